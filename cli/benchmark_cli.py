@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+from lib.benchmark import (
+    BENCHMARK_MODES,
+    generate_corpus,
+    generate_queries,
+    load_judgments,
+    load_queries,
+    run_benchmark,
+    write_queries,
+)
+from lib.search_utils import MOVIES_PATH, iter_movies
+
+
+def print_report(report) -> None:
+    setup = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in report["setup_s"].items())
+    print(f"{report['corpus']['documents']} documents, {report['config']['queries']} queries. Setup: {setup}")
+    for mode, result in report["modes"].items():
+        cold, warm = result["cold"], result["warm"]
+        print(f"\n{mode}")
+        print(f"  cold p50/p95/p99: {cold['p50_ms']:.2f} / {cold['p95_ms']:.2f} / {cold['p99_ms']:.2f} ms")
+        if warm:
+            print(f"  warm p50/p95/p99: {warm['p50_ms']:.2f} / {warm['p95_ms']:.2f} / {warm['p99_ms']:.2f} ms")
+        print(f"  QPS: {', '.join(f'{qps:.1f} ({threads} threads)' for threads, qps in result['qps'].items())}")
+        quality = result.get("quality")
+        if quality:
+            print("  " + ", ".join(f"{name} {value:.4f}" for name, value in quality.items() if name != "judged_queries")
+                  + f" over {quality['judged_queries']} judged queries")
+    print(f"\nPeak RSS over all modes: {report['peak_rss_mb']:.1f} MB")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark CLI: latency, throughput and quality of every retrieval mode")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    generate_parser = subparsers.add_parser("generate", help="Write a synthetic catalog of any size plus known-item queries and judgments")
+    generate_parser.add_argument("output_dir", type=str, help="Directory to create the data/ folder in, run the benchmark with --workdir pointing here")
+    generate_parser.add_argument("--size", type=int, default=10_000, help="Number of movies")
+    generate_parser.add_argument("--queries", type=int, default=200, help="Number of queries")
+    generate_parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    generate_parser.add_argument("--source", type=str, default=MOVIES_PATH, help="Catalog the text is drawn from")
+
+    queries_parser = subparsers.add_parser("queries", help="Write known-item queries and judgments for an existing catalog")
+    queries_parser.add_argument("output_dir", type=str, help="Directory for queries.txt and judgments.json")
+    queries_parser.add_argument("--input", type=str, default=MOVIES_PATH, help="Movies file (.json or .jsonl)")
+    queries_parser.add_argument("--queries", type=int, default=200, help="Number of queries")
+    queries_parser.add_argument("--seed", type=int, default=0, help="Random seed")
+
+    run_parser = subparsers.add_parser("run", help="Benchmark the retrieval modes over a query file")
+    run_parser.add_argument("queries", type=str, help="Query file, one query per line")
+    run_parser.add_argument("--judgments", type=str, default=None, help='Relevance judgments, JSON {query: {doc id: grade}} or {query: [doc ids]}')
+    run_parser.add_argument("--modes", type=str, nargs='+', choices=BENCHMARK_MODES, default=list(BENCHMARK_MODES), help="Retrieval modes to benchmark")
+    run_parser.add_argument("--k", type=int, default=10, help="Results per query, and the cutoff of recall@k and nDCG@k")
+    run_parser.add_argument("--threads", type=int, default=4, help="Measure QPS with 1, 2, 4, ... up to this many threads")
+    run_parser.add_argument("--warm-runs", type=int, default=2, help="Passes over the queries after the cold one")
+    run_parser.add_argument("--device", type=str, default="cpu", help="Encoder device")
+    run_parser.add_argument("--no-build", action="store_true", help="Load the existing keyword index instead of timing a fresh build in a temporary directory")
+    run_parser.add_argument("--workdir", type=str, default=None, help="Run against the data/ and cache/ of this directory, e.g. a generated corpus")
+    run_parser.add_argument("--output", type=str, default=None, help="Write the full report to this JSON file")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "generate":
+            movies = generate_corpus(args.output_dir, args.size, args.source, args.seed)
+            judgments = generate_queries(movies, args.queries, args.seed)
+            write_queries(os.path.join(args.output_dir, "queries.txt"), os.path.join(args.output_dir, "judgments.json"), judgments)
+            print(f"Wrote {len(movies)} movies and {len(judgments)} queries to {args.output_dir}")
+
+        case "queries":
+            judgments = generate_queries(list(iter_movies(args.input)), args.queries, args.seed)
+            os.makedirs(args.output_dir, exist_ok=True)
+            write_queries(os.path.join(args.output_dir, "queries.txt"), os.path.join(args.output_dir, "judgments.json"), judgments)
+            print(f"Wrote {len(judgments)} queries to {args.output_dir}")
+
+        case "run":
+            queries = load_queries(args.queries)
+            judgments = load_judgments(args.judgments) if args.judgments else None
+            output = os.path.abspath(args.output) if args.output else None
+            if args.workdir:
+                os.chdir(args.workdir)
+            threads = [1]
+            while threads[-1] * 2 <= args.threads:
+                threads.append(threads[-1] * 2)
+            if threads[-1] != args.threads and args.threads > 1:
+                threads.append(args.threads)
+            report = run_benchmark(queries, judgments, args.modes, args.k, threads, args.warm_runs, args.device, not args.no_build)
+            print_report(report)
+            if output:
+                with open(output, "w") as file:
+                    json.dump(report, file, indent=2)
+                print(f"\nWrote {output}")
+
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
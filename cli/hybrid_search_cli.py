@@ -1,4 +1,31 @@
 import argparse
+from lib.hybrid_search import HybridSearch
+from lib.profiling import add_profile_arguments, finish_profile, start_profile
+from lib.search_client import remote_search
+from lib.search_utils import HYBRID_ALPHA, RRF_K, SERVER_URL, load_movies, min_max_normalize
+
+
+def print_degraded(response) -> None:
+    if response["timed_out"]:
+        print(f"Timed out: {', '.join(response['timed_out'])} (results from the remaining leg only)")
+
+
+# Hybrid search in-process, or on a running search server with --server
+def hybrid_search(args, method, alpha=HYBRID_ALPHA, k=RRF_K):
+    params = {
+        "query": args.query,
+        "limit": args.limit,
+        "method": method,
+        "alpha": alpha,
+        "k": k,
+        "bm25_timeout": args.bm25_timeout,
+        "semantic_timeout": args.semantic_timeout,
+    }
+    if args.server:
+        return remote_search("hybrid", params, args.server)
+    hybrid = HybridSearch(load_movies())
+    del params["query"], params["limit"], params["method"]
+    return hybrid.search(args.query, method, args.limit, **params)
 
 
 def main() -> None:
@@ -8,26 +35,63 @@ def main() -> None:
     normalize = subparsers.add_parser("normalize", help="Normalize text for hybrid search")
     normalize.add_argument("scores", type=float, nargs='+', help="Scores to normalize")
 
+    weighted_search = subparsers.add_parser("weighted_search", help="Fuse min-max normalized BM25 and semantic scores")
+    weighted_search.add_argument("query", type=str, help="Search query")
+    weighted_search.add_argument("--alpha", type=float, default=HYBRID_ALPHA, help="Weight of the BM25 score, 1 - alpha goes to the semantic score")
+    weighted_search.add_argument("--limit", type=int, default=5, help="Number of results to return")
+    weighted_search.add_argument("--bm25-timeout", type=float, default=None, help="Seconds to wait for the BM25 leg")
+    weighted_search.add_argument("--semantic-timeout", type=float, default=None, help="Seconds to wait for the semantic leg before falling back to keyword-only results")
+    weighted_search.add_argument("--server", type=str, nargs="?", const=SERVER_URL, default=None, help="Send the query to a running search server (default %(const)s)")
+
+    rrf_search = subparsers.add_parser("rrf_search", help="Fuse BM25 and semantic rankings with reciprocal rank fusion")
+    rrf_search.add_argument("query", type=str, help="Search query")
+    rrf_search.add_argument("--k", type=int, default=RRF_K, help="RRF constant, larger values flatten the rank weights")
+    rrf_search.add_argument("--limit", type=int, default=5, help="Number of results to return")
+    rrf_search.add_argument("--bm25-timeout", type=float, default=None, help="Seconds to wait for the BM25 leg")
+    rrf_search.add_argument("--semantic-timeout", type=float, default=None, help="Seconds to wait for the semantic leg before falling back to keyword-only results")
+    rrf_search.add_argument("--server", type=str, nargs="?", const=SERVER_URL, default=None, help="Send the query to a running search server (default %(const)s)")
+
+    add_profile_arguments(subparsers)
     args = parser.parse_args()
+    start_profile(args)
 
     match args.command:
         case "normalize":
             scores = args.scores
             if not scores:
                 return
-            min_score = min(scores)
-            max_score = max(scores)
-            if min_score == max_score:
+            if min(scores) == max(scores):
                 for _ in scores:
                     print(1.0)
             else:
-                for score in scores:
-                    normalized = (score - min_score) / (max_score - min_score)
+                for normalized in min_max_normalize(scores):
                     print(f"* {normalized:.4f}")
 
+        case "weighted_search":
+            response = hybrid_search(args, "weighted", alpha=args.alpha)
+            print_degraded(response)
+            for i, result in enumerate(response["results"]):
+                print(f"\n{i+1}. {result['title']}")
+                print(f"   Hybrid Score: {result['score']:.4f}")
+                bm25_score = "-" if result['bm25_score'] is None else f"{result['bm25_score']:.4f}"
+                semantic_score = "-" if result['semantic_score'] is None else f"{result['semantic_score']:.4f}"
+                print(f"   BM25: {bm25_score}, Semantic: {semantic_score}")
+                print(f"   {result['document']}...")
+
+        case "rrf_search":
+            response = hybrid_search(args, "rrf", k=args.k)
+            print_degraded(response)
+            for i, result in enumerate(response["results"]):
+                print(f"\n{i+1}. {result['title']}")
+                print(f"   RRF Score: {result['score']:.4f}")
+                print(f"   BM25 Rank: {result['bm25_rank'] or '-'}, Semantic Rank: {result['semantic_rank'] or '-'}")
+                print(f"   {result['document']}...")
+
         case _:
             parser.print_help()
 
+    finish_profile(args)
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
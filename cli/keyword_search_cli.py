@@ -2,8 +2,13 @@
 
 import argparse
 from lib.inverted_index import InvertedIndex
+from lib.profiling import add_profile_arguments, finish_profile, start_profile
+from lib.search_client import remote_search
 from lib.search_utils import *
 
+# commands that read the existing index, the others (build, convert, help) never load it
+INDEX_COMMANDS = {"search", "bm25idf", "bm25search", "bm25tf", "idf", "tf", "tfidf", "upsert", "delete", "merge", "bm25prune", "index_memory"}
+
 def main() -> None:
     
     parser = argparse.ArgumentParser(description="Keyword Search CLI")
@@ -12,7 +17,24 @@ def main() -> None:
     search_parser = subparsers.add_parser("search", help="Search movies using BM25")
     search_parser.add_argument("query", type=str, help="Search query")
 
-    subparsers.add_parser("build", help="Generates inverted indexes for movies")
+    build_parser = subparsers.add_parser("build", help="Generates inverted indexes for movies")
+    build_parser.add_argument("--input", type=str, default=MOVIES_PATH, help="Movies file (.json or .jsonl)")
+    build_parser.add_argument("--workers", type=int, default=1, help="Worker processes for tokenizing")
+    build_parser.add_argument("--batch-size", type=int, default=BUILD_BATCH_SIZE, help="Documents per worker batch")
+    build_parser.add_argument("--positions", action="store_true", help="Also store token positions, for phrase and proximity search")
+
+    export_parser = subparsers.add_parser("export_jsonl", help="Write the movies file as JSON Lines for streaming builds")
+    export_parser.add_argument("output", type=str, help="Target .jsonl file")
+
+    subparsers.add_parser("convert", help="Convert a pickle index cache to the binary index format")
+
+    upsert_parser = subparsers.add_parser("upsert", help="Add or replace movies in the index by id")
+    upsert_parser.add_argument("input", type=str, help="Movies file (.json or .jsonl) with the movies to upsert")
+
+    delete_parser = subparsers.add_parser("delete", help="Delete movies from the index by id")
+    delete_parser.add_argument("doc_ids", type=int, nargs='+', help="Document ids")
+
+    subparsers.add_parser("merge", help="Merge the delta segments into the base index")
 
     term_freq_parser = subparsers.add_parser("tf", help="Get the term frequency in a document")
     term_freq_parser.add_argument("doc_id", type=int, help="Document id")
@@ -37,27 +59,34 @@ def main() -> None:
     bm25_tf_parser.add_argument("b", type=float, nargs='?', default=BM25_B, help="Tunable BM25 b parameter")
 
     bm25search_parser = subparsers.add_parser("bm25search", help="Search movies using full BM25 scoring")
-    bm25search_parser.add_argument("query", type=str, help="Search query")
+    bm25search_parser.add_argument("query", type=str, help='Search query, "quoted phrases" must match exactly (needs an index built with --positions)')
     bm25search_parser.add_argument("--limit", type=int, nargs='?', default=5, help="Limit")
+    bm25search_parser.add_argument("--proximity", action="store_true", help="Rerank by how close together the query terms occur (needs an index built with --positions)")
+    bm25search_parser.add_argument("--window", type=int, default=PROXIMITY_WINDOW, help="Largest word distance that counts for --proximity")
+    bm25search_parser.add_argument("--server", type=str, nargs="?", const=SERVER_URL, default=None, help="Send the query to a running search server (default %(const)s)")
 
+    subparsers.add_parser("index_memory", help="Report the memory of the postings, positions and document text")
 
-    # Create an instance of InvertedIndex
-    ii = InvertedIndex()
-
-    try:
-        ii.load()
-        data = ii.index
-    except Exception as e:
-        print(e)
+    bm25prune_parser = subparsers.add_parser("bm25prune", help="Compare postings scored and latency of pruned and exhaustive BM25 search")
+    bm25prune_parser.add_argument("queries", type=str, nargs='+', help="Search queries")
+    bm25prune_parser.add_argument("--limit", type=int, default=5, help="Limit")
 
-    # Load stop words (sets module-level `stop_words_list`)
-    load_stop_words()
 
+    add_profile_arguments(subparsers)
     args = parser.parse_args()
+    start_profile(args)
+
+    # Create an instance of InvertedIndex, loaded only for commands that read it
+    ii = InvertedIndex()
+    if args.command in INDEX_COMMANDS and not getattr(args, "server", None):
+        try:
+            ii.load()
+        except Exception as e:
+            print(e)
     
     try:
         term = args.term.lower()
-        term = stemmer.stem(term)
+        term = get_tokenizer().stem(term)
     except:
         # do nothing
         pass
@@ -82,15 +111,42 @@ def main() -> None:
                     for doc_id in ii.get_documents(token):
                         if len(result_list) >= MAX_SEARCH_RESULTS:
                             break
-                        result_list.append((doc_id, ii.docmap[doc_id]))
-                        print((doc_id, ii.docmap[doc_id]))
+                        result_list.append((doc_id, ii.get_text(doc_id)))
+                        print((doc_id, ii.get_text(doc_id)))
                 except Exception as e:
                     print(f"No results found for token '{token}'")
         case "bm25idf":
             bm25idf = ii.get_bm25_idf(term)
             print(f"BM25 IDF score of '{args.term}': {bm25idf:.2f}")
         case "bm25search":
-            ii.bm25_search(args.query, args.limit)
+            if args.server:
+                params = {"query": args.query, "limit": args.limit, "proximity": args.proximity, "window": args.window}
+                results = remote_search("bm25", params, args.server)["results"]
+                movie_dict = {result['id']: result['title'] for result in results}
+            else:
+                try:
+                    results = ii.bm25_search(args.query, args.limit, proximity=args.proximity, window=args.window)
+                except ValueError as e:
+                    print(e)
+                    return
+                movie_dict = load_movie_data()
+            for result in results:
+                print(f"({result['id']}) {movie_dict[result['id']]} - Score: {result['score']:.2f}")
+        case "index_memory":
+            report = ii.memory_report()
+            print(f"Postings: {report['postings_bytes'] / 1e6:.2f} MB")
+            print(f"Document text: {report['document_text_bytes'] / 1e6:.2f} MB")
+            if report['positions']:
+                print(f"Positions: {report['position_bytes'] / 1e6:.2f} MB for {report['positions']} positions "
+                      f"({', '.join(report['position_dtypes'])} deltas), "
+                      f"{report['position_overhead']:.0%} of the postings")
+            else:
+                print("Positions: none, build with --positions")
+        case "bm25prune":
+            for row in ii.pruning_report(args.queries, args.limit):
+                print(f"{row['query']}: {row['maxscore_postings']}/{row['exhaustive_postings']} postings scored, "
+                      f"{row['maxscore_ms']:.2f}ms vs {row['exhaustive_ms']:.2f}ms exhaustive, "
+                      f"{'identical' if row['identical'] else 'DIFFERENT'} results")
         case "bm25tf":
             bm25tf = ii.get_bm25_tf(doc_id, term, args.k1)
             print(f"BM25 TF score of '{args.term}' in document '{args.doc_id}': {bm25tf:.2f}")
@@ -108,11 +164,32 @@ def main() -> None:
             tf_idf = tf * idf
             print(f"TF-IDF score of '{term}' in document '{doc_id}': {tf_idf:.2f}")
         case "build":
-            ii.build()
+            ii.build(args.input, args.workers, args.batch_size, args.positions)
+        case "export_jsonl":
+            count = write_movies_jsonl(MOVIES_PATH, args.output)
+            print(f"Wrote {count} movies to {args.output}")
+        case "convert":
+            ii.convert_pickle_cache()
+        case "upsert":
+            try:
+                count = ii.upsert_documents(iter_movies(args.input))
+            except ValueError as e:
+                print(e)
+                return
+            print(f"Upserted {count} documents")
+        case "delete":
+            try:
+                count = ii.delete_documents(args.doc_ids)
+            except ValueError as e:
+                print(e)
+                return
+            print(f"Deleted {count} documents")
+        case "merge":
+            ii.merge_segments()
         case _:
             parser.print_help()
 
-    pass
+    finish_profile(args)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,148 @@
+import os
+import time
+import numpy as np
+from lib.search_utils import ANN_NPROBE, top_k
+from typing import Dict, List, Optional, Tuple
+
+# rows assigned to centroids per matrix product while clustering, bounds scratch memory
+KMEANS_BLOCK_SIZE = 8192
+KMEANS_ITERATIONS = 20
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), KMEANS_BLOCK_SIZE):
+        block = vectors[start:start + KMEANS_BLOCK_SIZE]
+        assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignment
+
+
+def spherical_kmeans(vectors: np.ndarray, k: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0) -> np.ndarray:
+    # k-means on unit vectors with cosine similarity, centroids re-normalized every step
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        assignment = _assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=k)
+        # an empty cluster restarts from a random vector
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = vectors[rng.choice(len(vectors), size=len(empty))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
+
+
+class IVFIndex:
+    # Inverted-file ANN index over L2-normalized vectors: k-means centroids split
+    # the rows into nlist lists and a query only scores the rows of the nprobe
+    # lists whose centroids are closest. nprobe is the recall/latency knob,
+    # nprobe == nlist is an exact scan
+    def __init__(self, nprobe: int = ANN_NPROBE) -> None:
+        self.nprobe = nprobe
+        self.centroids = np.zeros((0, 0), dtype=np.float32)
+        # rows of list l live in list_rows[list_offsets[l]:list_offsets[l + 1]]
+        self.list_offsets = np.zeros(1, dtype=np.int64)
+        self.list_rows = np.zeros(0, dtype=np.int64)
+        # the indexed vectors, not owned: they stay in the embeddings matrix
+        self.vectors: Optional[np.ndarray] = None
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, nlist: Optional[int] = None, nprobe: int = ANN_NPROBE, seed: int = 0) -> "IVFIndex":
+        index = cls(nprobe)
+        index.vectors = vectors
+        if len(vectors) == 0:
+            # no lists: every search returns nothing
+            index.centroids = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+            return index
+        if nlist is None:
+            # about sqrt(n) lists of about sqrt(n) rows
+            nlist = int(np.sqrt(len(vectors)))
+        nlist = max(1, min(nlist, len(vectors)))
+        index.centroids = spherical_kmeans(vectors, nlist, seed=seed)
+        assignment = _assign(vectors, index.centroids)
+        index.list_rows = np.argsort(assignment, kind="stable")
+        index.list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=nlist), out=index.list_offsets[1:])
+        index.vectors = vectors
+        return index
+
+    def save(self, path: str) -> None:
+        with open(path, 'wb') as file:
+            np.savez(
+                file,
+                centroids=self.centroids,
+                list_offsets=self.list_offsets,
+                list_rows=self.list_rows,
+                shape=np.array(self.vectors.shape, dtype=np.int64),
+            )
+
+    @classmethod
+    def load(cls, path: str, vectors: np.ndarray, nprobe: int = ANN_NPROBE) -> Optional["IVFIndex"]:
+        # None when the saved index was built for a different matrix
+        with np.load(path) as data:
+            if tuple(data["shape"]) != vectors.shape:
+                return None
+            index = cls(nprobe)
+            index.centroids = data["centroids"]
+            index.list_offsets = data["list_offsets"]
+            index.list_rows = data["list_rows"]
+        index.vectors = vectors
+        return index
+
+    # Rows of the lists to scan for a query
+    def candidates(self, query: np.ndarray, nprobe: Optional[int] = None) -> np.ndarray:
+        probe = top_k(self.centroids @ query, nprobe or self.nprobe)
+        return np.concatenate(
+            [np.zeros(0, dtype=np.int64)]
+            + [self.list_rows[self.list_offsets[l]:self.list_offsets[l + 1]] for l in probe.tolist()]
+        )
+
+    # Best k rows as (rows, scores), best first
+    def search(self, query: np.ndarray, k: int, nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        rows = np.sort(self.candidates(query, nprobe))
+        scores = self.vectors[rows] @ query
+        top = top_k(scores, k)
+        return rows[top], scores[top]
+
+
+def load_or_create_ivf_index(path: str, vectors: np.ndarray, nlist: Optional[int] = None, nprobe: int = ANN_NPROBE, rebuild: bool = False) -> IVFIndex:
+    index = None
+    if os.path.isfile(path) and nlist is None and not rebuild:
+        index = IVFIndex.load(path, vectors, nprobe)
+    if index is None:
+        index = IVFIndex.build(vectors, nlist, nprobe)
+        index.save(path)
+    return index
+
+
+# recall@k of the ANN search against the exact scan, plus mean latency of each,
+# for every nprobe. Queries are sampled rows of the indexed matrix, so an empty
+# index has no rows to report
+def recall_report(index: IVFIndex, k: int = 10, samples: int = 200, nprobes: Optional[List[int]] = None, seed: int = 0) -> List[Dict]:
+    vectors = index.vectors
+    if len(vectors) == 0:
+        return []
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), size=min(samples, len(vectors)), replace=False)]
+    if nprobes is None:
+        nprobes = sorted({n for n in (1, 2, 4, 8, 16, 32, 64, index.nlist) if n <= index.nlist})
+
+    start = time.perf_counter()
+    exact = [set(top_k(vectors @ query, k).tolist()) for query in queries]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    report = []
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        found = [set(index.search(query, k, nprobe)[0].tolist()) for query in queries]
+        ann_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        recall = float(np.mean([len(f & e) / len(e) for f, e in zip(found, exact)]))
+        report.append({"nprobe": nprobe, "recall": recall, "ann_ms": ann_ms, "exact_ms": exact_ms})
+    return report
@@ -0,0 +1,233 @@
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from lib.chunked_semantic_search import ChunkedSemanticSearch
+from lib.hybrid_search import HybridSearch
+from lib.inverted_index import InvertedIndex
+from lib.micro_batch import measure_qps
+from lib.profiling import get_profiler
+from lib.query_cache import get_query_cache
+from lib.search_utils import (
+    HYBRID_ALPHA,
+    MOVIES_PATH,
+    RRF_K,
+    STOP_WORDS_PATH,
+    get_tokenizer,
+    iter_movies,
+    load_movies,
+    split_text_to_sentences,
+)
+from typing import Callable, Dict, List, Optional
+
+BENCHMARK_MODES = ("bm25", "semantic", "chunked", "hybrid_weighted", "hybrid_rrf")
+LATENCY_PERCENTILES = (50, 95, 99)
+
+
+def generate_corpus(output_dir: str, size: int, source_path: str = MOVIES_PATH, seed: int = 0) -> List[dict]:
+    # A catalog of `size` movies under output_dir/data for scaling runs. Titles
+    # are recombined from the source catalog's title words and descriptions
+    # from its sentences, so the text stays realistic for both tokenizer and model
+    rng = np.random.default_rng(seed)
+    source = list(iter_movies(source_path))
+    title_words = sorted({word for movie in source for word in movie['title'].split()})
+    sentences = [sentence for movie in source for sentence in split_text_to_sentences(movie['description'])]
+    sentence_counts = [len(split_text_to_sentences(movie['description'])) or 1 for movie in source]
+
+    movies = []
+    for doc_id in range(1, size + 1):
+        title = " ".join(rng.choice(title_words, size=int(rng.integers(1, 4))).tolist())
+        count = int(rng.choice(sentence_counts))
+        description = " ".join(rng.choice(sentences, size=count).tolist())
+        movies.append({"id": doc_id, "title": title, "description": description})
+
+    os.makedirs(os.path.join(output_dir, "data"), exist_ok=True)
+    with open(os.path.join(output_dir, MOVIES_PATH), "w") as file:
+        json.dump({"movies": movies}, file)
+    shutil.copyfile(STOP_WORDS_PATH, os.path.join(output_dir, STOP_WORDS_PATH))
+    return movies
+
+
+def generate_queries(movies: List[dict], count: int, seed: int = 0) -> Dict[str, Dict[int, int]]:
+    # Known-item queries: a few content words of one movie's title and
+    # description, judged relevant (grade 1) for that movie only
+    rng = np.random.default_rng(seed)
+    tokenizer = get_tokenizer()
+    judgments: Dict[str, Dict[int, int]] = {}
+    for index in rng.permutation(len(movies))[:count].tolist():
+        movie = movies[index]
+        words = [word.strip(".,!?") for word in f"{movie['title']} {movie['description']}".split()]
+        words = [word for word in words if word and word.lower() not in tokenizer.stop_words]
+        if not words:
+            continue
+        picked = sorted(rng.choice(len(words), size=min(len(words), int(rng.integers(2, 5))), replace=False).tolist())
+        judgments.setdefault(" ".join(words[i] for i in picked), {})[movie['id']] = 1
+    return judgments
+
+
+def write_queries(path: str, judgments_path: Optional[str], judgments: Dict[str, Dict[int, int]]) -> None:
+    with open(path, "w") as file:
+        file.writelines(f"{query}\n" for query in judgments)
+    if judgments_path:
+        with open(judgments_path, "w") as file:
+            json.dump({query: {str(doc_id): grade for doc_id, grade in grades.items()} for query, grades in judgments.items()}, file, indent=2)
+
+
+# One query per line, blank lines skipped
+def load_queries(path: str) -> List[str]:
+    with open(path, "r") as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+# {query: {doc id: grade}}, a list of doc ids per query means grade 1 for each
+def load_judgments(path: str) -> Dict[str, Dict[int, int]]:
+    with open(path, "r") as file:
+        data = json.load(file)
+    judgments = {}
+    for query, relevant in data.items():
+        if isinstance(relevant, list):
+            judgments[query] = {int(doc_id): 1 for doc_id in relevant}
+        else:
+            judgments[query] = {int(doc_id): int(grade) for doc_id, grade in relevant.items()}
+    return judgments
+
+
+def quality_metrics(results: List[List[int]], queries: List[str], judgments: Dict[str, Dict[int, int]], k: int) -> Dict:
+    # recall@k, MRR and nDCG@k (gain 2^grade - 1) over the judged queries
+    recalls, reciprocal_ranks, ndcgs = [], [], []
+    for query, retrieved in zip(queries, results):
+        grades = {doc_id: grade for doc_id, grade in judgments.get(query, {}).items() if grade > 0}
+        if not grades:
+            continue
+        retrieved = retrieved[:k]
+        recalls.append(len(set(retrieved) & set(grades)) / len(grades))
+        rank = next((i for i, doc_id in enumerate(retrieved) if doc_id in grades), None)
+        reciprocal_ranks.append(0.0 if rank is None else 1 / (rank + 1))
+        discounts = 1 / np.log2(np.arange(2, k + 2))
+        dcg = sum((2 ** grades.get(doc_id, 0) - 1) * discounts[i] for i, doc_id in enumerate(retrieved))
+        ideal = sorted(grades.values(), reverse=True)[:k]
+        idcg = sum((2 ** grade - 1) * discounts[i] for i, grade in enumerate(ideal))
+        ndcgs.append(dcg / idcg)
+    if not recalls:
+        return {}
+    return {
+        "judged_queries": len(recalls),
+        f"recall@{k}": float(np.mean(recalls)),
+        "mrr": float(np.mean(reciprocal_ranks)),
+        f"ndcg@{k}": float(np.mean(ndcgs)),
+    }
+
+
+def latency_percentiles(latencies_ms: List[float]) -> Dict:
+    values = np.percentile(latencies_ms, LATENCY_PERCENTILES)
+    return {f"p{p}_ms": float(value) for p, value in zip(LATENCY_PERCENTILES, values)}
+
+
+# Peak resident set size of this process so far
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def benchmark_mode(search: Callable[[str], List[int]], queries: List[str], judgments: Optional[Dict], k: int, threads: List[int], warm_runs: int) -> Dict:
+    # The first pass over the queries is cold: the shared query embedding cache
+    # is emptied first, so no mode sees the embeddings of the one before. The
+    # following warm_runs passes are warm. With profiling on, the profiler is
+    # reset too and the report holds this mode's stages only
+    get_query_cache().clear()
+    profiler = get_profiler()
+    profiler.reset()
+    cold, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(search(query))
+        cold.append((time.perf_counter() - start) * 1000)
+    warm = []
+    for _ in range(warm_runs):
+        for query in queries:
+            start = time.perf_counter()
+            search(query)
+            warm.append((time.perf_counter() - start) * 1000)
+
+    report = {
+        "cold": latency_percentiles(cold),
+        "warm": latency_percentiles(warm) if warm else {},
+        "qps": {str(count): measure_qps(search, queries, count) for count in threads},
+    }
+    if judgments:
+        report["quality"] = quality_metrics(results, queries, judgments, k)
+    if profiler.enabled:
+        report["profile"] = profiler.report()
+    return report
+
+
+def run_benchmark(queries: List[str], judgments: Optional[Dict] = None, modes=BENCHMARK_MODES, k: int = 10, threads: Optional[List[int]] = None, warm_runs: int = 2, device: str = "cpu", build: bool = True) -> Dict:
+    # Benchmark every mode over the catalog and indexes of the working directory.
+    # Setup (index build, embedding load or build) is timed once per searcher.
+    # The timed keyword index build goes to a temporary directory, the index in
+    # cache/ and its delta segments are left alone
+    threads = threads or [1]
+    documents = load_movies()
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "corpus": {"path": os.path.abspath(MOVIES_PATH), "documents": len(documents)},
+        "config": {"queries": len(queries), "k": k, "threads": threads, "warm_runs": warm_runs, "device": device},
+        "setup_s": {},
+        "modes": {},
+    }
+
+    index = None
+    scratch = None
+    if any(mode in ("bm25", "hybrid_weighted", "hybrid_rrf") for mode in modes):
+        start = time.perf_counter()
+        if build:
+            scratch = tempfile.TemporaryDirectory(prefix="benchmark-index-")
+            index = InvertedIndex(cache_dir=scratch.name)
+            index.build()
+        else:
+            index = InvertedIndex()
+            index.load()
+        report["setup_s"]["bm25_index_build" if build else "bm25_index_load"] = time.perf_counter() - start
+
+    semantic = None
+    if any(mode != "bm25" for mode in modes):
+        start = time.perf_counter()
+        semantic = ChunkedSemanticSearch(device=device)
+        report["setup_s"]["model_load"] = time.perf_counter() - start
+        if "semantic" in modes:
+            start = time.perf_counter()
+            semantic.load_or_create_embeddings(documents)
+            report["setup_s"]["movie_embeddings"] = time.perf_counter() - start
+        start = time.perf_counter()
+        semantic.load_or_create_chunk_embeddings(documents)
+        report["setup_s"]["chunk_embeddings"] = time.perf_counter() - start
+
+    hybrid = None
+    if any(mode.startswith("hybrid") for mode in modes):
+        hybrid = HybridSearch(documents, semantic, index)
+
+    searches = {
+        "bm25": lambda query: [result["id"] for result in index.bm25_search(query, k)],
+        "semantic": lambda query: [doc["id"] for _, doc in semantic.search(query, k)],
+        "chunked": lambda query: [result["id"] for result in semantic.search_chunks(query, k)],
+        "hybrid_weighted": lambda query: [result["id"] for result in hybrid.search(query, "weighted", k, alpha=HYBRID_ALPHA)["results"]],
+        "hybrid_rrf": lambda query: [result["id"] for result in hybrid.search(query, "rrf", k, k=RRF_K)["results"]],
+    }
+    for mode in modes:
+        report["modes"][mode] = benchmark_mode(searches[mode], queries, judgments, k, threads, warm_runs)
+    # a process-wide high-water mark, so one figure for the whole run
+    report["peak_rss_mb"] = peak_rss_mb()
+    if scratch is not None:
+        scratch.cleanup()
+    return report
@@ -0,0 +1,100 @@
+import numpy as np
+from lib.index_format import read_index_file, write_index_file
+from typing import Dict
+
+CHUNK_METADATA_KIND = "chunk_metadata"
+
+
+class ChunkMetadata:
+    # Where every row of the chunk embeddings comes from, as parallel arrays
+    # memory-mapped from one index file (see lib/index_format.py), so loading
+    # parses nothing but the header. Rows are in chunk_idx order and the chunks
+    # of a doc are contiguous rows, docs in build order
+    def __init__(self) -> None:
+        # doc ordinal to doc id
+        self.doc_ids = np.zeros(0, dtype=np.int64)
+        # chunks of doc ordinal d are rows [doc_chunk_offsets[d], doc_chunk_offsets[d + 1])
+        self.doc_chunk_offsets = np.zeros(1, dtype=np.int64)
+        # doc ordinals sorted by doc id, for doc id lookups
+        self.doc_id_order = np.zeros(0, dtype=np.int64)
+        # chunk_idx to doc ordinal
+        self.chunk_docs = np.zeros(0, dtype=np.int32)
+        # chunk_idx to its [first, end) sentences in the doc's description, as
+        # split by split_text_to_sentences
+        self.chunk_sentences = np.zeros((0, 2), dtype=np.int32)
+
+    @classmethod
+    def from_chunks(cls, doc_ids: np.ndarray, chunk_docs: np.ndarray, chunk_sentences: np.ndarray) -> "ChunkMetadata":
+        # chunk_docs must be non-decreasing: a doc's chunks are contiguous
+        metadata = cls()
+        metadata.doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        metadata.chunk_docs = np.asarray(chunk_docs, dtype=np.int32)
+        metadata.chunk_sentences = np.asarray(chunk_sentences, dtype=np.int32).reshape(-1, 2)
+        counts = np.bincount(metadata.chunk_docs, minlength=len(metadata.doc_ids))
+        metadata.doc_chunk_offsets = np.zeros(len(metadata.doc_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=metadata.doc_chunk_offsets[1:])
+        metadata.doc_id_order = np.argsort(metadata.doc_ids, kind="stable")
+        return metadata
+
+    @classmethod
+    def load(cls, path: str) -> "ChunkMetadata":
+        sections, meta = read_index_file(path)
+        if meta.get("kind") != CHUNK_METADATA_KIND:
+            raise ValueError(f"{path} is not a chunk metadata file")
+        metadata = cls()
+        metadata.doc_ids = sections["doc_ids"]
+        metadata.doc_chunk_offsets = sections["doc_chunk_offsets"]
+        metadata.doc_id_order = sections["doc_id_order"]
+        metadata.chunk_docs = sections["chunk_docs"]
+        metadata.chunk_sentences = sections["chunk_sentences"]
+        return metadata
+
+    def save(self, path: str) -> None:
+        sections = {
+            "doc_ids": self.doc_ids,
+            "doc_chunk_offsets": self.doc_chunk_offsets,
+            "doc_id_order": self.doc_id_order,
+            "chunk_docs": self.chunk_docs,
+            "chunk_sentences": self.chunk_sentences,
+        }
+        write_index_file(path, sections, self.meta())
+
+    def meta(self) -> Dict:
+        return {"kind": CHUNK_METADATA_KIND, "chunks": len(self), "docs": self.doc_count}
+
+    def __len__(self) -> int:
+        return len(self.chunk_docs)
+
+    @property
+    def doc_count(self) -> int:
+        return len(self.doc_ids)
+
+    # Chunks per doc ordinal
+    @property
+    def doc_chunk_counts(self) -> np.ndarray:
+        return np.diff(self.doc_chunk_offsets)
+
+    # Doc id of each of the given chunk_idxs
+    def chunk_doc_ids(self, chunk_idxs) -> np.ndarray:
+        return self.doc_ids[self.chunk_docs[chunk_idxs]]
+
+    # Number of chunks of the doc of each of the given chunk_idxs
+    def chunk_totals(self, chunk_idxs) -> np.ndarray:
+        docs = self.chunk_docs[chunk_idxs]
+        return self.doc_chunk_offsets[docs + 1] - self.doc_chunk_offsets[docs]
+
+    # Doc ordinal of each of the given doc ids, -1 for ids without chunks
+    def doc_ordinals(self, doc_ids) -> np.ndarray:
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        if self.doc_count == 0:
+            return np.full(doc_ids.shape, -1, dtype=np.int64)
+        sorted_ids = self.doc_ids[self.doc_id_order]
+        pos = np.minimum(np.searchsorted(sorted_ids, doc_ids), self.doc_count - 1)
+        return np.where(sorted_ids[pos] == doc_ids, self.doc_id_order[pos], -1)
+
+    # [start, end) rows of the chunks of a doc id, empty when it has none
+    def doc_chunks(self, doc_id: int) -> range:
+        ordinal = int(self.doc_ordinals(doc_id))
+        if ordinal < 0:
+            return range(0)
+        return range(int(self.doc_chunk_offsets[ordinal]), int(self.doc_chunk_offsets[ordinal + 1]))
@@ -0,0 +1,171 @@
+import json
+import os
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import batched
+from lib.chunk_metadata import ChunkMetadata
+from lib.embedding_cache import cached_rows, commit_cached_embeddings, embedding_key, invalidate_cached_embeddings
+from lib.search_utils import CHUNK_TASK_SIZE, EMBED_PIPELINE_BATCH_SIZE, semantic_chunk_count, semantic_chunk_spans
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# one row per chunk of an unfinished build, in chunk_idx order: the doc
+# ordinal of the chunk and its [first, end) sentences, see ChunkMetadata
+CHUNK_ROW_DTYPE = np.dtype([("doc", np.int32), ("sentence_start", np.int32), ("sentence_end", np.int32)])
+
+
+# Chunk one task of (doc ordinal, description) pairs, runs inside chunking workers
+def _chunk_task(task: Tuple[Tuple[int, str], ...], max_chunk_size: int, overlap: int) -> List[Tuple[int, List[str], List[Tuple[int, int]]]]:
+    return [(doc, *semantic_chunk_spans(text, max_chunk_size, overlap)) for doc, text in task]
+
+
+def iter_document_chunks(descriptions: Iterable[Tuple[int, str]], max_chunk_size: int, overlap: int, workers: int = 0) -> Iterator[Tuple[int, List[str], List[Tuple[int, int]]]]:
+    # (doc ordinal, chunks, sentence spans) of every description, in order.
+    # With workers the descriptions are chunked in worker processes while the
+    # consumer encodes, at most two tasks per worker in flight; workers <= 0
+    # chunks in-process
+    tasks = batched(descriptions, CHUNK_TASK_SIZE)
+    if workers <= 0:
+        for task in tasks:
+            yield from _chunk_task(task, max_chunk_size, overlap)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for task in tasks:
+            in_flight.append(executor.submit(_chunk_task, task, max_chunk_size, overlap))
+            if len(in_flight) >= workers * 2:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+
+def _read_checkpoint(path: str) -> Optional[Dict]:
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def _write_checkpoint(path: str, checkpoint: Dict) -> None:
+    with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+        json.dump(checkpoint, file)
+    os.replace(f"{path}.tmp", path)
+
+
+# Rows of one batch of chunks: copied from the cache by key, or encoded when missing
+def _embed_batch(texts: List[str], keys: List[str], cached: Optional[np.ndarray], rows: Dict[str, int], encode: Callable[[List[str]], np.ndarray]) -> Tuple[np.ndarray, int]:
+    missing = [i for i, key in enumerate(keys) if key not in rows]
+    reused = [i for i, key in enumerate(keys) if key in rows]
+    encoded = encode([texts[i] for i in missing]) if missing else None
+    dim = encoded.shape[1] if encoded is not None else cached.shape[1]
+    dtype = encoded.dtype if encoded is not None else cached.dtype
+    block = np.empty((len(texts), dim), dtype=dtype)
+    if reused:
+        block[reused] = cached[[rows[keys[i]] for i in reused]]
+    if missing:
+        block[missing] = encoded
+    return block, len(missing)
+
+
+def embed_document_chunks(
+    path: str,
+    metadata_path: str,
+    model_name: str,
+    params: str,
+    documents: List[Tuple[int, str]],
+    max_chunk_size: int,
+    overlap: int,
+    encode: Callable[[List[str]], np.ndarray],
+    digest: str,
+    workers: int = 0,
+    batch_size: int = EMBED_PIPELINE_BATCH_SIZE,
+) -> Tuple[int, int]:
+    # Chunk the description of every (doc id, description) and embed the chunks
+    # batch by batch into a preallocated memory-mapped .npy, committed as the
+    # embedding cache at path, with their ChunkMetadata at metadata_path.
+    # Memory stays bounded by the batch size plus one key per chunk. Chunks
+    # already in the cache are copied instead of encoded. After
+    # every batch the rows so far are flushed and checkpointed, so a build
+    # interrupted for the same digest resumes after its last checkpoint.
+    # Returns (chunks encoded, chunks resumed from the checkpoint)
+    stem = os.path.splitext(path)[0]
+    partial_path = f"{stem}.partial.npy"
+    partial_metadata_path = f"{os.path.splitext(metadata_path)[0]}.partial.npy"
+    checkpoint_path = f"{stem}.checkpoint.json"
+
+    total = sum(semantic_chunk_count(text, max_chunk_size, overlap) for _, text in documents)
+
+    resumed = 0
+    checkpoint = _read_checkpoint(checkpoint_path)
+    if (checkpoint is not None and checkpoint["digest"] == digest and checkpoint["total"] == total
+            and os.path.isfile(partial_path) and os.path.isfile(partial_metadata_path)):
+        resumed = checkpoint["rows"]
+    embeddings = np.lib.format.open_memmap(partial_path, mode="r+") if resumed else None
+    metadata = np.lib.format.open_memmap(
+        partial_metadata_path,
+        mode="r+" if resumed else "w+",
+        dtype=CHUNK_ROW_DTYPE,
+        shape=(total,),
+    )
+    if resumed:
+        print(f"Resuming after {resumed} of {total} chunks")
+
+    cached, rows = cached_rows(path)
+    keys: List[str] = []
+    encoded = 0
+    batch_texts: List[str] = []
+    row = 0
+
+    def write_batch() -> None:
+        nonlocal embeddings, encoded
+        start = row - len(batch_texts)
+        block, batch_encoded = _embed_batch(batch_texts, keys[start:row], cached, rows, encode)
+        if embeddings is None:
+            embeddings = np.lib.format.open_memmap(partial_path, mode="w+", dtype=block.dtype, shape=(total, block.shape[1]))
+        embeddings[start:row] = block
+        # rows reach the disk before the checkpoint that covers them
+        embeddings.flush()
+        metadata.flush()
+        _write_checkpoint(checkpoint_path, {"digest": digest, "total": total, "rows": row})
+        encoded += batch_encoded
+        batch_texts.clear()
+        print(f"Embedded {row} of {total} chunks", end="\r", flush=True)
+
+    # chunks before the checkpoint are chunked again for their keys, not encoded
+    descriptions = ((doc, text) for doc, (_, text) in enumerate(documents))
+    for doc, chunks, spans in iter_document_chunks(descriptions, max_chunk_size, overlap, workers):
+        for chunk, (sentence_start, sentence_end) in zip(chunks, spans):
+            keys.append(embedding_key(model_name, params, chunk))
+            row += 1
+            if row <= resumed:
+                continue
+            metadata[row - 1] = (doc, sentence_start, sentence_end)
+            batch_texts.append(chunk)
+            if len(batch_texts) >= batch_size:
+                write_batch()
+    if batch_texts:
+        write_batch()
+    if total > 0:
+        print()
+
+    if embeddings is None:
+        # no chunks at all
+        np.save(partial_path, np.zeros((0, 0), dtype=np.float32))
+    del embeddings
+    chunk_metadata = ChunkMetadata.from_chunks(
+        np.array([doc_id for doc_id, _ in documents], dtype=np.int64),
+        np.array(metadata["doc"]),
+        np.stack([metadata["sentence_start"], metadata["sentence_end"]], axis=1),
+    )
+    del metadata
+
+    # metadata first with the old cache invalidated: the embeddings manifest
+    # written last is the commit point
+    invalidate_cached_embeddings(path)
+    chunk_metadata.save(metadata_path)
+    os.remove(partial_metadata_path)
+    commit_cached_embeddings(path, partial_path, model_name, params, digest, keys)
+    if os.path.isfile(checkpoint_path):
+        os.remove(checkpoint_path)
+    return encoded, resumed
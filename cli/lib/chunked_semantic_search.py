@@ -1,36 +1,55 @@
-import json
 import numpy as np
 import os
-from typing import Dict, List
-from lib.semantic_search import SemanticSearch
+import time
+from lib.ann_index import load_or_create_ivf_index
+from lib.chunk_metadata import ChunkMetadata
+from lib.chunk_pipeline import embed_document_chunks
+from lib.embedding_cache import cached_embeddings_current, documents_digest, load_cached_embeddings
+from lib.profiling import count, stage
+from lib.quantization import QuantizedEmbeddings
+from lib.semantic_search import SemanticSearch, normalize_embeddings
 from lib.search_utils import (
+    ANN_CHUNK_CANDIDATES,
+    ANN_NPROBE,
     DEFAULT_SEMANTIC_CHUNK_SIZE,
     DEFAULT_CHUNK_OVERLAP,
     SCORE_PRECISION,
     load_movies,
-    open_json_file,
-    semantic_chunk,
+    top_k,
 )
 
+# embedding cache parameters of the chunk embeddings, see embedding_key
+CHUNK_EMBEDDING_PARAMS = f"semantic_chunk:{DEFAULT_SEMANTIC_CHUNK_SIZE}:{DEFAULT_CHUNK_OVERLAP}"
+CHUNK_METADATA_PATH = 'cache/chunk_metadata.bin'
+
 
 class ChunkedSemanticSearch(SemanticSearch):
-    def __init__(self, model_name = "all-MiniLM-L6-v2") -> None:
-        super().__init__(model_name)
+    def __init__(self, model_name = "all-MiniLM-L6-v2", device = "auto", backend = "torch", workers = 1) -> None:
+        super().__init__(model_name, device, backend, workers)
         self.chunk_embeddings = None
         self.chunk_metadata = None
         self.embeddings = None
         self.documents = None
         self.document_map = {}
-    
-    def __cosine_similarity_score__(self, query_embedding, chunk_embedding):
-        dot_product = np.dot(query_embedding, chunk_embedding)
-        magnitude_query = np.linalg.norm(query_embedding)
-        magnitude_chunk = np.linalg.norm(chunk_embedding)
-
-        if (magnitude_chunk == 0 or magnitude_query == 0):
-            return 0
-
-        return dot_product / (magnitude_query * magnitude_chunk)
+        # per movie group: doc id and its [start, end) rows in chunk_embeddings
+        self.group_doc_ids = None
+        self.group_starts = None
+        self.group_ends = None
+        # movie group of each row
+        self.row_group = None
+
+    def __index_chunks__(self):
+        # Index the ChunkMetadata once per load. Rows are in chunk_idx order
+        # with the chunks of a movie contiguous, so the movie groups are the
+        # doc chunk offsets and per-movie scores are a single np.maximum.reduceat
+        metadata = self.chunk_metadata
+        if self.chunk_embeddings is not None:
+            self.chunk_embeddings = normalize_embeddings(self.chunk_embeddings)
+        groups = np.flatnonzero(metadata.doc_chunk_counts > 0)
+        self.group_doc_ids = np.asarray(metadata.doc_ids[groups])
+        self.group_starts = np.asarray(metadata.doc_chunk_offsets[groups])
+        self.group_ends = np.asarray(metadata.doc_chunk_offsets[groups + 1])
+        self.row_group = np.repeat(np.arange(len(groups)), self.group_ends - self.group_starts)
 
     def __populate_docs_and_doc_map__(self, documents):
         self.documents = documents
@@ -39,85 +58,162 @@ class ChunkedSemanticSearch(SemanticSearch):
             self.document_map[doc['id']] = doc
             movies.append(f"{doc['title']}: {doc['description']}")
 
-    def build_chunk_embeddings(self, documents):
-        self.__populate_docs_and_doc_map__(documents)
-
-        chunks: List[str] = []
-        chunk_metadata = []
-
-        chunk_idx = 0
-        for doc_index, doc in enumerate(documents):
-            if doc is None:
-                continue
-            sentence_chunks = semantic_chunk(doc['description'], DEFAULT_SEMANTIC_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP)
-
-            for chunk in sentence_chunks:
-                chunks.append(chunk)
-                data = { 'movie_idx': doc_index + 1, 'chunk_idx': chunk_idx, 'total_chunks': len(sentence_chunks) }
-                chunk_metadata.append(data)
+    # Chunks and their metadata follow from the doc ids and descriptions alone
+    def __chunks_digest__(self, documents):
+        descriptions = (f"{doc['id']}\0{doc['description']}" for doc in documents if doc is not None)
+        return documents_digest(self.model_name, CHUNK_EMBEDDING_PARAMS, descriptions)
 
-                chunk_idx += 1
-
-        self.chunk_embeddings = self.model.encode(chunks, show_progress_bar=True, device='cuda', batch_size=256)
-        self.chunk_metadata = chunk_metadata
-
-        with open('cache/chunk_embeddings.npy', 'wb') as file:
-            np.save(file, self.chunk_embeddings)
-        
-        with open("cache/chunk_metadata.json", "w", encoding="utf-8") as file:
-            json.dump({"chunks": chunk_metadata, "total_chunks": len(chunks)}, file, indent=2)
+    def build_chunk_embeddings(self, documents, chunk_workers=0):
+        # Streamed: descriptions are chunked on chunk_workers processes while
+        # batches are encoded, see embed_document_chunks. Only new or edited
+        # chunks are encoded, the rest come from the cache, and an interrupted
+        # build resumes where it stopped
+        self.__populate_docs_and_doc_map__(documents)
 
+        start = time.perf_counter()
+        encoded, resumed = embed_document_chunks(
+            'cache/chunk_embeddings.npy',
+            CHUNK_METADATA_PATH,
+            self.model_name,
+            CHUNK_EMBEDDING_PARAMS,
+            [(doc['id'], doc['description']) for doc in documents if doc is not None],
+            DEFAULT_SEMANTIC_CHUNK_SIZE,
+            DEFAULT_CHUNK_OVERLAP,
+            self.encoder.encode,
+            self.__chunks_digest__(documents),
+            chunk_workers,
+        )
+        seconds = time.perf_counter() - start
+        self.chunk_embeddings = np.load('cache/chunk_embeddings.npy')
+        self.chunk_metadata = ChunkMetadata.load(CHUNK_METADATA_PATH)
+        total = len(self.chunk_metadata)
+        print(f"Encoded {encoded} of {total} chunks, reused {total - encoded - resumed} cached embeddings, resumed {resumed}")
+        if encoded:
+            print(f"Encoder {self.encoder}: {encoded / max(seconds, 1e-9):.1f} chunks/sec")
+
+        self.__index_chunks__()
         return self.chunk_embeddings
         
-    def load_or_create_chunk_embeddings(self, documents: list[dict]) -> np.ndarray:
+    def load_or_create_chunk_embeddings(self, documents: list[dict], chunk_workers=0) -> np.ndarray:
         self.__populate_docs_and_doc_map__(documents)
 
-        if os.path.isfile('cache/chunk_embeddings.npy'):
-            with open('cache/chunk_embeddings.npy', 'rb') as file:
-                self.chunk_embeddings = np.load(file)
-
-        if os.path.isfile('cache/chunk_metadata.json'):
-            self.chunk_metadata = open_json_file('cache/chunk_metadata.json')
+        # the cache is used as is only when it was built from exactly these descriptions
+        with stage("embeddings.load"):
+            self.chunk_embeddings = load_cached_embeddings('cache/chunk_embeddings.npy', self.__chunks_digest__(documents))
+            if self.chunk_embeddings is not None and os.path.isfile(CHUNK_METADATA_PATH):
+                self.chunk_metadata = ChunkMetadata.load(CHUNK_METADATA_PATH)
 
-        if ((self.chunk_embeddings is None or len(self.chunk_embeddings) <= 0)
-            or (self.chunk_metadata is None or len(self.chunk_metadata) <= 0)):
-            return self.build_chunk_embeddings(documents)
+        if self.chunk_embeddings is None or self.chunk_metadata is None or len(self.chunk_metadata) != len(self.chunk_embeddings):
+            return self.build_chunk_embeddings(documents, chunk_workers)
         else:
+            self.__index_chunks__()
             return self.chunk_embeddings
         
     def search_chunks(self, query: str, limit: int = 10):
-        query_embedding = self.generate_embedding(query)
-        chunk_score: dict = []
-        movie_score: Dict[int, float] = {}
-        movie_data = load_movies()
-        chunk_embeddings = self.load_or_create_chunk_embeddings(movie_data)
-        chunk_by_idx = {c["chunk_idx"]: c for c in self.chunk_metadata["chunks"]}
-        
-        for i, chunk_embedding in enumerate(chunk_embeddings):
-            score = self.__cosine_similarity_score__(chunk_embedding, query_embedding)
-            movie_idx = chunk_by_idx.get(i)['movie_idx']
-            chunk_score.append({ "chunk_idx": i, "movie_idx": movie_idx, "score": score})
-
-            # if movie score doesn't exist or score higher than stored, upsert with new chunk score
-            if movie_score.get(movie_idx) is None or movie_score.get(movie_idx) < score:
-                movie_score[movie_idx] = score
-
-        chunk_by_movie = {c["movie_idx"]: c for c in self.chunk_metadata["chunks"]}
-        movie_score = sorted(movie_score.items(), key = lambda k: k[1], reverse=True)
-        top_movies: dict = []
-        for ms in movie_score[:limit]:
-            doc = self.document_map.get(ms[0])
-            metadata = chunk_by_movie.get(ms[0])
+        matches = self.__match_movies__(query, limit)
+        with stage("chunked.materialize"):
+            return self.__top_movies(matches)
+
+    def __top_movies(self, matches):
+        top_movies: list = []
+        for group, best_row, score in matches:
+            start, end = self.group_starts[group], self.group_ends[group]
+            doc = self.document_map.get(int(self.group_doc_ids[group]))
+            if doc is None:
+                continue
             top_movies.append({ 
                 "id": doc['id'], 
                 "title": doc['title'], 
                 "document": doc['description'][:100], 
-                "score": round(ms[1], SCORE_PRECISION), 
-                "metadata": metadata or {} 
+                "score": round(score, SCORE_PRECISION), 
+                "metadata": {
+                    "chunk_idx": int(best_row),
+                    "total_chunks": int(end - start),
+                    "sentences": self.chunk_metadata.chunk_sentences[best_row].tolist(),
+                }
             })
 
         return top_movies
 
+    # Best movies as (doc ids, scores) arrays, best first, for rank fusion
+    def movie_scores(self, query: str, limit: int = 10):
+        doc_ids, scores = [], []
+        for group, _, score in self.__match_movies__(query, limit):
+            doc_id = int(self.group_doc_ids[group])
+            if doc_id not in self.document_map:
+                continue
+            doc_ids.append(doc_id)
+            scores.append(score)
+        return np.array(doc_ids, dtype=np.int64), np.array(scores, dtype=np.float64)
+
+    # (movie group, best chunk row, score) of the best movies, best first
+    def __match_movies__(self, query, limit):
+        # loaded once, warm queries do no disk I/O
+        if (self.chunk_embeddings is None and self.quantized is None) or self.row_group is None:
+            self.load_or_create_chunk_embeddings(load_movies())
+        if len(self.row_group) == 0:
+            return []
+
+        query_embedding = normalize_embeddings(self.generate_embedding(query))
+        with stage("chunked.score"):
+            return self.__score_movies(query_embedding, limit)
+
+    def __score_movies(self, query_embedding, limit):
+        if self.quantized is not None or self.ann_index is not None:
+            # candidate chunks come best first, so a group's first row is its best chunk
+            if self.quantized is not None:
+                # codes are stored in chunk_idx order, the row order
+                rows, chunk_scores = self.quantized.search(query_embedding, limit * ANN_CHUNK_CANDIDATES, self.rerank_embeddings)
+            else:
+                rows, chunk_scores = self.ann_index.search(query_embedding, limit * ANN_CHUNK_CANDIDATES)
+            count("chunked.chunks_scored", len(rows))
+            groups, first = np.unique(self.row_group[rows], return_index=True)
+            top = top_k(chunk_scores[first], limit)
+            return list(zip(groups[top].tolist(), rows[first][top].tolist(), chunk_scores[first][top].tolist()))
+        else:
+            count("chunked.chunks_scored", len(self.row_group))
+            chunk_scores = self.chunk_embeddings @ query_embedding
+            # a movie scores as its best chunk
+            movie_scores = np.maximum.reduceat(chunk_scores, self.group_starts)
+            matches = []
+            for group in top_k(movie_scores, limit).tolist():
+                start, end = self.group_starts[group], self.group_ends[group]
+                best_row = start + int(np.argmax(chunk_scores[start:end]))
+                matches.append((group, best_row, float(movie_scores[group])))
+            return matches
+
+    # Same as SemanticSearch.load_or_create_quantized_embeddings, over the chunk
+    # embeddings. Codes keep the chunk_idx order of the float32 cache
+    def load_or_create_quantized_chunk_embeddings(self, documents, mode, rerank=True, rebuild=False):
+        self.__populate_docs_and_doc_map__(documents)
+
+        path = f'cache/chunk_embeddings.{mode}.npz'
+        self.quantized = None
+        if not cached_embeddings_current('cache/chunk_embeddings.npy', self.__chunks_digest__(documents)):
+            # refreshing the cache also drops the codes built from the old matrix
+            self.load_or_create_chunk_embeddings(documents)
+        if os.path.isfile(path) and os.path.isfile(CHUNK_METADATA_PATH) and not rebuild:
+            self.quantized = QuantizedEmbeddings.load(path)
+            self.chunk_metadata = ChunkMetadata.load(CHUNK_METADATA_PATH)
+        if (self.quantized is None or self.quantized.mode != mode
+            or len(self.quantized) != len(self.chunk_metadata)):
+            self.load_or_create_chunk_embeddings(documents)
+            self.quantized = QuantizedEmbeddings.encode(self.chunk_embeddings, mode)
+            self.quantized.save(path)
+
+        # the float32 matrix is only read through the memory map from here on
+        self.chunk_embeddings = None
+        self.__index_chunks__()
+        self.rerank_embeddings = np.load('cache/chunk_embeddings.npy', mmap_mode='r') if rerank else None
+        return self.quantized
+
+    # Same as SemanticSearch.load_or_create_ann_index, over the chunk embeddings
+    def load_or_create_ann_index(self, nlist=None, nprobe=ANN_NPROBE, rebuild=False):
+        if self.chunk_embeddings is None or self.row_group is None:
+            raise ValueError("Chunk embeddings must be loaded before building the ANN index.")
+        self.ann_index = load_or_create_ivf_index('cache/chunk_embeddings.ivf.npz', self.chunk_embeddings, nlist, nprobe, rebuild)
+        return self.ann_index
+
 #         {
 #   "id": doc_id,
 #   "title": title,
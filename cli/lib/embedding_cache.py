@@ -0,0 +1,125 @@
+import glob
+import hashlib
+import json
+import os
+import numpy as np
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Embedding caches are a .npy matrix plus a manifest (same path, .manifest.json)
+# holding one content key per row. A key hashes (model, chunking parameters,
+# text), so an edited text gets a new key and its old row is dropped as an orphan
+EMBEDDING_MANIFEST_VERSION = 1
+
+
+def _manifest_path(path: str) -> str:
+    return f"{os.path.splitext(path)[0]}.manifest.json"
+
+
+def embedding_key(model_name: str, params: str, text: str) -> str:
+    return hashlib.sha256(f"{model_name}\0{params}\0{text}".encode("utf-8")).hexdigest()
+
+
+# Digest of a whole ordered input, lets a load skip per-row validation when nothing changed
+def documents_digest(model_name: str, params: str, texts: Iterable[str]) -> str:
+    digest = hashlib.sha256(f"{model_name}\0{params}".encode("utf-8"))
+    for text in texts:
+        digest.update(b"\0")
+        digest.update(text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _read_manifest(path: str) -> Optional[Dict]:
+    manifest_path = _manifest_path(path)
+    if not os.path.isfile(manifest_path) or not os.path.isfile(path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as file:
+        manifest = json.load(file)
+    if manifest.get("version") != EMBEDDING_MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+# Whether the cache was written for this digest, only reads the manifest
+def cached_embeddings_current(path: str, digest: str) -> bool:
+    manifest = _read_manifest(path)
+    return manifest is not None and manifest["digest"] == digest
+
+
+# The cached matrix when its manifest was written for this digest, else None
+def load_cached_embeddings(path: str, digest: str) -> Optional[np.ndarray]:
+    manifest = _read_manifest(path)
+    if manifest is None or manifest["digest"] != digest:
+        return None
+    with open(path, "rb") as file:
+        embeddings = np.load(file)
+    if len(embeddings) != len(manifest["keys"]):
+        return None
+    return embeddings
+
+
+# (cached matrix, key to row) of the cache at path, memory-mapped so only reused rows are read
+def cached_rows(path: str) -> Tuple[Optional[np.ndarray], Dict[str, int]]:
+    manifest = _read_manifest(path)
+    if manifest is None:
+        return None, {}
+    cached = np.load(path, mmap_mode="r")
+    if len(cached) != len(manifest["keys"]):
+        return cached, {}
+    return cached, {key: row for row, key in enumerate(manifest["keys"])}
+
+
+def update_cached_embeddings(
+    path: str,
+    model_name: str,
+    params: str,
+    texts: List[str],
+    encode: Callable[[List[str]], np.ndarray],
+    digest: str,
+) -> Tuple[np.ndarray, int]:
+    # Rows for texts, reusing cached rows by key and encoding only new or changed
+    # texts in one call. Rows of keys no longer wanted are dropped. Returns the
+    # matrix and the number of texts encoded
+    keys = [embedding_key(model_name, params, text) for text in texts]
+    cached, rows = cached_rows(path)
+
+    missing = [i for i, key in enumerate(keys) if key not in rows]
+    encoded = encode([texts[i] for i in missing]) if missing else None
+    dim = encoded.shape[1] if encoded is not None else (cached.shape[1] if cached is not None else 0)
+    dtype = encoded.dtype if encoded is not None else (cached.dtype if cached is not None else np.float32)
+
+    embeddings = np.empty((len(texts), dim), dtype=dtype)
+    reused = [i for i, key in enumerate(keys) if key in rows]
+    if reused:
+        embeddings[reused] = cached[[rows[keys[i]] for i in reused]]
+    if missing:
+        embeddings[missing] = encoded
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        np.save(file, embeddings)
+    commit_cached_embeddings(path, tmp_path, model_name, params, digest, keys)
+    return embeddings, len(missing)
+
+
+# Drop the manifest so the cache at path no longer counts as current
+def invalidate_cached_embeddings(path: str) -> None:
+    if os.path.isfile(_manifest_path(path)):
+        os.remove(_manifest_path(path))
+
+
+def commit_cached_embeddings(path: str, new_path: str, model_name: str, params: str, digest: str, keys: List[str]) -> None:
+    # Replace the cache at path with the finished matrix at new_path, keyed by keys.
+    # The manifest goes first: a crash between the two writes leaves no manifest,
+    # which re-encodes everything, rather than keys that do not match the rows
+    invalidate_cached_embeddings(path)
+    os.replace(new_path, path)
+    with open(f"{_manifest_path(path)}.tmp", "w", encoding="utf-8") as file:
+        json.dump({"version": EMBEDDING_MANIFEST_VERSION, "model": model_name, "params": params, "digest": digest, "keys": keys}, file)
+    os.replace(f"{_manifest_path(path)}.tmp", _manifest_path(path))
+    _drop_derived(path)
+
+
+# ANN indexes and quantized codes built from the old matrix (<stem>.*.npz) are stale now
+def _drop_derived(path: str) -> None:
+    for derived in glob.glob(f"{glob.escape(os.path.splitext(path)[0])}.*.npz"):
+        os.remove(derived)
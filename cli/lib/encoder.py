@@ -0,0 +1,92 @@
+import os
+import time
+import numpy as np
+from lib.search_utils import ENCODE_BATCH_SIZE
+from typing import List, Optional
+
+# torch: the model as loaded. int8: Linear layers dynamically quantized to int8,
+# CPU only. onnx: sentence-transformers' ONNX Runtime backend, needs optimum[onnxruntime]
+ENCODER_BACKENDS = ("torch", "int8", "onnx")
+
+
+# "auto" picks cuda, then mps, then cpu
+def select_device(device: str = "auto") -> str:
+    if device != "auto":
+        return device
+    import torch
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+class Encoder:
+    # Sentence-transformers model behind a configurable backend. Texts are encoded
+    # in length order so batches hold similar lengths and waste little padding,
+    # optionally spread over a pool of worker processes
+    def __init__(self, model_name: str, device: str = "auto", backend: str = "torch", workers: int = 1, batch_size: int = ENCODE_BATCH_SIZE) -> None:
+        if backend not in ENCODER_BACKENDS:
+            raise ValueError(f"Unknown encoder backend {backend}, expected one of {', '.join(ENCODER_BACKENDS)}")
+        self.model_name = model_name
+        self.device = select_device(device)
+        self.backend = backend
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.batch_size = batch_size
+        # texts per second of the last encode call
+        self.throughput = 0.0
+
+        # imported here: sentence-transformers pulls in torch, seconds of startup
+        # that commands which never encode should not pay
+        from sentence_transformers import SentenceTransformer
+        if backend == "onnx":
+            self.model = SentenceTransformer(model_name, device=self.device, backend="onnx")
+        else:
+            self.model = SentenceTransformer(model_name, device=self.device)
+        if backend == "int8":
+            if self.device != "cpu":
+                raise ValueError("The int8 encoder backend runs on cpu only.")
+            import torch
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    def __str__(self) -> str:
+        workers = f", {self.workers} workers" if self.workers > 1 else ""
+        return f"{self.model_name} ({self.backend} on {self.device}{workers})"
+
+    def encode(self, texts: List[str], show_progress_bar: bool = False) -> np.ndarray:
+        start = time.perf_counter()
+        order = np.argsort([len(text) for text in texts], kind="stable")
+        ordered = [texts[i] for i in order.tolist()]
+        # a pool only pays for its start-up with a few batches per worker
+        if self.workers > 1 and len(texts) >= self.batch_size * self.workers:
+            pool = self.model.start_multi_process_pool([self.device] * self.workers)
+            try:
+                encoded = self.model.encode(ordered, pool=pool, batch_size=self.batch_size, show_progress_bar=show_progress_bar)
+            finally:
+                self.model.stop_multi_process_pool(pool)
+        else:
+            encoded = self.model.encode(ordered, batch_size=self.batch_size, show_progress_bar=show_progress_bar)
+
+        embeddings = np.empty_like(encoded)
+        embeddings[order] = encoded
+        self.throughput = len(texts) / max(time.perf_counter() - start, 1e-9)
+        return embeddings
+
+
+def benchmark_encoder(texts: List[str], model_name: str, device: str, backends: List[str], workers: Optional[List[int]] = None, batch_size: int = ENCODE_BATCH_SIZE) -> List[dict]:
+    # chunks/sec of every backend and worker count over the same texts
+    report = []
+    for backend in backends:
+        for worker_count in workers or [1]:
+            encoder = Encoder(model_name, device, backend, worker_count, batch_size)
+            encoder.encode(texts[:batch_size])  # warm-up
+            start = time.perf_counter()
+            encoder.encode(texts)
+            seconds = time.perf_counter() - start
+            report.append({
+                "encoder": str(encoder),
+                "texts": len(texts),
+                "seconds": seconds,
+                "chunks_per_sec": len(texts) / max(seconds, 1e-9),
+            })
+    return report
@@ -1,26 +1,200 @@
+import asyncio
 import os
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
-from .keyword_search import InvertedIndex
-from .semantic_search import ChunkedSemanticSearch
+from lib.chunked_semantic_search import ChunkedSemanticSearch
+from lib.inverted_index import InvertedIndex
+from lib.profiling import count, stage
+from lib.search_utils import (
+    HYBRID_ALPHA,
+    HYBRID_CANDIDATE_FACTOR,
+    HYBRID_LEG_THREADS,
+    RRF_K,
+    SCORE_PRECISION,
+    min_max_normalize,
+    tokenize,
+    top_k,
+)
+
+HYBRID_METHODS = ("weighted", "rrf")
+LEGS = ("bm25", "semantic")
+_EMPTY_LEG = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64))
 
 
 class HybridSearch:
-    def __init__(self, documents):
+    # semantic_search and index may be passed in already loaded, to share them
+    # with other searchers in the same process
+    def __init__(self, documents, semantic_search=None, index=None):
         self.documents = documents
-        self.semantic_search = ChunkedSemanticSearch()
-        self.semantic_search.load_or_create_chunk_embeddings(documents)
+        self.document_map = {doc['id']: doc for doc in documents}
+        self.semantic_search = semantic_search
+        if self.semantic_search is None:
+            self.semantic_search = ChunkedSemanticSearch()
+            self.semantic_search.load_or_create_chunk_embeddings(documents)
 
-        self.idx = InvertedIndex()
-        if not os.path.exists(self.idx.index_path):
-            self.idx.build()
-            self.idx.save()
+        # loaded once per instance, every query reuses the mapped index
+        self.idx = index
+        if self.idx is None:
+            self.idx = InvertedIndex()
+            if not os.path.exists(self.idx.index_path):
+                self.idx.build()
+            else:
+                self.idx.load()
+        # the two retrieval legs run side by side. Spare threads so a leg that
+        # timed out and is still running does not hold up the next query
+        self.__executor = ThreadPoolExecutor(max_workers=HYBRID_LEG_THREADS)
 
+    # Best BM25 matches as (doc ids, scores) arrays, best first
     def _bm25_search(self, query, limit):
-        self.idx.load()
-        return self.idx.bm25_search(query, limit)
+        with stage("bm25.tokenize"):
+            tokens = tokenize(query)
+        with stage("bm25.score"):
+            return self.idx.bm25_top_k(tokens, limit)
+
+    # Best chunked-semantic matches as (doc ids, scores) arrays, best first
+    def _semantic_search(self, query, limit):
+        return self.semantic_search.movie_scores(query, limit)
+
+    def __legs(self, query, limit):
+        # Both legs over-fetch, so a document one leg ranks low can still win on the other
+        candidates = limit * HYBRID_CANDIDATE_FACTOR
+        return {
+            "bm25": (self._bm25_search, query, candidates),
+            "semantic": (self._semantic_search, query, candidates),
+        }
+
+    @staticmethod
+    def __timed(leg, *args):
+        start = time.perf_counter()
+        result = leg(*args)
+        return result, (time.perf_counter() - start) * 1000
+
+    # Run both legs side by side. A leg that does not finish within its timeout
+    # (seconds, None waits) is dropped, so a slow semantic leg degrades the query
+    # to keyword-only results. The leg keeps running in its thread, its result is unused
+    def __run_legs(self, query, limit, timeouts):
+        futures = {
+            name: self.__executor.submit(self.__timed, *leg)
+            for name, leg in self.__legs(query, limit).items()
+        }
+        finished = {}
+        started = time.monotonic()
+        for name, future in futures.items():
+            timeout = timeouts.get(name)
+            try:
+                remaining = None if timeout is None else max(started + timeout - time.monotonic(), 0)
+                finished[name] = future.result(remaining)
+            except TimeoutError:
+                pass
+        return finished
+
+    async def __arun_legs(self, query, limit, timeouts):
+        loop = asyncio.get_running_loop()
+        legs = self.__legs(query, limit)
+        runs = [
+            asyncio.wait_for(loop.run_in_executor(self.__executor, self.__timed, *leg), timeouts.get(name))
+            for name, leg in legs.items()
+        ]
+        outcomes = await asyncio.gather(*runs, return_exceptions=True)
+        finished = {}
+        for name, outcome in zip(legs, outcomes):
+            if isinstance(outcome, TimeoutError):
+                continue
+            if isinstance(outcome, BaseException):
+                raise outcome
+            finished[name] = outcome
+        return finished
+
+    def __candidates(self, finished):
+        # Union of the finished legs' candidate doc ids (sorted) and each leg's
+        # scores and 1-based ranks over it, NaN / 0 where a leg missed the doc
+        legs = [finished[name][0] if name in finished else _EMPTY_LEG for name in LEGS]
+        doc_ids = np.union1d(legs[0][0], legs[1][0])
+        scores = np.full((2, len(doc_ids)), np.nan)
+        ranks = np.zeros((2, len(doc_ids)), dtype=np.int64)
+        for leg, (leg_ids, leg_scores) in enumerate(legs):
+            positions = np.searchsorted(doc_ids, leg_ids)
+            scores[leg, positions] = leg_scores
+            ranks[leg, positions] = np.arange(1, len(leg_ids) + 1)
+        return doc_ids, scores, ranks
+
+    def __results(self, doc_ids, fused, scores, ranks, limit):
+        with stage("hybrid.materialize"):
+            return self.__materialize(doc_ids, fused, scores, ranks, limit)
+
+    def __materialize(self, doc_ids, fused, scores, ranks, limit):
+        results = []
+        for pos in top_k(fused, limit).tolist():
+            doc = self.document_map.get(int(doc_ids[pos]))
+            if doc is None:
+                continue
+            bm25_score, semantic_score = scores[:, pos].tolist()
+            results.append({
+                "id": doc['id'],
+                "title": doc['title'],
+                "document": doc['description'][:100],
+                "score": round(float(fused[pos]), SCORE_PRECISION),
+                "bm25_score": None if np.isnan(bm25_score) else round(bm25_score, SCORE_PRECISION),
+                "semantic_score": None if np.isnan(semantic_score) else round(semantic_score, SCORE_PRECISION),
+                "bm25_rank": int(ranks[0, pos]) or None,
+                "semantic_rank": int(ranks[1, pos]) or None,
+            })
+        return results
+
+    def __fuse(self, finished, method, limit, alpha, k):
+        count("hybrid.legs_timed_out", len(LEGS) - len(finished))
+        if not finished:
+            raise TimeoutError("Both hybrid search legs timed out.")
+        with stage("hybrid.fuse"):
+            doc_ids, fused, scores, ranks = self.__fused_scores(finished, method, alpha, k)
+        return {
+            "results": self.__results(doc_ids, fused, scores, ranks, limit),
+            "timed_out": [name for name in LEGS if name not in finished],
+            "leg_ms": {name: round(finished[name][1], 3) for name in LEGS if name in finished},
+        }
+
+    def __fused_scores(self, finished, method, alpha, k):
+        doc_ids, scores, ranks = self.__candidates(finished)
+        if method == "weighted":
+            # alpha * min-max normalized BM25 + (1 - alpha) * min-max normalized
+            # semantic score, a leg that missed a document contributes 0
+            normalized = np.zeros_like(scores)
+            for leg in range(2):
+                found = ~np.isnan(scores[leg])
+                normalized[leg, found] = min_max_normalize(scores[leg, found])
+            fused = alpha * normalized[0] + (1 - alpha) * normalized[1]
+        else:
+            # reciprocal rank fusion: sum over legs of 1 / (k + rank), a leg that
+            # missed a document contributes 0
+            fused = np.where(ranks > 0, 1.0 / (k + ranks), 0.0).sum(axis=0)
+        return doc_ids, fused, scores, ranks
+
+    # Checked before the legs run, so a bad request costs no search
+    @staticmethod
+    def __check_params(method, alpha, k):
+        if method not in HYBRID_METHODS:
+            raise ValueError(f"Unknown hybrid search method {method}, expected weighted or rrf")
+        if method == "weighted" and not 0 <= alpha <= 1:
+            raise ValueError("alpha must be between 0 and 1")
+        if method == "rrf" and k <= 0:
+            raise ValueError("k must be positive")
+
+    # Fused results plus the legs that timed out and each finished leg's latency
+    def search(self, query, method="rrf", limit=5, alpha=HYBRID_ALPHA, k=RRF_K, bm25_timeout=None, semantic_timeout=None):
+        self.__check_params(method, alpha, k)
+        timeouts = {"bm25": bm25_timeout, "semantic": semantic_timeout}
+        return self.__fuse(self.__run_legs(query, limit, timeouts), method, limit, alpha, k)
+
+    # Same as search, awaitable: the legs run in the thread pool while the event loop stays free
+    async def asearch(self, query, method="rrf", limit=5, alpha=HYBRID_ALPHA, k=RRF_K, bm25_timeout=None, semantic_timeout=None):
+        self.__check_params(method, alpha, k)
+        timeouts = {"bm25": bm25_timeout, "semantic": semantic_timeout}
+        return self.__fuse(await self.__arun_legs(query, limit, timeouts), method, limit, alpha, k)
 
-    def weighted_search(self, query, alpha, limit=5):
-        raise NotImplementedError("Weighted hybrid search is not implemented yet.")
+    def weighted_search(self, query, alpha=HYBRID_ALPHA, limit=5, bm25_timeout=None, semantic_timeout=None):
+        return self.search(query, "weighted", limit, alpha=alpha, bm25_timeout=bm25_timeout, semantic_timeout=semantic_timeout)["results"]
 
-    def rrf_search(self, query, k, limit=10):
-        raise NotImplementedError("RRF hybrid search is not implemented yet.")
\ No newline at end of file
+    def rrf_search(self, query, k=RRF_K, limit=10, bm25_timeout=None, semantic_timeout=None):
+        return self.search(query, "rrf", limit, k=k, bm25_timeout=bm25_timeout, semantic_timeout=semantic_timeout)["results"]
@@ -0,0 +1,116 @@
+import json
+import os
+import struct
+import numpy as np
+from typing import Dict, List, Tuple
+
+# Binary index file layout (little endian):
+#   magic (8 bytes) | version (uint32) | header length (uint32) | JSON header
+#   followed by the raw section arrays, each aligned to SECTION_ALIGNMENT bytes.
+# The JSON header maps each section name to its offset, dtype and shape, plus
+# free-form "meta" values (counts, corpus statistics).
+INDEX_MAGIC = b"RSEIDX\x00\x00"
+INDEX_FORMAT_VERSION = 1
+SECTION_ALIGNMENT = 64
+
+_PREAMBLE = struct.Struct("<8sII")
+
+
+def _aligned(offset: int) -> int:
+    return (offset + SECTION_ALIGNMENT - 1) // SECTION_ALIGNMENT * SECTION_ALIGNMENT
+
+
+def write_index_file(path: str, sections: Dict[str, np.ndarray], meta: Dict) -> None:
+    # Two passes: lay out the header until its size is stable, then write sections.
+    # Written to a temp file and renamed so readers that still map the old file keep working.
+    arrays = {name: np.ascontiguousarray(array) for name, array in sections.items()}
+    layout: Dict[str, Dict] = {}
+    header_bytes = b""
+    while True:
+        offset = _aligned(_PREAMBLE.size + len(header_bytes))
+        for name, array in arrays.items():
+            layout[name] = {"offset": offset, "dtype": array.dtype.str, "shape": list(array.shape)}
+            offset = _aligned(offset + array.nbytes)
+        new_header = json.dumps({"sections": layout, "meta": meta}).encode("utf-8")
+        # the layout above assumed the previous header's length, it is only
+        # valid for new_header when the lengths agree
+        stable = len(new_header) == len(header_bytes)
+        header_bytes = new_header
+        if stable:
+            break
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as handle:
+        handle.write(_PREAMBLE.pack(INDEX_MAGIC, INDEX_FORMAT_VERSION, len(header_bytes)))
+        handle.write(header_bytes)
+        for name, array in arrays.items():
+            handle.seek(layout[name]["offset"])
+            handle.write(array.tobytes())
+        handle.truncate(max(handle.tell(), _aligned(_PREAMBLE.size + len(header_bytes))))
+    os.replace(tmp_path, path)
+
+
+def read_index_file(path: str) -> Tuple[Dict[str, np.ndarray], Dict]:
+    # Map the file read-only; sections are zero-copy views, so only the pages a
+    # query touches are read and processes mapping the same file share the page cache
+    raw = np.memmap(path, dtype=np.uint8, mode="r")
+    magic, version, header_length = _PREAMBLE.unpack(bytes(raw[:_PREAMBLE.size]))
+    if magic != INDEX_MAGIC:
+        raise ValueError(f"{path} is not an index file")
+    if version != INDEX_FORMAT_VERSION:
+        raise ValueError(f"{path} has index format version {version}, expected {INDEX_FORMAT_VERSION}")
+    header = json.loads(bytes(raw[_PREAMBLE.size:_PREAMBLE.size + header_length]).decode("utf-8"))
+
+    sections: Dict[str, np.ndarray] = {}
+    for name, section in header["sections"].items():
+        dtype = np.dtype(section["dtype"])
+        count = int(np.prod(section["shape"], dtype=np.int64))
+        start = section["offset"]
+        view = raw[start:start + count * dtype.itemsize].view(dtype)
+        sections[name] = view.reshape(section["shape"])
+    return sections, header["meta"]
+
+
+class DocStore:
+    # Read-only doc_id -> text mapping over a utf-8 blob with per-doc offsets,
+    # so document text can live in the mapped index file instead of a dict
+    def __init__(self, doc_ids: np.ndarray, offsets: np.ndarray, blob: np.ndarray) -> None:
+        self.doc_ids = doc_ids
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def from_texts(cls, doc_ids: np.ndarray, texts: List[str]) -> "DocStore":
+        encoded = [text.encode("utf-8") for text in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(doc_ids, offsets, blob)
+
+    def text(self, ordinal: int) -> str:
+        return bytes(self.blob[self.offsets[ordinal]:self.offsets[ordinal + 1]]).decode("utf-8")
+
+    def __ordinal(self, doc_id) -> int:
+        ordinal = int(np.searchsorted(self.doc_ids, doc_id))
+        if ordinal >= len(self.doc_ids) or self.doc_ids[ordinal] != doc_id:
+            return -1
+        return ordinal
+
+    def __getitem__(self, doc_id) -> str:
+        ordinal = self.__ordinal(doc_id)
+        if ordinal < 0:
+            raise KeyError(doc_id)
+        return self.text(ordinal)
+
+    def get(self, doc_id, default=None):
+        ordinal = self.__ordinal(doc_id)
+        return default if ordinal < 0 else self.text(ordinal)
+
+    def __contains__(self, doc_id) -> bool:
+        return self.__ordinal(doc_id) >= 0
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __iter__(self):
+        return iter(self.doc_ids.tolist())
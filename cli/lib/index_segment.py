@@ -0,0 +1,547 @@
+import numpy as np
+from collections import Counter
+from itertools import repeat
+from lib.index_format import DocStore, read_index_file, write_index_file
+from lib.search_utils import bm25_idf
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+# relative slack on pruning comparisons, partial scores are summed in a
+# different order than the final ones and may differ in the last bits
+PRUNE_SLACK = 1e-9
+# cost of looking a candidate up in a posting list, in postings scored in full
+PROBE_COST = 4
+# queries with fewer postings than this in a segment are scored in full, the
+# bookkeeping of pruning would cost more than it saves
+PRUNE_MIN_POSTINGS = 4096
+# doc stride of the (doc, position) keys phrase matching intersects
+PHRASE_KEY_STRIDE = 1 << 32
+
+
+class PartialIndex(NamedTuple):
+    # Postings for one batch of documents, with terms numbered locally to the batch
+    doc_ids: List[int]
+    doc_lengths: List[int]
+    terms: List[str]
+    term_ids: np.ndarray
+    posting_doc_ids: np.ndarray
+    tfs: np.ndarray
+    # word positions of each posting, ascending, one run of tf positions per
+    # posting in posting order. None for an index without positions
+    positions: Optional[np.ndarray] = None
+
+
+def partial_index(doc_ids: List[int], term_counts: Iterable[Counter], doc_lengths: List[int], term_positions: Optional[Iterable[Dict[str, List[int]]]] = None) -> PartialIndex:
+    lexicon: Dict[str, int] = {}
+    term_ids: List[int] = []
+    posting_doc_ids: List[int] = []
+    tfs: List[int] = []
+    positions: List[int] = []
+    for doc_id, term_freq, doc_positions in zip(doc_ids, term_counts, term_positions or repeat(None)):
+        for token, tf in term_freq.items():
+            term_ids.append(lexicon.setdefault(token, len(lexicon)))
+            posting_doc_ids.append(doc_id)
+            tfs.append(tf)
+            if doc_positions is not None:
+                positions.extend(doc_positions[token])
+    return PartialIndex(
+        doc_ids,
+        doc_lengths,
+        list(lexicon),
+        np.array(term_ids, dtype=np.int64),
+        np.array(posting_doc_ids, dtype=np.int64),
+        np.array(tfs, dtype=np.int32),
+        None if term_positions is None else np.array(positions, dtype=np.int64),
+    )
+
+
+class IndexSegment:
+    # One immutable block of packed postings (see InvertedIndex) plus a mutable
+    # mask of deleted docs. A full build produces a single segment, upserts add
+    # small delta segments next to it
+    def __init__(self) -> None:
+        # sorted utf-8 term lexicon, a term's id is its position in the lexicon
+        self.lexicon = np.zeros(0, dtype="S1")
+        # postings of term id t live in [postings_offsets[t], postings_offsets[t + 1])
+        self.postings_offsets = np.zeros(1, dtype=np.int64)
+        # doc ordinals (positions in doc_ids), sorted by doc id within each posting list
+        self.postings_docs = np.zeros(0, dtype=np.int32)
+        # term frequency of the term in the matching doc
+        self.postings_tfs = np.zeros(0, dtype=np.int32)
+        # doc ordinal to doc_id, sorted ascending
+        self.doc_ids = np.zeros(0, dtype=np.int64)
+        # doc ordinal to doc length
+        self.doc_lengths = np.zeros(0, dtype=np.int32)
+        # doc_id to doc text
+        self.docmap = DocStore.from_texts(self.doc_ids, [])
+        # doc ordinal to True once the doc is deleted or replaced, None while nothing is
+        self.deleted: Optional[np.ndarray] = None
+        # term id to BM25 IDF and doc ordinal to length norm, computed for this
+        # segment alone and for the average doc length in norms_avg_doc_length
+        self.idf = np.zeros(0, dtype=np.float64)
+        self.length_norms = np.zeros(0, dtype=np.float64)
+        self.norms_avg_doc_length = 0.0
+        # term id to the largest tf and the shortest doc length in its posting
+        # list, the inputs of the term's BM25 upper bound for dynamic pruning
+        self.term_max_tfs = np.zeros(0, dtype=np.int32)
+        self.term_min_doc_lengths = np.zeros(0, dtype=np.int32)
+        # optional positional postings: one run of tf positions per posting in
+        # posting order, delta-encoded (first absolute, then gaps) in the smallest
+        # unsigned dtype that fits. The runs of term id t start at
+        # position_offsets[t], a posting's run start follows from the tfs before it
+        self.position_offsets: Optional[np.ndarray] = None
+        self.positions: Optional[np.ndarray] = None
+        self.meta: Dict = {}
+
+    @classmethod
+    def pack(cls, terms, term_ids, posting_doc_ids, tfs, doc_ids, doc_lengths, texts, positions=None) -> "IndexSegment":
+        # Pack flat (term id, doc_id, tf) postings into contiguous arrays: terms
+        # renumbered in lexicon order, postings grouped by term id and sorted by
+        # doc id inside each group, docs numbered by ascending doc id. Position
+        # runs, if given, follow their postings
+        segment = cls()
+        doc_order = np.argsort(doc_ids, kind="stable")
+        segment.doc_ids = doc_ids[doc_order]
+        segment.doc_lengths = doc_lengths[doc_order]
+        segment.docmap = DocStore.from_texts(segment.doc_ids, [texts[i] for i in doc_order.tolist()])
+
+        term_order = sorted(range(len(terms)), key=terms.__getitem__)
+        term_rank = np.empty(len(terms), dtype=np.int64)
+        term_rank[term_order] = np.arange(len(terms))
+        segment.lexicon = np.array([terms[i].encode("utf-8") for i in term_order], dtype="S")
+
+        term_ids = term_rank[term_ids]
+        doc_ords = np.searchsorted(segment.doc_ids, posting_doc_ids)
+        order = np.lexsort((doc_ords, term_ids))
+        segment.postings_docs = doc_ords[order].astype(np.int32)
+        segment.postings_tfs = tfs[order].astype(np.int32)
+        counts = np.bincount(term_ids, minlength=len(terms))
+        segment.postings_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(counts, out=segment.postings_offsets[1:])
+        segment.compute_term_bounds()
+        if positions is not None:
+            segment.positions = _encode_positions(positions, tfs, order)
+            run_ends = np.zeros(len(order) + 1, dtype=np.int64)
+            np.cumsum(segment.postings_tfs, out=run_ends[1:])
+            segment.position_offsets = run_ends[segment.postings_offsets]
+        return segment
+
+    @classmethod
+    def load(cls, path: str) -> "IndexSegment":
+        # memory-map the segment file, nothing is read until a query touches it
+        sections, meta = read_index_file(path)
+        segment = cls()
+        segment.lexicon = sections["lexicon"]
+        segment.postings_offsets = sections["postings_offsets"]
+        segment.postings_docs = sections["postings_docs"]
+        segment.postings_tfs = sections["postings_tfs"]
+        segment.doc_ids = sections["doc_ids"]
+        segment.doc_lengths = sections["doc_lengths"]
+        segment.docmap = DocStore(segment.doc_ids, sections["doc_offsets"], sections["doc_text"])
+        segment.idf = sections["idf"]
+        segment.length_norms = sections["length_norms"]
+        segment.norms_avg_doc_length = meta["avg_doc_length"]
+        segment.meta = meta
+        if "term_max_tfs" in sections:
+            segment.term_max_tfs = sections["term_max_tfs"]
+            segment.term_min_doc_lengths = sections["term_min_doc_lengths"]
+        else:
+            # written before the bounds were stored
+            segment.compute_term_bounds()
+        segment.position_offsets = sections.get("position_offsets")
+        segment.positions = sections.get("positions")
+        return segment
+
+    def save(self, path: str) -> None:
+        sections = {
+            "lexicon": self.lexicon,
+            "postings_offsets": self.postings_offsets,
+            "postings_docs": self.postings_docs,
+            "postings_tfs": self.postings_tfs,
+            "doc_ids": self.doc_ids,
+            "doc_lengths": self.doc_lengths,
+            "idf": self.idf,
+            "length_norms": self.length_norms,
+            "term_max_tfs": self.term_max_tfs,
+            "term_min_doc_lengths": self.term_min_doc_lengths,
+            "doc_offsets": self.docmap.offsets,
+            "doc_text": self.docmap.blob,
+        }
+        if self.positions is not None:
+            sections["position_offsets"] = self.position_offsets
+            sections["positions"] = self.positions
+        write_index_file(path, sections, self.meta)
+
+    # Statistics of this segment on its own. They are the corpus statistics
+    # while it is the only segment and nothing in it is deleted
+    def compute_stats(self, b: float) -> Dict:
+        avg_doc_length = self.doc_lengths.sum(dtype=np.int64) / self.doc_count if self.doc_count > 0 else 0.0
+        self.idf = bm25_idf(self.doc_count, np.diff(self.postings_offsets))
+        self.norms_avg_doc_length = -1.0
+        self.norms(float(avg_doc_length), b)
+        self.meta = {"doc_count": self.doc_count, "avg_doc_length": float(avg_doc_length), "bm25_b": b}
+        return self.meta
+
+    def compute_term_bounds(self) -> None:
+        counts = np.diff(self.postings_offsets)
+        self.term_max_tfs = np.zeros(self.term_count, dtype=np.int32)
+        self.term_min_doc_lengths = np.zeros(self.term_count, dtype=np.int32)
+        nonempty = counts > 0
+        if not nonempty.any():
+            return
+        starts = self.postings_offsets[:-1][nonempty]
+        self.term_max_tfs[nonempty] = np.maximum.reduceat(self.postings_tfs, starts)
+        self.term_min_doc_lengths[nonempty] = np.minimum.reduceat(self.doc_lengths[self.postings_docs], starts)
+
+    @property
+    def doc_count(self) -> int:
+        return len(self.doc_ids)
+
+    @property
+    def term_count(self) -> int:
+        return len(self.lexicon)
+
+    # Term id of a term, -1 if the term is not indexed
+    def term_id(self, term: str) -> int:
+        key = term.encode("utf-8")
+        pos = int(np.searchsorted(self.lexicon, key))
+        if pos < len(self.lexicon) and self.lexicon[pos] == key:
+            return pos
+        return -1
+
+    def term_postings(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = self.postings_offsets[term_id], self.postings_offsets[term_id + 1]
+        return self.postings_docs[start:end], self.postings_tfs[start:end]
+
+    # Absolute positions of the postings at the given places in a term's posting
+    # list, and for each position the index of its posting in `list_positions`
+    def posting_positions(self, term_id: int, list_positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        if self.positions is None:
+            raise ValueError("This index was built without positions.")
+        _, tfs = self.term_postings(term_id)
+        run_starts = np.zeros(len(tfs), dtype=np.int64)
+        np.cumsum(tfs[:-1], out=run_starts[1:])
+        return self.__decode_runs(self.position_offsets[term_id] + run_starts[list_positions], tfs[list_positions])
+
+    def __decode_runs(self, starts: np.ndarray, lengths: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        lengths = lengths.astype(np.int64)
+        run_offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=run_offsets[1:])
+        gather = np.repeat(starts - run_offsets[:-1], lengths) + np.arange(run_offsets[-1])
+        values = np.cumsum(self.positions[gather], dtype=np.int64)
+        # the running sum carries over from earlier runs, every run holds at least one position
+        carry = values[run_offsets[:-1]] - self.positions[starts].astype(np.int64)
+        values -= np.repeat(carry, lengths)
+        return values, np.repeat(np.arange(len(starts)), lengths)
+
+    # Positions of a term in one doc, empty if the doc does not contain it
+    def term_positions(self, term_id: int, ordinal: int) -> np.ndarray:
+        docs, _ = self.term_postings(term_id)
+        pos = int(np.searchsorted(docs, ordinal))
+        if pos >= len(docs) or docs[pos] != ordinal:
+            return np.zeros(0, dtype=np.int64)
+        return self.posting_positions(term_id, np.array([pos]))[0]
+
+    # Sorted doc ordinals containing the phrase, given as term ids and their word
+    # offsets in the phrase. Docs are intersected from the rarest term up, then
+    # (doc, position - offset) keys of each term over the remaining docs, again
+    # rarest first, so a match needs every term at its offset from a common start
+    def phrase_docs(self, term_ids: List[int], offsets: List[int]) -> np.ndarray:
+        if any(term_id < 0 for term_id in term_ids):
+            return np.zeros(0, dtype=np.int64)
+        rarest_first = sorted(range(len(term_ids)), key=lambda i: self.postings_offsets[term_ids[i] + 1] - self.postings_offsets[term_ids[i]])
+        docs = None
+        for i in rarest_first:
+            term_docs, _ = self.term_postings(term_ids[i])
+            docs = term_docs if docs is None else np.intersect1d(docs, term_docs, assume_unique=True)
+            if len(docs) == 0:
+                return np.zeros(0, dtype=np.int64)
+
+        keys = None
+        bias = max(offsets)
+        for i in rarest_first:
+            term_docs, _ = self.term_postings(term_ids[i])
+            values, runs = self.posting_positions(term_ids[i], np.searchsorted(term_docs, docs))
+            term_keys = runs * PHRASE_KEY_STRIDE + (values - offsets[i] + bias)
+            keys = term_keys if keys is None else np.intersect1d(keys, term_keys, assume_unique=True)
+            if len(keys) == 0:
+                return np.zeros(0, dtype=np.int64)
+        return docs[np.unique(keys // PHRASE_KEY_STRIDE)].astype(np.int64)
+
+    # Doc ordinal of a live doc_id, -1 if absent or deleted
+    def doc_ordinal(self, doc_id: int) -> int:
+        ordinal = int(np.searchsorted(self.doc_ids, doc_id))
+        if ordinal >= len(self.doc_ids) or self.doc_ids[ordinal] != doc_id:
+            return -1
+        if self.deleted is not None and self.deleted[ordinal]:
+            return -1
+        return ordinal
+
+    # Mark docs as deleted, returns the doc ids that were live here
+    def delete(self, doc_ids: Iterable[int]) -> List[int]:
+        removed = []
+        for doc_id in doc_ids:
+            ordinal = self.doc_ordinal(doc_id)
+            if ordinal < 0:
+                continue
+            if self.deleted is None:
+                self.deleted = np.zeros(self.doc_count, dtype=bool)
+            self.deleted[ordinal] = True
+            removed.append(doc_id)
+        return removed
+
+    def deleted_doc_ids(self) -> List[int]:
+        if self.deleted is None:
+            return []
+        return self.doc_ids[self.deleted].tolist()
+
+    def live_doc_count(self) -> int:
+        if self.deleted is None:
+            return self.doc_count
+        return self.doc_count - int(self.deleted.sum())
+
+    def live_length_sum(self) -> int:
+        if self.deleted is None:
+            return int(self.doc_lengths.sum(dtype=np.int64))
+        return int(self.doc_lengths[~self.deleted].sum(dtype=np.int64))
+
+    def live_df(self, term_id: int) -> int:
+        docs, _ = self.term_postings(term_id)
+        if self.deleted is None:
+            return len(docs)
+        return int(np.count_nonzero(~self.deleted[docs]))
+
+    # Document frequency of every term id over the live docs
+    def live_dfs(self) -> np.ndarray:
+        counts = np.diff(self.postings_offsets)
+        if self.deleted is None:
+            return counts
+        live = np.zeros(len(self.postings_docs) + 1, dtype=np.int64)
+        np.cumsum(~self.deleted[self.postings_docs], out=live[1:])
+        return live[self.postings_offsets[1:]] - live[self.postings_offsets[:-1]]
+
+    # Length norms (1 - b + b * doc_length / avg_doc_length) for the given corpus average
+    def norms(self, avg_doc_length: float, b: float) -> np.ndarray:
+        if avg_doc_length != self.norms_avg_doc_length or len(self.length_norms) != self.doc_count:
+            self.length_norms = length_norms(self.doc_lengths, avg_doc_length, b)
+            self.norms_avg_doc_length = avg_doc_length
+        return self.length_norms
+
+    # Scores of the live docs this segment matches for weighted query terms
+    # [(term id, idf)] in query order, as (doc ordinals, scores, postings scored).
+    # Every posting list is scored in full
+    def exhaustive_scores(self, terms: List[Tuple[int, float]], k1: float, norms: np.ndarray) -> Tuple[np.ndarray, np.ndarray, int]:
+        scores = np.zeros(self.doc_count, dtype=np.float64)
+        scored = 0
+        for term_id, idf in terms:
+            docs, tfs = self.term_postings(term_id)
+            scores[docs] += bm25_term_scores(idf, tfs, norms[docs], k1)
+            scored += len(docs)
+        if self.deleted is not None:
+            scores[self.deleted] = 0.0
+        matched = np.flatnonzero(scores)
+        return matched, scores[matched], scored
+
+    # Same docs and scores as exhaustive_scores for every doc that can reach the
+    # best `limit`, others are left out (MaxScore). Terms are scored in full in
+    # decreasing order of their upper bound until the remaining terms together
+    # cannot lift an unseen doc to the current limit-th best score. Those
+    # non-essential lists are then only probed for the surviving candidates, and
+    # the candidates rescored term by term in query order so the sums match
+    # exhaustive_scores bit for bit
+    def maxscore_scores(self, terms: List[Tuple[int, float]], limit: int, k1: float, norms: np.ndarray, avg_doc_length: float, b: float) -> Tuple[np.ndarray, np.ndarray, int]:
+        if not terms or limit <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64), 0
+        term_ids = np.array([term_id for term_id, _ in terms], dtype=np.int64)
+        lengths = self.postings_offsets[term_ids + 1] - self.postings_offsets[term_ids]
+        if len(terms) == 1 or lengths.sum() < PRUNE_MIN_POSTINGS:
+            return self.exhaustive_scores(terms, k1, norms)
+        idfs = np.array([idf for _, idf in terms], dtype=np.float64)
+        upper_bounds = bm25_term_scores(
+            idfs,
+            self.term_max_tfs[term_ids],
+            length_norms(self.term_min_doc_lengths[term_ids], avg_doc_length, b),
+            k1,
+        )
+        order = np.argsort(-upper_bounds, kind="stable")
+        # remaining[i]: the most the terms order[i:] can add to any doc
+        remaining = np.concatenate([np.cumsum(upper_bounds[order][::-1])[::-1], [0.0]])
+
+        scores = np.zeros(self.doc_count, dtype=np.float64)
+        scored = 0
+        threshold = 0.0
+        essential = len(order)
+        for i, t in enumerate(order.tolist()):
+            # unseen docs can score at most remaining[i], once that is below the
+            # limit-th best partial score only the docs seen so far can make it
+            if remaining[i] * (1 + PRUNE_SLACK) < threshold:
+                essential = i
+                break
+            docs, tfs = self.term_postings(int(term_ids[t]))
+            scores[docs] += bm25_term_scores(idfs[t], tfs, norms[docs], k1)
+            scored += len(docs)
+            # partial scores are lower bounds of the final ones, so the limit-th
+            # best of any set of live docs bounds the final limit-th best from below
+            if remaining[i + 1] < remaining[0] - remaining[i + 1]:
+                live_docs = docs if self.deleted is None else docs[~self.deleted[docs]]
+                threshold = max(threshold, _kth_largest(scores[live_docs], limit))
+
+        if self.deleted is not None:
+            scores[self.deleted] = 0.0
+        candidates = np.flatnonzero((scores > 0) & (scores + remaining[essential] >= threshold * (1 - PRUNE_SLACK)))
+        # each non-essential list raises the candidates' partial scores and the
+        # threshold, and drops the candidates the rest of the terms cannot save
+        for i in range(essential, len(order)):
+            t = order[i]
+            docs, tfs = self.term_postings(int(term_ids[t]))
+            if len(candidates) * PROBE_COST < len(docs):
+                hit, pos = _probe(docs, candidates)
+                scores[candidates[hit]] += bm25_term_scores(idfs[t], tfs[pos[hit]], norms[candidates[hit]], k1)
+                scored += len(candidates)
+            else:
+                # with this many candidates scoring the whole list is cheaper than looking them up
+                scores[docs] += bm25_term_scores(idfs[t], tfs, norms[docs], k1)
+                scored += len(docs)
+            partial = scores[candidates]
+            threshold = max(threshold, _kth_largest(partial, limit))
+            candidates = candidates[partial + remaining[i + 1] >= threshold * (1 - PRUNE_SLACK)]
+
+        exact = np.zeros(len(candidates), dtype=np.float64)
+        for term_id, idf in terms:
+            docs, tfs = self.term_postings(term_id)
+            hit, pos = _probe(docs, candidates)
+            exact[hit] += bm25_term_scores(idf, tfs[pos[hit]], norms[candidates[hit]], k1)
+        return candidates, exact, scored
+
+    # Live postings and texts of this segment, in the shape build workers produce
+    def to_partial(self) -> Tuple[List[str], PartialIndex]:
+        term_ids = np.repeat(np.arange(self.term_count), np.diff(self.postings_offsets))
+        docs = self.postings_docs
+        tfs = self.postings_tfs
+        live_ords = np.arange(self.doc_count)
+        if self.deleted is not None:
+            keep = ~self.deleted[docs]
+            term_ids, docs, tfs = term_ids[keep], docs[keep], tfs[keep]
+            live_ords = live_ords[~self.deleted]
+
+        # drop terms whose postings were all deleted and renumber the rest
+        used = np.flatnonzero(np.bincount(term_ids, minlength=self.term_count))
+        term_map = np.zeros(self.term_count, dtype=np.int64)
+        term_map[used] = np.arange(len(used))
+        terms = [term.decode("utf-8") for term in self.lexicon[used].tolist()]
+
+        positions = None
+        if self.positions is not None:
+            run_starts = np.zeros(len(self.postings_tfs), dtype=np.int64)
+            np.cumsum(self.postings_tfs[:-1], out=run_starts[1:])
+            run_lengths = self.postings_tfs
+            if self.deleted is not None:
+                live_postings = ~self.deleted[self.postings_docs]
+                run_starts, run_lengths = run_starts[live_postings], run_lengths[live_postings]
+            positions = self.__decode_runs(run_starts, run_lengths)[0]
+
+        texts = [self.docmap.text(ordinal) for ordinal in live_ords.tolist()]
+        partial = PartialIndex(
+            self.doc_ids[live_ords].tolist(),
+            self.doc_lengths[live_ords].tolist(),
+            terms,
+            term_map[term_ids],
+            self.doc_ids[docs],
+            np.asarray(tfs, dtype=np.int32),
+            positions,
+        )
+        return texts, partial
+
+
+class SegmentBuilder:
+    # Collects partial indexes and packs them into one segment
+    def __init__(self) -> None:
+        self.__lexicon: Dict[str, int] = {}
+        self.__terms: List[np.ndarray] = []
+        self.__docs: List[np.ndarray] = []
+        self.__tfs: List[np.ndarray] = []
+        # position runs of every partial, None once a partial comes without positions
+        self.__positions: Optional[List[np.ndarray]] = []
+        self.__lengths: Dict[int, int] = {}
+        self.__texts: Dict[int, str] = {}
+
+    def add_partial(self, texts: Iterable[str], partial: PartialIndex) -> None:
+        for doc_id, text, doc_length in zip(partial.doc_ids, texts, partial.doc_lengths):
+            self.__texts[doc_id] = text
+            self.__lengths[doc_id] = doc_length
+
+        # Renumber the partial's terms into the segment lexicon
+        lexicon = self.__lexicon
+        term_map = np.array([lexicon.setdefault(term, len(lexicon)) for term in partial.terms], dtype=np.int64)
+        self.__terms.append(term_map[partial.term_ids])
+        self.__docs.append(partial.posting_doc_ids)
+        self.__tfs.append(partial.tfs)
+        if self.__positions is not None and partial.positions is not None:
+            self.__positions.append(partial.positions)
+        else:
+            self.__positions = None
+
+    def finish(self) -> IndexSegment:
+        doc_ids = list(self.__lengths)
+        return IndexSegment.pack(
+            list(self.__lexicon),
+            np.concatenate([np.zeros(0, dtype=np.int64)] + self.__terms),
+            np.concatenate([np.zeros(0, dtype=np.int64)] + self.__docs),
+            np.concatenate([np.zeros(0, dtype=np.int32)] + self.__tfs),
+            np.array(doc_ids, dtype=np.int64),
+            np.array([self.__lengths[doc_id] for doc_id in doc_ids], dtype=np.int32),
+            [self.__texts[doc_id] for doc_id in doc_ids],
+            None if self.__positions is None else np.concatenate([np.zeros(0, dtype=np.int64)] + self.__positions),
+        )
+
+
+# (lexicon, dfs) of the union of several indexes, df summed over the indexes that have the term
+def merge_document_frequencies(lexicons: List[np.ndarray], dfs: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    lexicon, terms = np.unique(np.concatenate(lexicons), return_inverse=True)
+    merged = np.bincount(terms, weights=np.concatenate(dfs), minlength=len(lexicon))
+    return lexicon, merged.astype(np.int64)
+
+
+def length_norms(doc_lengths: np.ndarray, avg_doc_length: float, b: float) -> np.ndarray:
+    if avg_doc_length <= 0:
+        return np.ones(len(doc_lengths), dtype=np.float64)
+    return 1 - b + b * (doc_lengths / avg_doc_length)
+
+
+# BM25 contribution of one term: idf * tf * (k1 + 1) / (tf + k1 * length norm)
+def bm25_term_scores(idf, tfs: np.ndarray, norms: np.ndarray, k1: float) -> np.ndarray:
+    tfs = tfs.astype(np.float64)
+    return idf * (tfs * (k1 + 1)) / (tfs + k1 * norms)
+
+
+# The k-th largest score, 0 when fewer than k docs score above 0
+def _kth_largest(scores: np.ndarray, k: int) -> float:
+    if k > len(scores):
+        return 0.0
+    return float(np.partition(scores, len(scores) - k)[len(scores) - k])
+
+
+# (mask of the sorted doc ordinals found in the posting docs, their positions there)
+def _probe(docs: np.ndarray, ordinals: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    if len(docs) == 0:
+        return np.zeros(len(ordinals), dtype=bool), np.zeros(len(ordinals), dtype=np.int64)
+    pos = np.searchsorted(docs, ordinals)
+    pos[pos == len(docs)] = 0
+    return docs[pos] == ordinals, pos
+
+
+# Reorder position runs (one of tfs[j] positions per posting j) into posting
+# order and delta-encode each run
+def _encode_positions(positions: np.ndarray, tfs: np.ndarray, order: np.ndarray) -> np.ndarray:
+    run_starts = np.zeros(len(tfs) + 1, dtype=np.int64)
+    np.cumsum(tfs, out=run_starts[1:])
+    lengths = tfs[order].astype(np.int64)
+    offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    gather = np.repeat(run_starts[:-1][order] - offsets[:-1], lengths) + np.arange(offsets[-1])
+    ordered = positions[gather]
+    deltas = np.diff(ordered, prepend=0)
+    firsts = offsets[:-1][lengths > 0]
+    deltas[firsts] = ordered[firsts]
+    largest = int(deltas.max()) if len(deltas) else 0
+    dtype = next(t for t in (np.uint8, np.uint16, np.uint32, np.uint64) if largest <= np.iinfo(t).max)
+    return deltas.astype(dtype)
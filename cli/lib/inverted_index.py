@@ -1,60 +1,145 @@
 import json
-import math
 import os
 import pickle
-from collections import Counter
+import threading
+import time
+import numpy as np
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import batched
+from lib.index_segment import IndexSegment, PartialIndex, SegmentBuilder, merge_document_frequencies, partial_index
+from lib.profiling import count, stage
 from lib.search_utils import *
-from typing import List, Dict
+from typing import Iterable, Iterator, List, Dict, NamedTuple, Optional, Tuple
 
 CACHE_DIR = 'cache'
+SEGMENTS_DIR = 'segments'
+# delta segments allowed before an upsert starts a background merge
+MAX_DELTA_SEGMENTS = 8
+
+
+# Tokenize and index one batch of (doc_id, text) pairs, runs inside build workers
+def _index_batch(batch: Tuple[Tuple[int, str], ...], positions: bool = False) -> PartialIndex:
+    tokenizer = get_tokenizer()
+    if not positions:
+        tokenized = tokenizer.tokenize_many(text for _, text in batch)
+        return partial_index(
+            [doc_id for doc_id, _ in batch],
+            [Counter(tokens) for tokens in tokenized],
+            [len(tokens) for tokens in tokenized],
+        )
+
+    term_positions = []
+    for _, text in batch:
+        doc_positions: Dict[str, List[int]] = {}
+        for token, position in zip(*tokenizer.tokenize_with_positions(text)):
+            doc_positions.setdefault(token, []).append(position)
+        term_positions.append(doc_positions)
+    return partial_index(
+        [doc_id for doc_id, _ in batch],
+        [Counter({token: len(p) for token, p in doc_positions.items()}) for doc_positions in term_positions],
+        [sum(len(p) for p in doc_positions.values()) for doc_positions in term_positions],
+        term_positions,
+    )
+
+
+# Index batches in order, in-process or across a process pool. At most two
+# batches per worker are in flight, so memory is bounded by the batch size
+def _index_batches(batches: Iterable[Tuple], workers: int, positions: bool = False) -> Iterator[Tuple[Tuple, PartialIndex]]:
+    if workers <= 1:
+        for batch in batches:
+            yield batch, _index_batch(batch, positions)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for batch in batches:
+            in_flight.append((batch, executor.submit(_index_batch, batch, positions)))
+            if len(in_flight) >= workers * 2:
+                batch, future = in_flight.popleft()
+                yield batch, future.result()
+        while in_flight:
+            batch, future = in_flight.popleft()
+            yield batch, future.result()
+
+
+class CorpusStats(NamedTuple):
+    # BM25 statistics of a larger corpus this index is part of, so a shard
+    # scores its docs exactly as the unsharded index would
+    avg_doc_length: float
+    # BM25 IDF of every query token over the whole corpus
+    idfs: Dict[str, float]
+
 
 class InvertedIndex:
-    def __init__(self) -> None:
-        # token to doc_id
-        self.index: Dict[str, set] = {}
-        # doc_id to doc text
-        self.docmap: Dict[int, str] = {}
-        # doc_id to token frequencies
-        self.term_frequencies: Dict[int, Counter] = {}
-        # doc_id to doc length
-        self.doc_lengths: Dict[int, int] = {}
-        self.index_path = os.path.join(CACHE_DIR, "index.pkl")
-        self.docmap_path = os.path.join(CACHE_DIR, "docmap.pkl")
-        self.term_frequencies_path = os.path.join(CACHE_DIR, "term_frequencies.pkl")
-        self.doc_lengths_path = os.path.join(CACHE_DIR, "doc_lengths.pkl")
-
-    # Add a document to the index
-    def __add_document(self, doc_id: int, text: str) -> None:
-        # Tokenize text, then add each token to index with document ID
-        # Add full text to docmap by doc_id
-        self.docmap[doc_id] = text
-
-        # tokenize
-        tokens = tokenize(text)
-
-        # Store document length
-        self.doc_lengths[doc_id] = len(tokens)
-
-        # Add tokens to index
-        # Also build term frequencies
-        term_freq = Counter()
-        
-        for token in tokens:
-            self.index[token].add(doc_id)
-            term_freq[token] += 1
-        self.term_frequencies[doc_id] = term_freq
-
-    def __get_avg_doc_length(self) -> float:
-        # Calculate the average document length across all documents
-        doc_count = len(self.doc_lengths)
-        if doc_count <= 0: 
-            return 0.0
-        doc_length_sum = 0
-        for doc_id in self.doc_lengths:
-            doc_length_sum += self.doc_lengths[doc_id]
-        # print (f"Total Document Length Sum: {doc_length_sum}, Document Count: {doc_count}")
-        # Return full precision average document length (avoid premature rounding)
-        return doc_length_sum / doc_count
+    def __init__(self, cache_dir: str = CACHE_DIR) -> None:
+        self.cache_dir = cache_dir
+        # segments[0] is the base index written by build() or a merge, later
+        # segments are small deltas written by upserts (see lib/index_segment.py)
+        self.segments: List[IndexSegment] = []
+        # segment file of each segment, relative to cache_dir
+        self.segment_files: List[str] = []
+        # corpus statistics over the live docs of all segments, kept current by __compute_stats
+        self.doc_count: int = 0
+        self.avg_doc_length: float = 0.0
+        # term to BM25 IDF over all segments, filled on demand and cleared when docs change
+        self.__idf_cache: Dict[str, float] = {}
+        self.__next_segment = 1
+        self.__lock = threading.RLock()
+        # doc ids deleted or replaced while a merge runs, None when no merge is running
+        self.__merge_log: Optional[List[int]] = None
+        self.__merge_thread: Optional[threading.Thread] = None
+        self.index_path = os.path.join(self.cache_dir, "index.bin")
+        # lists the live segment files and the doc ids deleted from each
+        self.manifest_path = os.path.join(self.cache_dir, SEGMENTS_DIR, "manifest.json")
+        # pickle cache written by earlier versions, read only by convert_pickle_cache
+        self.pickle_index_path = os.path.join(self.cache_dir, "index.pkl")
+        self.pickle_docmap_path = os.path.join(self.cache_dir, "docmap.pkl")
+        self.pickle_term_frequencies_path = os.path.join(self.cache_dir, "term_frequencies.pkl")
+        self.pickle_doc_lengths_path = os.path.join(self.cache_dir, "doc_lengths.pkl")
+
+    def __compute_stats(self) -> None:
+        # Compute N and average document length over the live docs once, so a
+        # query only has to walk its posting lists
+        self.__idf_cache = {}
+        if self.__single_segment():
+            base = self.segments[0]
+            self.doc_count = base.doc_count
+            self.avg_doc_length = base.meta["avg_doc_length"]
+            return
+        self.doc_count = sum(segment.live_doc_count() for segment in self.segments)
+        length_sum = sum(segment.live_length_sum() for segment in self.segments)
+        self.avg_doc_length = float(length_sum / self.doc_count) if self.doc_count > 0 else 0.0
+
+    # True while the base index is all there is, so its precomputed statistics apply
+    def __single_segment(self) -> bool:
+        return len(self.segments) == 1 and self.segments[0].deleted is None
+
+    # BM25 IDF of a term over the live docs of all segments
+    def __idf(self, term: str) -> float:
+        if self.__single_segment():
+            base = self.segments[0]
+            term_id = base.term_id(term)
+            return float(base.idf[term_id]) if term_id >= 0 else float(bm25_idf(self.doc_count, 0))
+
+        idf = self.__idf_cache.get(term)
+        if idf is None:
+            df = 0
+            for segment in self.segments:
+                term_id = segment.term_id(term)
+                if term_id >= 0:
+                    df += segment.live_df(term_id)
+            idf = float(bm25_idf(self.doc_count, df))
+            self.__idf_cache[term] = idf
+        return idf
+
+    # Segment and doc ordinal holding the live version of a doc_id
+    def __locate(self, doc_id: int) -> Tuple[IndexSegment, int]:
+        for segment in reversed(self.segments):
+            ordinal = segment.doc_ordinal(doc_id)
+            if ordinal >= 0:
+                return segment, ordinal
+        raise KeyError(doc_id)
 
     def bm25(self, doc_id, term) -> float:
         tf = self.get_bm25_tf(doc_id, term)
@@ -63,113 +148,424 @@ class InvertedIndex:
         # print(f"BM25 Score: {bm25_score}")
         return bm25_score
 
-    def bm25_search(self, query, limit):
-        tokens = tokenize(query)
-        # map doc_id to BM25 score
-        scores: Dict[int, float] = {}
-        for token in tokens:
-            doc_ids = self.index[token]
-            for doc_id in doc_ids:
-                doc_score = self.bm25(doc_id, token)
-                if scores.get(doc_id) is None:
-                    scores[doc_id] = 0.00
-                scores[doc_id] += doc_score
-        scores = sorted(scores.items(), key = lambda k: k[1], reverse=True)
-        movie_dict = load_movie_data()
-        for score in scores[:limit]:
-            print(f"({score[0]}) {movie_dict[score[0]]} - Score: {score[1]:.2f}")
+    def bm25_top_k(self, tokens: List[str], limit: int, k1=BM25_K1, prune: bool = True, phrases=None, stats: Optional[CorpusStats] = None) -> Tuple[np.ndarray, np.ndarray]:
+        # Best `limit` live docs as (doc_ids, scores), best first. With prune the
+        # segments skip postings that cannot reach the top (MaxScore), the result
+        # is identical to scoring every posting list in full. phrases, as
+        # (tokens, word offsets), restrict the results to docs containing all of
+        # them. stats replace this index's own IDF and average doc length
+        doc_ids, scores, _ = self.__top_k(tokens, limit, k1, prune, phrases, stats)
+        return doc_ids, scores
+
+    def __top_k(self, tokens: List[str], limit: int, k1: float, prune: bool, phrases=None, stats: Optional[CorpusStats] = None) -> Tuple[np.ndarray, np.ndarray, int]:
+        # Per segment, then the segment winners merged. Also returns the number of postings scored
+        if phrases and not self.has_positions:
+            raise ValueError("Phrase queries need an index built with positions.")
+        avg_doc_length = self.avg_doc_length if stats is None else stats.avg_doc_length
+        idf = self.__idf if stats is None else stats.idfs.__getitem__
+        doc_ids = [np.zeros(0, dtype=np.int64)]
+        scores = [np.zeros(0, dtype=np.float64)]
+        scored = 0
+        for segment in self.segments:
+            norms = segment.norms(avg_doc_length, BM25_B)
+            terms = [(term_id, idf(token)) for token in tokens if (term_id := segment.term_id(token)) >= 0]
+            if phrases:
+                matched, matched_scores, segment_scored = segment.exhaustive_scores(terms, k1, norms)
+                for phrase_tokens, offsets in phrases:
+                    keep = np.isin(matched, segment.phrase_docs([segment.term_id(token) for token in phrase_tokens], offsets))
+                    matched, matched_scores = matched[keep], matched_scores[keep]
+            elif prune:
+                matched, matched_scores, segment_scored = segment.maxscore_scores(terms, limit, k1, norms, avg_doc_length, BM25_B)
+            else:
+                matched, matched_scores, segment_scored = segment.exhaustive_scores(terms, k1, norms)
+            top = top_k(matched_scores, limit)
+            doc_ids.append(segment.doc_ids[matched[top]])
+            scores.append(matched_scores[top])
+            scored += segment_scored
+
+        # ties go to the lower doc id, as within a segment
+        doc_ids = np.concatenate(doc_ids)
+        scores = np.concatenate(scores)
+        best = np.lexsort((doc_ids, -scores))[:limit]
+        count("bm25.postings_scored", scored)
+        return doc_ids[best], scores[best], scored
+
+    # Postings scored and time taken with and without pruning, per query
+    def pruning_report(self, queries: List[str], limit: int, k1=BM25_K1) -> List[Dict]:
+        report = []
+        for query in queries:
+            tokens = tokenize(query)
+            row = {"query": query}
+            results = {}
+            for name, prune in (("exhaustive", False), ("maxscore", True)):
+                start = time.perf_counter()
+                doc_ids, scores, scored = self.__top_k(tokens, limit, k1, prune)
+                row[f"{name}_ms"] = (time.perf_counter() - start) * 1000
+                row[f"{name}_postings"] = scored
+                results[name] = (doc_ids.tolist(), scores.tolist())
+            row["identical"] = results["exhaustive"] == results["maxscore"]
+            report.append(row)
+        return report
+
+    # Best matches as [{"id", "score"}], best first. "Quoted phrases" in the
+    # query must appear as such, with proximity the BM25 candidates are
+    # reranked by how close together the query terms occur
+    def bm25_search(self, query, limit, k1=BM25_K1, proximity: bool = False, window: int = PROXIMITY_WINDOW) -> List[Dict]:
+        with stage("bm25.tokenize"):
+            tokens, phrases = parse_query(query)
+        if proximity:
+            return self.proximity_search(tokens, phrases, limit, k1, window)
+        if not self.has_positions:
+            # without positions a quoted phrase scores as its words, as it did
+            # before phrase queries; only an explicit phrases= is an error
+            phrases = None
+        with stage("bm25.score"):
+            doc_ids, scores = self.bm25_top_k(tokens, limit, k1, phrases=phrases)
+        with stage("bm25.materialize"):
+            return [{"id": doc_id, "score": score} for doc_id, score in zip(doc_ids.tolist(), scores.tolist())]
+
+    def proximity_search(self, tokens: List[str], phrases, limit: int, k1=BM25_K1, window: int = PROXIMITY_WINDOW) -> List[Dict]:
+        # BM25 plus a term-pair proximity score (BM25TP): for every pair of
+        # distinct query terms, acc sums 1 / distance^2 over their occurrences
+        # at most `window` words apart, and the pair adds
+        # min(idf) * acc * (k1 + 1) / (acc + k1 * length norm).
+        # Reranks the best PROXIMITY_CANDIDATE_FACTOR * limit BM25 matches
+        if not self.has_positions:
+            raise ValueError("Proximity search needs an index built with positions.")
+        with stage("bm25.score"):
+            doc_ids, scores = self.bm25_top_k(tokens, limit * PROXIMITY_CANDIDATE_FACTOR, k1, phrases=phrases)
+        with stage("bm25.proximity"):
+            return self.__proximity_rerank(tokens, doc_ids, scores, limit, k1, window)
+
+    def __proximity_rerank(self, tokens, doc_ids, scores, limit, k1, window) -> List[Dict]:
+        distinct = list(dict.fromkeys(tokens))
+        idfs = [self.__idf(token) for token in distinct]
+        results = []
+        for doc_id, score in zip(doc_ids.tolist(), scores.tolist()):
+            segment, ordinal = self.__locate(doc_id)
+            positions = [segment.term_positions(term_id, ordinal) if (term_id := segment.term_id(token)) >= 0 else np.zeros(0, dtype=np.int64) for token in distinct]
+            length_norm = segment.norms(self.avg_doc_length, BM25_B)[ordinal]
+            for i in range(len(distinct)):
+                for j in range(i + 1, len(distinct)):
+                    if len(positions[i]) == 0 or len(positions[j]) == 0:
+                        continue
+                    distances = np.abs(np.subtract.outer(positions[i], positions[j]))
+                    near = distances[(distances > 0) & (distances <= window)]
+                    acc = float(np.sum(1.0 / near.astype(np.float64) ** 2))
+                    score += min(idfs[i], idfs[j]) * acc * (k1 + 1) / float(acc + k1 * length_norm)
+            results.append({"id": doc_id, "score": score})
+        results.sort(key=lambda result: (-result["score"], result["id"]))
+        return results[:limit]
+
+    # (utf-8 lexicon, document frequencies) over the live docs of all segments
+    def document_frequencies(self) -> Tuple[np.ndarray, np.ndarray]:
+        if len(self.segments) == 1:
+            return self.segments[0].lexicon, self.segments[0].live_dfs()
+        return merge_document_frequencies(
+            [segment.lexicon for segment in self.segments],
+            [segment.live_dfs() for segment in self.segments],
+        )
+
+    # Total length of the live docs
+    def live_length_sum(self) -> int:
+        return sum(segment.live_length_sum() for segment in self.segments)
+
+    # True when every segment stores token positions, needed for phrase and proximity search
+    @property
+    def has_positions(self) -> bool:
+        return bool(self.segments) and all(segment.positions is not None for segment in self.segments)
+
+    # Bytes of the postings, the positional postings and the document text across all segments
+    def memory_report(self) -> Dict:
+        postings_bytes = position_bytes = text_bytes = position_count = 0
+        dtypes = set()
+        for segment in self.segments:
+            postings_bytes += sum(array.nbytes for array in (
+                segment.lexicon, segment.postings_offsets, segment.postings_docs, segment.postings_tfs,
+                segment.doc_ids, segment.doc_lengths, segment.idf, segment.length_norms,
+                segment.term_max_tfs, segment.term_min_doc_lengths,
+            ))
+            text_bytes += segment.docmap.offsets.nbytes + segment.docmap.blob.nbytes
+            if segment.positions is not None:
+                position_bytes += segment.position_offsets.nbytes + segment.positions.nbytes
+                position_count += len(segment.positions)
+                dtypes.add(segment.positions.dtype.name)
+        return {
+            "postings_bytes": postings_bytes,
+            "position_bytes": position_bytes,
+            "document_text_bytes": text_bytes,
+            "positions": position_count,
+            "position_dtypes": sorted(dtypes),
+            "position_overhead": position_bytes / postings_bytes if postings_bytes else 0.0,
+        }
 
     # Get BM25 IDF for a given term
     def get_bm25_idf(self, term: str) -> float:
-        # log((N - df + 0.5) / (df + 0.5) + 1)
-        doc_count = len(self.docmap)
-        term_docs = self.get_documents(term)
-        df = len(term_docs)
-        idf = math.log((doc_count - df + 0.5) / (df + 0.5) + 1)
-        return idf
-    
+        return self.__idf(term.lower())
+
     def get_bm25_tf(self, doc_id, term, k1=BM25_K1, b = BM25_B):
-        doc_length = self.doc_lengths[doc_id]
-        avg_doc_length = self.__get_avg_doc_length()
         tf = self.get_tf(doc_id, term)
-        # Length normalization factor
-        length_norm = 1 - b + b * (doc_length / avg_doc_length)
+        segment, ordinal = self.__locate(doc_id)
+        # Length normalization factor, cached for the default b
+        if b == BM25_B:
+            length_norm = segment.norms(self.avg_doc_length, BM25_B)[ordinal]
+        else:
+            length_norm = 1 - b + b * (segment.doc_lengths[ordinal] / self.avg_doc_length)
         bm25_tf = (tf * (k1 + 1)) / (tf + k1 * length_norm)
-        
-        return bm25_tf
+
+        return float(bm25_tf)
 
     # Get list of document IDs for a given term
     def get_documents(self, term: str) -> List[int]:
-        # Set the document ID for a given token
-        # return as a list sorted in asc order
-        doc_id_list = self.index.get(term.lower())
-        if doc_id_list is None:
-            return []
-        return sorted(doc_id_list)
-    
+        # live doc ids of every segment, sorted asc
+        doc_ids = [np.zeros(0, dtype=np.int64)]
+        for segment in self.segments:
+            term_id = segment.term_id(term.lower())
+            if term_id < 0:
+                continue
+            docs, _ = segment.term_postings(term_id)
+            if segment.deleted is not None:
+                docs = docs[~segment.deleted[docs]]
+            doc_ids.append(segment.doc_ids[docs])
+        return np.sort(np.concatenate(doc_ids)).tolist()
+
     # Get term frequency for a given document ID and term
     def get_tf(self, doc_id, term) -> int:
         tokens = term.split()
         if len(tokens) > 1:
             raise ValueError("Only one word allowed for the parameter 'term'")
-        term_freq = self.term_frequencies[doc_id]
-        return term_freq[term]
-    
+        segment, ordinal = self.__locate(doc_id)
+        term_id = segment.term_id(term)
+        if term_id < 0:
+            return 0
+        docs, tfs = segment.term_postings(term_id)
+        pos = int(np.searchsorted(docs, ordinal))
+        if pos < len(docs) and docs[pos] == ordinal:
+            return int(tfs[pos])
+        return 0
+
     # Get inverse document frequency for a given term
     def get_idf(self, term) -> float:
         documents = self.get_documents(term)
-        idf = math.log((len(self.docmap) + 1) / (len(documents) + 1))
-        return idf
+        idf = np.log((self.doc_count + 1) / (len(documents) + 1))
+        return float(idf)
+
+    # Get the indexed text of a document
+    def get_text(self, doc_id: int) -> str:
+        segment, ordinal = self.__locate(doc_id)
+        return segment.docmap.text(ordinal)
+
+    def build(self, path: str = MOVIES_PATH, workers: int = 1, batch_size: int = BUILD_BATCH_SIZE, positions: bool = False, shard: Optional[Tuple[int, int]] = None) -> None:
+        # Stream movies in batches, tokenize each batch (across worker processes
+        # when workers > 1) into a partial index and merge the partial postings.
+        # With positions the index also stores every token's word position.
+        # shard, as (shard, shard count), indexes only the movies of that shard
+        builder = SegmentBuilder()
+        documents = ((int(m['id']), f"{m['title']} {m['description']}") for m in iter_movies(path))
+        if shard is not None:
+            documents = ((doc_id, text) for doc_id, text in documents if shard_of(doc_id, shard[1]) == shard[0])
+        for batch, partial in _index_batches(batched(documents, batch_size), workers, positions):
+            builder.add_partial((text for _, text in batch), partial)
+
+        self.__set_base(builder.finish())
+        self.save()
+
+    def __set_base(self, base: IndexSegment) -> None:
+        base.compute_stats(BM25_B)
+        self.segments = [base]
+        self.segment_files = [os.path.basename(self.index_path)]
+        self.__compute_stats()
+
+    # Insert new documents or replace existing ones with the same id
+    def upsert_documents(self, movies: Iterable[dict]) -> int:
+        # later entries for the same id win
+        if not self.segments:
+            raise ValueError("Build or load the index before upserting documents")
+        documents = {int(m['id']): f"{m['title']} {m['description']}" for m in movies}
+        if not documents:
+            return 0
+        builder = SegmentBuilder()
+        # delta segments keep positions when the index has them
+        builder.add_partial(documents.values(), _index_batch(tuple(documents.items()), self.has_positions))
+        segment = builder.finish()
+        segment.compute_stats(BM25_B)
+
+        with self.__lock:
+            segment_file = os.path.join(SEGMENTS_DIR, f"seg_{self.__next_segment:06d}.bin")
+            self.__next_segment += 1
+            os.makedirs(os.path.join(self.cache_dir, SEGMENTS_DIR), exist_ok=True)
+            # the new segment only becomes live once the manifest lists it
+            segment.save(os.path.join(self.cache_dir, segment_file))
+            self.__delete_live(documents)
+            self.segments = self.segments + [segment]
+            self.segment_files = self.segment_files + [segment_file]
+            self.__compute_stats()
+            self.__save_manifest()
+            print(f"Saved {segment_file} with {len(documents)} documents")
 
-    def build(self) -> None:
-        # Iterate over all movies and add them to both index and docmap
-        with open('data/movies.json', 'r') as file:
-            data = json.load(file)
-            #data = sorted(data['movies'], key=lambda k: k['id'])
+        if len(self.segments) - 1 >= MAX_DELTA_SEGMENTS:
+            self.merge_segments_in_background()
+        return len(documents)
 
-            for m in data['movies']:
-                concat = f"{m['title']} {m['description']}"
-                self.__add_document(int(m['id']), concat)
+    def delete_documents(self, doc_ids: Iterable[int]) -> int:
+        if not self.segments:
+            raise ValueError("Build or load the index before deleting documents")
+        with self.__lock:
+            removed = self.__delete_live(doc_ids)
+            self.__compute_stats()
+            self.__save_manifest()
+        return len(removed)
 
-            self.save()
+    def __delete_live(self, doc_ids: Iterable[int]) -> set:
+        doc_ids = list(doc_ids)
+        removed = set()
+        for segment in self.segments:
+            removed.update(segment.delete(doc_ids))
+        if self.__merge_log is not None:
+            self.__merge_log.extend(doc_ids)
+        return removed
+
+    # Fold the delta segments and deletions into a new base segment
+    def merge_segments(self) -> None:
+        with self.__lock:
+            if self.__merge_log is not None or len(self.segments) == 0:
+                return
+            segments = self.segments
+            segment_files = self.segment_files
+            merged_file = os.path.join(SEGMENTS_DIR, f"base_{self.__next_segment:06d}.bin")
+            self.__next_segment += 1
+            self.__merge_log = []
+
+        try:
+            builder = SegmentBuilder()
+            for segment in segments:
+                texts, partial = segment.to_partial()
+                builder.add_partial(texts, partial)
+            merged = builder.finish()
+            merged.compute_stats(BM25_B)
+            os.makedirs(os.path.join(self.cache_dir, SEGMENTS_DIR), exist_ok=True)
+            merged.save(os.path.join(self.cache_dir, merged_file))
+        except BaseException:
+            with self.__lock:
+                self.__merge_log = None
+            raise
+
+        with self.__lock:
+            # docs deleted or replaced while merging must not come back
+            merged.delete(self.__merge_log)
+            self.__merge_log = None
+            self.segments = [merged] + self.segments[len(segments):]
+            self.segment_files = [merged_file] + self.segment_files[len(segments):]
+            self.__compute_stats()
+            self.__save_manifest()
+            print(f"Merged {len(segments)} segments into {merged_file}")
+
+        # open mappings of the old files stay valid after unlinking
+        for segment_file in segment_files:
+            path = os.path.join(self.cache_dir, segment_file)
+            if path != self.index_path and os.path.exists(path):
+                os.remove(path)
+
+    def merge_segments_in_background(self) -> threading.Thread:
+        if self.__merge_thread is None or not self.__merge_thread.is_alive():
+            self.__merge_thread = threading.Thread(target=self.merge_segments, name="index-merge")
+            self.__merge_thread.start()
+        return self.__merge_thread
+
+    def __save_manifest(self) -> None:
+        # The manifest is the commit point, a segment file only counts once it is listed here
+        manifest = {
+            "base": self.segment_files[0],
+            "segments": self.segment_files[1:],
+            "deleted": {
+                segment_file: segment.deleted_doc_ids()
+                for segment_file, segment in zip(self.segment_files, self.segments)
+                if segment.deleted is not None
+            },
+            "next_segment": self.__next_segment,
+        }
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(manifest, file)
+        os.replace(tmp_path, self.manifest_path)
 
     def save(self):
-        # Save to disk using pickle.dump
-        # Create cache folder if it doesn't exist in data/cache
-        # cache/index.pkl
-        # cache/docmap.pkl
+        # Save a freshly built index as the base (see lib/index_format.py) and drop
+        # the delta segments of the previous index
+        # cache/index.bin
         # create folder if it doesn't exist
-        os.makedirs(CACHE_DIR, exist_ok=True)
-
-        # Store data (serialize)
-        with open(self.index_path, 'wb') as handle:
-            pickle.dump(self.index, handle, protocol=pickle.HIGHEST_PROTOCOL)
-            print(f"Saved {self.index_path}")
-        with open(self.docmap_path, 'wb') as handle:
-            pickle.dump(self.docmap, handle, protocol=pickle.HIGHEST_PROTOCOL)
-            print(f"Saved {self.docmap_path}")
-        with open(self.term_frequencies_path    , 'wb') as handle:
-            pickle.dump(self.term_frequencies, handle, protocol=pickle.HIGHEST_PROTOCOL)
-            print(f"Saved {self.term_frequencies_path}")
-        with open(self.doc_lengths_path, 'wb') as handle:
-            pickle.dump(self.doc_lengths, handle, protocol=pickle.HIGHEST_PROTOCOL)
-            print(f"Saved {self.doc_lengths_path}")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.segments[0].save(self.index_path)
+        print(f"Saved {self.index_path}")
+
+        segments_dir = os.path.join(self.cache_dir, SEGMENTS_DIR)
+        if os.path.isdir(segments_dir):
+            for name in os.listdir(segments_dir):
+                os.remove(os.path.join(segments_dir, name))
+        self.__next_segment = 1
 
     def load(self):
-        # load using picke.load
+        with stage("index.load"):
+            self.__load()
+
+    def __load(self):
+        # memory-map the base and delta segments, nothing is read until a query touches them
         try:
-            with open(self.index_path, 'rb') as handle:
-                self.index = pickle.load(handle)
-                # print(f"Loaded {self.index_path}")
-            with open(self.docmap_path, 'rb') as handle:
-                self.docmap = pickle.load(handle)
-                # print(f"Loaded {self.docmap_path}")
-            with open(self.term_frequencies_path, 'rb') as handle:
-                self.term_frequencies = pickle.load(handle)
-                # print(f"Loaded {self.term_frequencies_path}")
-            with open(self.doc_lengths_path, 'rb') as handle:
-                self.doc_lengths = pickle.load(handle)
-                # print(f"Loaded {self.doc_lengths_path}")
+            manifest = {"base": os.path.basename(self.index_path), "segments": [], "deleted": {}, "next_segment": 1}
+            if os.path.isfile(self.manifest_path):
+                manifest = open_json_file(self.manifest_path)
+            segment_files = [manifest["base"]] + manifest["segments"]
+            segments = [IndexSegment.load(os.path.join(self.cache_dir, f)) for f in segment_files]
+            for segment_file, segment in zip(segment_files, segments):
+                segment.delete(manifest["deleted"].get(segment_file, []))
+            if segments[0].meta["bm25_b"] != BM25_B:
+                segments[0].compute_stats(BM25_B)
+            self.segments = segments
+            self.segment_files = segment_files
+            self.__next_segment = manifest["next_segment"]
+            self.__compute_stats()
         except Exception as e:
             print(e)
-    pass
\ No newline at end of file
+
+    def convert_pickle_cache(self) -> None:
+        # Convert a pickle cache from earlier versions into the binary index.
+        # Handles both the original layout (dict of sets, Counter per doc) and the
+        # array layout (postings arrays in index.pkl, doc arrays in doc_lengths.pkl)
+        with open(self.pickle_index_path, 'rb') as handle:
+            index = pickle.load(handle)
+        with open(self.pickle_docmap_path, 'rb') as handle:
+            docmap = pickle.load(handle)
+        with open(self.pickle_doc_lengths_path, 'rb') as handle:
+            doc_lengths = pickle.load(handle)
+
+        if "postings_offsets" in index:
+            # postings are grouped by the term ids stored in the "terms" dict
+            terms = sorted(index["terms"], key=index["terms"].get)
+            term_ids = np.repeat(np.arange(len(terms)), np.diff(index["postings_offsets"]))
+            doc_ids = doc_lengths["doc_ids"]
+            base = IndexSegment.pack(
+                terms,
+                term_ids,
+                doc_ids[index["postings_docs"]],
+                index["postings_tfs"],
+                doc_ids,
+                doc_lengths["doc_lengths"],
+                [docmap[doc_id] for doc_id in doc_ids.tolist()],
+            )
+        else:
+            with open(self.pickle_term_frequencies_path, 'rb') as handle:
+                term_frequencies = pickle.load(handle)
+            doc_ids = list(term_frequencies)
+            partial = partial_index(
+                doc_ids,
+                term_frequencies.values(),
+                [doc_lengths[doc_id] for doc_id in doc_ids],
+            )
+            builder = SegmentBuilder()
+            builder.add_partial((docmap[doc_id] for doc_id in doc_ids), partial)
+            base = builder.finish()
+
+        self.__set_base(base)
+        self.save()
+    pass
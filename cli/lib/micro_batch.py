@@ -0,0 +1,68 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from lib.search_utils import MICRO_BATCH_SIZE, MICRO_BATCH_WAIT_MS
+from typing import Any, Callable, List
+
+
+class MicroBatcher:
+    # Coalesces concurrent calls into batches. The first waiting item opens a
+    # batch, which closes after max_wait_ms or max_batch items; process_batch
+    # then runs once over the batch (on the batcher's own thread) and every
+    # caller gets its own result back
+    def __init__(self, process_batch: Callable[[List[Any]], List[Any]], max_batch: int = MICRO_BATCH_SIZE, max_wait_ms: float = MICRO_BATCH_WAIT_MS) -> None:
+        self.process_batch = process_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.items = 0
+        self.__queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.__thread = threading.Thread(target=self.__run, name="micro-batcher", daemon=True)
+        self.__thread.start()
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.items / self.batches if self.batches else 0.0
+
+    def submit_future(self, item: Any) -> Future:
+        future: Future = Future()
+        self.__queue.put((item, future))
+        return future
+
+    def submit(self, item: Any) -> Any:
+        return self.submit_future(item).result()
+
+    def __run(self) -> None:
+        while True:
+            batch = [self.__queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.__queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self.batches += 1
+            self.items += len(batch)
+            try:
+                results = self.process_batch([item for item, _ in batch])
+                if len(results) != len(batch):
+                    raise ValueError(f"process_batch returned {len(results)} results for {len(batch)} items")
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+# Calls per second of fn over items from a number of concurrent threads
+def measure_qps(fn: Callable[[Any], Any], items: List[Any], threads: int) -> float:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(fn, items))
+    return len(items) / max(time.perf_counter() - start, 1e-9)
@@ -0,0 +1,142 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Dict
+
+# set to anything but "" or "0" to profile every search in the process
+PROFILE_ENV = "SEARCH_PROFILE"
+PROFILE_FORMATS = ("json", "prometheus")
+
+_DISABLED = nullcontext()
+
+
+class Profiler:
+    # Per-stage wall-clock timers and event counters for the search pipeline.
+    # Stages are dotted names ("bm25.score"), nested stages each count their own
+    # time. While disabled stage() hands out one shared no-op context and
+    # count() returns at once, so the hooks can stay in the hot paths
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        # stage name to [calls, total seconds, max seconds]
+        self.stages: Dict[str, list] = {}
+        self.counters: Dict[str, int] = {}
+
+    def stage(self, name: str):
+        if not self.enabled:
+            return _DISABLED
+        return self.__timed(name)
+
+    @contextmanager
+    def __timed(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                stats = self.stages.setdefault(name, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += seconds
+                stats[2] = max(stats[2], seconds)
+
+    def count(self, name: str, value: int = 1) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self) -> None:
+        with self.lock:
+            self.stages.clear()
+            self.counters.clear()
+
+    def report(self) -> Dict:
+        with self.lock:
+            return {
+                "stages": {
+                    name: {
+                        "calls": calls,
+                        "total_ms": total * 1000,
+                        "mean_ms": total * 1000 / calls,
+                        "max_ms": longest * 1000,
+                    }
+                    for name, (calls, total, longest) in sorted(self.stages.items())
+                },
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.report(), indent=2)
+
+    # Prometheus text exposition format
+    def to_prometheus(self) -> str:
+        report = self.report()
+        lines = [
+            "# HELP search_stage_seconds_total Wall-clock time spent in each search stage.",
+            "# TYPE search_stage_seconds_total counter",
+        ]
+        lines += [f'search_stage_seconds_total{{stage="{name}"}} {stats["total_ms"] / 1000:.9f}' for name, stats in report["stages"].items()]
+        lines += [
+            "# HELP search_stage_calls_total Times each search stage ran.",
+            "# TYPE search_stage_calls_total counter",
+        ]
+        lines += [f'search_stage_calls_total{{stage="{name}"}} {stats["calls"]}' for name, stats in report["stages"].items()]
+        lines += [
+            "# HELP search_stage_max_seconds Longest single run of each search stage.",
+            "# TYPE search_stage_max_seconds gauge",
+        ]
+        lines += [f'search_stage_max_seconds{{stage="{name}"}} {stats["max_ms"] / 1000:.9f}' for name, stats in report["stages"].items()]
+        lines += [
+            "# HELP search_events_total Events counted in the search pipeline.",
+            "# TYPE search_events_total counter",
+        ]
+        lines += [f'search_events_total{{event="{name}"}} {value}' for name, value in report["counters"].items()]
+        return "\n".join(lines) + "\n"
+
+    def export(self, profile_format: str = "json") -> str:
+        if profile_format == "prometheus":
+            return self.to_prometheus()
+        return self.to_json()
+
+
+_profiler = None
+
+# Shared profiler, enabled from the environment on first use
+def get_profiler() -> Profiler:
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(os.environ.get(PROFILE_ENV, "") not in ("", "0"))
+    return _profiler
+
+def stage(name: str):
+    return get_profiler().stage(name)
+
+def count(name: str, value: int = 1) -> None:
+    get_profiler().count(name, value)
+
+
+# --profile, --profile-format and --profile-output on every command of a CLI
+def add_profile_arguments(subparsers) -> None:
+    for parser in subparsers.choices.values():
+        parser.add_argument("--profile", action="store_true", help=f"Time each search stage and count events, printed to stderr when done. {PROFILE_ENV}=1 also enables it")
+        parser.add_argument("--profile-format", choices=PROFILE_FORMATS, default="json", help="Profile as JSON or Prometheus text")
+        parser.add_argument("--profile-output", type=str, default=None, help="Write the profile to this file instead of stderr")
+
+def start_profile(args) -> None:
+    if getattr(args, "profile", False):
+        get_profiler().enabled = True
+
+def finish_profile(args) -> None:
+    profiler = get_profiler()
+    if not profiler.enabled:
+        return
+    text = profiler.export(getattr(args, "profile_format", "json"))
+    if getattr(args, "profile_output", None):
+        with open(args.profile_output, "w") as file:
+            file.write(text)
+    else:
+        print(text, file=sys.stderr)
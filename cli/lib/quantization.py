@@ -0,0 +1,194 @@
+import time
+import numpy as np
+from lib.search_utils import QUANT_RERANK_FACTOR, top_k
+from typing import Dict, List, Optional, Tuple
+
+QUANTIZATION_MODES = ("float16", "int8", "pq")
+# rows decoded per matrix product while scoring, bounds scratch memory
+QUANT_BLOCK_SIZE = 8192
+# product quantization: dimensions per subspace and centroids per subspace
+# codebook, one uint8 code per subspace is a 16x reduction from float32
+PQ_SUBSPACE_DIM = 4
+PQ_CENTROIDS = 256
+PQ_TRAIN_SAMPLES = 20_000
+PQ_KMEANS_ITERATIONS = 15
+
+
+def _kmeans(vectors: np.ndarray, k: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    # plain euclidean k-means, the subvectors of a PQ subspace are not unit length
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = _nearest(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=k)
+        # an empty cluster restarts from a random vector
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()))]
+        counts[empty] = 1
+        centroids = sums / counts[:, None]
+    return centroids
+
+
+def _nearest(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # |v - c|^2 = |v|^2 - 2 v.c + |c|^2, and |v|^2 does not change the argmin
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    centroid_norms = (centroids * centroids).sum(axis=1)
+    for start in range(0, len(vectors), QUANT_BLOCK_SIZE):
+        block = vectors[start:start + QUANT_BLOCK_SIZE]
+        assignment[start:start + len(block)] = np.argmin(centroid_norms - 2 * (block @ centroids.T), axis=1)
+    return assignment
+
+
+class QuantizedEmbeddings:
+    # Compressed copy of an L2-normalized embedding matrix. Queries are scored
+    # directly on the codes:
+    #   float16  half precision rows
+    #   int8     per-dimension scalar quantization, x ~ offset + code * scale
+    #   pq       product quantization, rows split into subspaces of PQ_SUBSPACE_DIM
+    #            dimensions, each stored as the id of its nearest codebook centroid
+    #            and scored with a per-query lookup table (asymmetric distance)
+    def __init__(self, mode: str) -> None:
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown quantization mode {mode}, expected one of {', '.join(QUANTIZATION_MODES)}")
+        self.mode = mode
+        self.dim = 0
+        self.codes = np.zeros((0, 0), dtype=np.uint8)
+        # int8: per-dimension offset and step
+        self.offset = np.zeros(0, dtype=np.float32)
+        self.scale = np.zeros(0, dtype=np.float32)
+        # pq: (subspaces, centroids, PQ_SUBSPACE_DIM) codebooks
+        self.codebooks = np.zeros((0, 0, PQ_SUBSPACE_DIM), dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.offset.nbytes + self.scale.nbytes + self.codebooks.nbytes
+
+    @classmethod
+    def encode(cls, vectors: np.ndarray, mode: str, seed: int = 0) -> "QuantizedEmbeddings":
+        quantized = cls(mode)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        quantized.dim = vectors.shape[1] if vectors.ndim == 2 else 0
+        if mode == "float16":
+            quantized.codes = vectors.astype(np.float16)
+        elif mode == "int8":
+            low = vectors.min(axis=0) if len(vectors) > 0 else np.zeros(quantized.dim, dtype=np.float32)
+            high = vectors.max(axis=0) if len(vectors) > 0 else np.zeros(quantized.dim, dtype=np.float32)
+            quantized.offset = ((high + low) / 2).astype(np.float32)
+            quantized.scale = np.maximum((high - low) / 255, np.finfo(np.float32).tiny).astype(np.float32)
+            codes = np.rint((vectors - quantized.offset) / quantized.scale)
+            quantized.codes = np.clip(codes, -128, 127).astype(np.int8)
+        else:
+            quantized.__train_pq(vectors, np.random.default_rng(seed))
+        return quantized
+
+    def __subspaces(self, vectors: np.ndarray) -> np.ndarray:
+        # (rows, subspaces, PQ_SUBSPACE_DIM) view, zero padded to whole subspaces
+        pad = -self.dim % PQ_SUBSPACE_DIM
+        if pad:
+            vectors = np.pad(vectors, [(0, 0)] * (vectors.ndim - 1) + [(0, pad)])
+        return vectors.reshape(*vectors.shape[:-1], -1, PQ_SUBSPACE_DIM)
+
+    def __train_pq(self, vectors: np.ndarray, rng: np.random.Generator) -> None:
+        subvectors = self.__subspaces(vectors)
+        subspaces = subvectors.shape[1]
+        centroids = min(PQ_CENTROIDS, len(vectors))
+        sample = subvectors
+        if len(vectors) > PQ_TRAIN_SAMPLES:
+            sample = subvectors[rng.choice(len(vectors), size=PQ_TRAIN_SAMPLES, replace=False)]
+
+        self.codebooks = np.zeros((subspaces, centroids, PQ_SUBSPACE_DIM), dtype=np.float32)
+        self.codes = np.zeros((len(vectors), subspaces), dtype=np.uint8)
+        if centroids == 0:
+            return
+        for m in range(subspaces):
+            self.codebooks[m] = _kmeans(np.ascontiguousarray(sample[:, m]), centroids, PQ_KMEANS_ITERATIONS, rng)
+            self.codes[:, m] = _nearest(np.ascontiguousarray(subvectors[:, m]), self.codebooks[m])
+
+    def save(self, path: str) -> None:
+        with open(path, 'wb') as file:
+            np.savez(
+                file,
+                mode=np.array(self.mode),
+                dim=np.array(self.dim, dtype=np.int64),
+                codes=self.codes,
+                offset=self.offset,
+                scale=self.scale,
+                codebooks=self.codebooks,
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "QuantizedEmbeddings":
+        with np.load(path) as data:
+            quantized = cls(str(data["mode"]))
+            quantized.dim = int(data["dim"])
+            quantized.codes = data["codes"]
+            quantized.offset = data["offset"]
+            quantized.scale = data["scale"]
+            quantized.codebooks = data["codebooks"]
+        return quantized
+
+    # Approximate similarity of every row to a normalized query
+    def scores(self, query: np.ndarray) -> np.ndarray:
+        query = np.asarray(query, dtype=np.float32)
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        if self.mode == "pq":
+            # one lookup table row per subspace: the query's dot product with each centroid
+            table = np.einsum("mcd,md->mc", self.codebooks, self.__subspaces(query))
+            subspaces = np.arange(table.shape[0])
+            for start in range(0, len(self.codes), QUANT_BLOCK_SIZE):
+                block = self.codes[start:start + QUANT_BLOCK_SIZE]
+                scores[start:start + len(block)] = table[subspaces, block].sum(axis=1)
+            return scores
+
+        weights, base = query, 0.0
+        if self.mode == "int8":
+            # fold the scale into the query, the offset adds the same amount to every row
+            weights, base = query * self.scale, float(self.offset @ query)
+        for start in range(0, len(self.codes), QUANT_BLOCK_SIZE):
+            block = self.codes[start:start + QUANT_BLOCK_SIZE]
+            scores[start:start + len(block)] = block.astype(np.float32) @ weights + base
+        return scores
+
+    # Best k rows as (rows, scores), best first. With rerank (float32 rows in the
+    # same order, typically memory-mapped) the best k * QUANT_RERANK_FACTOR codes
+    # are rescored exactly, so only those rows are read
+    def search(self, query: np.ndarray, k: int, rerank: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        scores = self.scores(query)
+        if rerank is None:
+            rows = top_k(scores, k)
+            return rows, scores[rows]
+
+        rows = np.sort(top_k(scores, k * QUANT_RERANK_FACTOR))
+        vectors = np.asarray(rerank[rows], dtype=np.float32)
+        # rerank rows may be raw model output, normalize them like the codes were
+        norms = np.linalg.norm(vectors, axis=1)
+        norms[norms == 0] = 1.0
+        exact = (vectors @ query) / norms
+        top = top_k(exact, k)
+        return rows[top], exact[top]
+
+
+# recall@k against the exact float32 scan, with and without rerank, plus mean
+# latency of each. Queries are sampled rows of the normalized matrix
+def quantization_report(quantized: QuantizedEmbeddings, vectors: np.ndarray, k: int = 10, samples: int = 200, rerank: Optional[np.ndarray] = None, seed: int = 0) -> List[Dict]:
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), size=min(samples, len(vectors)), replace=False)]
+
+    start = time.perf_counter()
+    exact = [set(top_k(vectors @ query, k).tolist()) for query in queries]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    report = []
+    for label, rerank_rows in (("codes", None), ("rerank", rerank)):
+        if label == "rerank" and rerank is None:
+            continue
+        start = time.perf_counter()
+        found = [set(quantized.search(query, k, rerank_rows)[0].tolist()) for query in queries]
+        search_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        recall = float(np.mean([len(f & e) / len(e) for f, e in zip(found, exact)]))
+        report.append({"scoring": label, "recall": recall, "search_ms": search_ms, "exact_ms": exact_ms})
+    return report
@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+import numpy as np
+from collections import OrderedDict
+from lib.profiling import count
+from lib.search_utils import QUERY_CACHE_SIZE
+from typing import Callable, Dict, List, Optional
+
+
+# Queries that differ only in case or spacing share an embedding
+def normalize_query(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+
+class QueryEmbeddingCache:
+    # Bounded LRU of query text -> embedding. Keys include the model name, so
+    # every searcher in the process can share one cache. Thread safe
+    def __init__(self, capacity: int = QUERY_CACHE_SIZE) -> None:
+        self.capacity = capacity
+        self.entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @staticmethod
+    def key(model_name: str, text: str) -> str:
+        return f"{model_name}\0{normalize_query(text)}"
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self.lock:
+            embedding = self.entries.get(key)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+    def put(self, key: str, embedding: np.ndarray) -> None:
+        with self.lock:
+            self.entries[key] = embedding
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    # Embeddings of texts in order, computing the misses in one call. Misses
+    # are encoded from the caller's text, not the normalized key, so turning
+    # the cache on does not change a first-seen query's embedding. Misses that
+    # share a key are encoded once, from the first of them
+    def get_many(self, model_name: str, texts: List[str], compute: Callable[[List[str]], np.ndarray]) -> List[np.ndarray]:
+        keys = [self.key(model_name, text) for text in texts]
+        embeddings = [self.get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        count("query_cache.hits", len(texts) - len(missing))
+        count("query_cache.misses", len(missing))
+        if missing:
+            first: Dict[str, int] = {}
+            for i in missing:
+                first.setdefault(keys[i], i)
+            computed = dict(zip(first, compute([texts[i] for i in first.values()])))
+            for key, embedding in computed.items():
+                self.put(key, embedding)
+            for i in missing:
+                embeddings[i] = computed[keys[i]]
+        return embeddings
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    # Persist as <path>.npy (one row per entry, least recently used first) and
+    # <path>.json (the keys), written to temp files and renamed. The keys go
+    # first and come back last, so a crash in between leaves nothing to load
+    def save(self, path: str) -> None:
+        with self.lock:
+            keys = list(self.entries)
+            embeddings = np.array([self.entries[key] for key in keys], dtype=np.float32)
+        if len(keys) == 0:
+            return
+        if os.path.isfile(f"{path}.json"):
+            os.remove(f"{path}.json")
+        with open(f"{path}.npy.tmp", "wb") as file:
+            np.save(file, embeddings)
+        os.replace(f"{path}.npy.tmp", f"{path}.npy")
+        with open(f"{path}.json.tmp", "w", encoding="utf-8") as file:
+            json.dump(keys, file)
+        os.replace(f"{path}.json.tmp", f"{path}.json")
+
+    # Warm start from save(): the matrix is memory-mapped, so entries are read
+    # from disk only when a query hits them
+    def load(self, path: str) -> int:
+        if not os.path.isfile(f"{path}.npy") or not os.path.isfile(f"{path}.json"):
+            return 0
+        with open(f"{path}.json", "r", encoding="utf-8") as file:
+            keys = json.load(file)
+        embeddings = np.load(f"{path}.npy", mmap_mode="r")
+        if len(keys) != len(embeddings):
+            return 0
+        for key, embedding in zip(keys[-self.capacity:], embeddings[-self.capacity:]):
+            self.put(key, embedding)
+        return min(len(keys), self.capacity)
+
+
+_query_cache = None
+
+# Shared query embedding cache, used by SemanticSearch, ChunkedSemanticSearch
+# and HybridSearch. Created on first use
+def get_query_cache() -> QueryEmbeddingCache:
+    global _query_cache
+    if _query_cache is None:
+        _query_cache = QueryEmbeddingCache()
+    return _query_cache
@@ -0,0 +1,22 @@
+import json
+import urllib.error
+import urllib.request
+from typing import Dict
+
+from lib.search_utils import SERVER_URL
+
+
+# POST a search to a running search server (see lib/search_server.py) and
+# return its JSON response. Raises RuntimeError with the server's error message
+def remote_search(endpoint: str, params: Dict, server_url: str = SERVER_URL, timeout: float = 30.0) -> Dict:
+    request = urllib.request.Request(
+        f"{server_url.rstrip('/')}/search/{endpoint}",
+        data=json.dumps(params).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(f"Search server error {e.code}: {json.loads(e.read()).get('error')}") from e
@@ -0,0 +1,263 @@
+import asyncio
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from lib.chunked_semantic_search import ChunkedSemanticSearch
+from lib.hybrid_search import HybridSearch
+from lib.inverted_index import InvertedIndex
+from lib.profiling import get_profiler
+from lib.search_utils import (
+    HYBRID_ALPHA,
+    MAX_SEARCH_RESULTS,
+    PROXIMITY_WINDOW,
+    RRF_K,
+    SCORE_PRECISION,
+    SERVER_MAX_BODY,
+    SERVER_MAX_PENDING,
+    SERVER_WORKERS,
+    load_movies,
+)
+from typing import Dict, Optional, Tuple, Union
+
+
+class BadRequest(Exception):
+    pass
+
+
+class SearchService:
+    # Everything a query needs, loaded once: the keyword index, one encoder
+    # model serving movie and chunk embeddings, and the hybrid searcher over both
+    def __init__(self, documents) -> None:
+        self.documents = documents
+        self.document_map = {doc['id']: doc for doc in documents}
+
+        self.index = InvertedIndex()
+        self.index.load()
+        self.semantic = ChunkedSemanticSearch()
+        self.semantic.load_or_create_embeddings(documents)
+        self.semantic.load_or_create_chunk_embeddings(documents)
+        # concurrent requests share encoder batches and matrix products
+        self.semantic.enable_micro_batching()
+        self.hybrid = HybridSearch(documents, self.semantic, self.index)
+
+    def __doc_result(self, doc_id, score) -> Dict:
+        doc = self.document_map.get(doc_id, {})
+        return {
+            "id": doc_id,
+            "title": doc.get('title'),
+            "document": doc.get('description', '')[:100],
+            "score": round(score, SCORE_PRECISION),
+        }
+
+    def bm25(self, query: str, limit: int, proximity: bool = False, window: int = PROXIMITY_WINDOW) -> Dict:
+        results = self.index.bm25_search(query, limit, proximity=proximity, window=window)
+        return {"results": [self.__doc_result(r["id"], r["score"]) for r in results]}
+
+    def semantic_search(self, query: str, limit: int) -> Dict:
+        results = self.semantic.search(query, limit)
+        return {"results": [self.__doc_result(doc['id'], score) for score, doc in results]}
+
+    def chunked(self, query: str, limit: int) -> Dict:
+        return {"results": self.semantic.search_chunks(query, limit)}
+
+
+def _query_params(body: Dict) -> Tuple[str, int]:
+    query = body.get("query")
+    if not isinstance(query, str) or query.strip() == "":
+        raise BadRequest("query must be a non-empty string")
+    limit = body.get("limit", MAX_SEARCH_RESULTS)
+    if not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0:
+        raise BadRequest("limit must be a positive integer")
+    return query, limit
+
+
+def _bm25_params(body: Dict) -> Tuple[bool, int]:
+    proximity = body.get("proximity", False)
+    if not isinstance(proximity, bool):
+        raise BadRequest("proximity must be true or false")
+    window = body.get("window", PROXIMITY_WINDOW)
+    if not isinstance(window, int) or isinstance(window, bool) or window <= 0:
+        raise BadRequest("window must be a positive integer")
+    return proximity, window
+
+
+def _hybrid_params(body: Dict) -> Tuple[float, int, Optional[float], Optional[float]]:
+    alpha = body.get("alpha", HYBRID_ALPHA)
+    if not _is_number(alpha) or not 0 <= alpha <= 1:
+        raise BadRequest("alpha must be a number between 0 and 1")
+    k = body.get("k", RRF_K)
+    if not isinstance(k, int) or isinstance(k, bool) or k <= 0:
+        raise BadRequest("k must be a positive integer")
+    timeouts = []
+    for name in ("bm25_timeout", "semantic_timeout"):
+        timeout = body.get(name)
+        if timeout is not None and (not _is_number(timeout) or timeout <= 0):
+            raise BadRequest(f"{name} must be null or a positive number")
+        timeouts.append(timeout)
+    return alpha, k, timeouts[0], timeouts[1]
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+class SearchServer:
+    # Minimal HTTP/1.1 JSON server on asyncio streams. Searches run on a bounded
+    # thread pool; requests beyond the pool plus SERVER_MAX_PENDING waiting ones
+    # are answered 503 at once instead of queueing without limit.
+    #   GET  /health
+    #   GET  /metrics  per-stage timings and counters as Prometheus text, see --profile
+    #   POST /search/bm25  {"query", "limit", "proximity", "window"}
+    #   POST /search/semantic, /search/chunked  {"query", "limit"}
+    #   POST /search/hybrid  {"query", "limit", "method", "alpha", "k", "bm25_timeout", "semantic_timeout"}
+    def __init__(self, service: SearchService, workers: int = SERVER_WORKERS, max_pending: int = SERVER_MAX_PENDING) -> None:
+        self.service = service
+        self.workers = workers
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.in_flight = 0
+        self.served = 0
+        self.rejected = 0
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.__handle_connection, host, port)
+        print(f"Serving on http://{host}:{port} with {self.workers} workers")
+        async with server:
+            await server.serve_forever()
+
+    async def __handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    request = await self.__read_request(reader)
+                except BadRequest as e:
+                    # where the next request starts is unknown, so the connection is not reused
+                    self.__write_response(writer, HTTPStatus.BAD_REQUEST, {"error": str(e)}, False)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                if body is None:
+                    # the unread body is still on the stream, so the connection cannot be reused
+                    status, payload, keep_alive = HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": "request body too large"}, False
+                else:
+                    status, payload = await self.__dispatch(method, path, body)
+                self.__write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    # (method, path, headers, body), body None when it exceeds SERVER_MAX_BODY.
+    # Raises BadRequest on a malformed request line or Content-Length
+    async def __read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], Optional[bytes]]]:
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers: Dict[str, str] = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+        except (ValueError, UnicodeDecodeError):
+            raise BadRequest("malformed request")
+        if length < 0:
+            raise BadRequest("Content-Length must not be negative")
+        if length > SERVER_MAX_BODY:
+            return method, path, headers, None
+        body = await reader.readexactly(length) if length else b""
+        return method, path, headers, body
+
+    # a str payload is sent as plain text, anything else as JSON
+    def __write_response(self, writer: asyncio.StreamWriter, status: HTTPStatus, payload: Union[Dict, str], keep_alive: bool) -> None:
+        if isinstance(payload, str):
+            body, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body, content_type = json.dumps(payload).encode("utf-8"), "application/json"
+        head = (
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+
+    async def __dispatch(self, method: str, path: str, body: bytes) -> Tuple[HTTPStatus, Union[Dict, str]]:
+        if method == "GET" and path == "/health":
+            return HTTPStatus.OK, {
+                "status": "ok",
+                "in_flight": self.in_flight,
+                "served": self.served,
+                "rejected": self.rejected,
+            }
+        if method == "GET" and path == "/metrics":
+            profiler = get_profiler()
+            if not profiler.enabled:
+                return HTTPStatus.NOT_FOUND, {"error": "profiling is off, start the server with --profile"}
+            return HTTPStatus.OK, profiler.to_prometheus()
+        handlers = {
+            "/search/bm25": self.service.bm25,
+            "/search/semantic": self.service.semantic_search,
+            "/search/chunked": self.service.chunked,
+            "/search/hybrid": None,
+        }
+        if path not in handlers:
+            return HTTPStatus.NOT_FOUND, {"error": f"unknown path {path}"}
+        if method != "POST":
+            return HTTPStatus.METHOD_NOT_ALLOWED, {"error": "use POST"}
+        if self.in_flight >= self.workers + self.max_pending:
+            self.rejected += 1
+            return HTTPStatus.SERVICE_UNAVAILABLE, {"error": "server busy"}
+
+        self.in_flight += 1
+        try:
+            params = json.loads(body or b"{}")
+            if not isinstance(params, dict):
+                raise BadRequest("body must be a JSON object")
+            query, limit = _query_params(params)
+            if path == "/search/hybrid":
+                alpha, k, bm25_timeout, semantic_timeout = _hybrid_params(params)
+                payload = await self.service.hybrid.asearch(
+                    query,
+                    params.get("method", "rrf"),
+                    limit,
+                    alpha,
+                    k,
+                    bm25_timeout,
+                    semantic_timeout,
+                )
+            elif path == "/search/bm25":
+                loop = asyncio.get_running_loop()
+                proximity, window = _bm25_params(params)
+                payload = await loop.run_in_executor(self.executor, self.service.bm25, query, limit, proximity, window)
+            else:
+                loop = asyncio.get_running_loop()
+                payload = await loop.run_in_executor(self.executor, handlers[path], query, limit)
+            self.served += 1
+            return HTTPStatus.OK, payload
+        except (BadRequest, ValueError) as e:
+            return HTTPStatus.BAD_REQUEST, {"error": str(e)}
+        except TimeoutError as e:
+            return HTTPStatus.GATEWAY_TIMEOUT, {"error": str(e)}
+        except Exception as e:
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)}
+        finally:
+            self.in_flight -= 1
+
+
+def run_server(host: str, port: int, workers: int = SERVER_WORKERS, max_pending: int = SERVER_MAX_PENDING, profile: bool = False) -> None:
+    if profile:
+        get_profiler().enabled = True
+    service = SearchService(load_movies())
+    asyncio.run(SearchServer(service, workers, max_pending).serve(host, port))
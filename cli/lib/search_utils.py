@@ -1,21 +1,61 @@
 import json
+import numpy as np
 import re
 import string
-from nltk.stem import PorterStemmer
-from typing import Dict, List
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Tuple
 
+# chunks fetched from the ANN index per requested movie, several chunks can share a movie
+ANN_CHUNK_CANDIDATES = 10
+ANN_NPROBE = 8
 BM25_B = 0.75
 BM25_K1 = 1.5
+BUILD_BATCH_SIZE = 1000
+# descriptions per chunking task of the chunk embedding pipeline's workers
+CHUNK_TASK_SIZE = 256
 DEFAULT_CHUNK_OVERLAP = 1
 DEFAULT_SEMANTIC_CHUNK_SIZE = 4
+# chunks encoded, written and checkpointed at a time by the chunk embedding pipeline
+EMBED_PIPELINE_BATCH_SIZE = 4096
+ENCODE_BATCH_SIZE = 128
+HYBRID_ALPHA = 0.5
+# candidates each hybrid leg retrieves per requested result
+HYBRID_CANDIDATE_FACTOR = 10
+HYBRID_LEG_THREADS = 4
 MAX_SEARCH_RESULTS = 5
+MICRO_BATCH_SIZE = 32
+MICRO_BATCH_WAIT_MS = 2.0
+MOVIES_PATH = 'data/movies.json'
+# BM25 candidates reranked per requested result by proximity search
+PROXIMITY_CANDIDATE_FACTOR = 10
+# term pairs further apart than this many words add no proximity score
+PROXIMITY_WINDOW = 5
+# quantized searches rescore this many candidates per result from the float32 cache
+QUANT_RERANK_FACTOR = 10
+QUERY_CACHE_SIZE = 10_000
+RRF_K = 60
 SCORE_PRECISION = 4
+SERVER_MAX_BODY = 1 << 20
+# requests allowed to wait for a busy worker before the server answers 503
+SERVER_MAX_PENDING = 64
+SERVER_URL = 'http://127.0.0.1:8765'
+SERVER_WORKERS = 16
+# partitions of a sharded index, see lib/sharded_index.py
+SHARD_COUNT = 4
+STEM_CACHE_SIZE = 100_000
+STOP_WORDS_PATH = 'data/stopwords.txt'
 
-stemmer = PorterStemmer()
+# Shard of a doc id when the corpus is partitioned into `shards` by doc id
+def shard_of(doc_id: int, shards: int) -> int:
+    return doc_id % shards
+
+# BM25 IDF, log((N - df + 0.5) / (df + 0.5) + 1), for a scalar or an array of df
+def bm25_idf(doc_count, df):
+    return np.log((doc_count - df + 0.5) / (df + 0.5) + 1)
 
 def load_stop_words():
     global stop_words_list
-    with open('data/stopwords.txt', 'r') as file:
+    with open(STOP_WORDS_PATH, 'r') as file:
         stop_words_list = file.read().splitlines()
         return stop_words_list
 
@@ -33,39 +73,136 @@ def load_movies():
     data = open_json_file('data/movies.json')
     return data['movies']
 
+# Yield movies one at a time. A JSON Lines file (one movie per line) is
+# streamed, the regular {"movies": [...]} file has to be loaded whole
+def iter_movies(file_path: str = MOVIES_PATH) -> Iterator[dict]:
+    if file_path.endswith('.jsonl'):
+        with open(file_path, 'r') as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        yield from open_json_file(file_path)['movies']
+
+def write_movies_jsonl(source_path: str, target_path: str) -> int:
+    count = 0
+    with open(target_path, 'w') as file:
+        for movie in iter_movies(source_path):
+            file.write(json.dumps(movie) + "\n")
+            count += 1
+    return count
+
 def open_json_file(file_path):
     with open(file_path, 'r') as file:
         data = json.load(file)
     return data
 
-def tokenize(text: str):
-    translation_table = str.maketrans("", "", string.punctuation)
+class Tokenizer:
+    # Reusable tokenizer: punctuation table built once, frozenset stop words and
+    # a bounded memo of stemmed words, since the same words repeat constantly
+    def __init__(self, stop_words_path: str = STOP_WORDS_PATH, stem_cache_size: int = STEM_CACHE_SIZE) -> None:
+        self.translation_table = str.maketrans("", "", string.punctuation)
+        with open(stop_words_path, 'r') as file:
+            self.stop_words = frozenset(file.read().splitlines())
+        # imported here: nltk takes a few hundred ms to import and most commands never tokenize
+        from nltk.stem import PorterStemmer
+        self.stem = lru_cache(maxsize=stem_cache_size)(PorterStemmer().stem)
+
+    def tokenize(self, text: str) -> List[str]:
+        stem = self.stem
+        stop_words = self.stop_words
+        tokens = text.lower().translate(self.translation_table).split()
+        return [stem(token) for token in tokens if token not in stop_words]
+
+    def tokenize_many(self, texts: Iterable[str]) -> List[List[str]]:
+        return [self.tokenize(text) for text in texts]
+
+    # Tokens and their word positions in the text, stop words still count as
+    # words so a phrase's gaps match the document's
+    def tokenize_with_positions(self, text: str) -> Tuple[List[str], List[int]]:
+        stem = self.stem
+        stop_words = self.stop_words
+        tokens: List[str] = []
+        positions: List[int] = []
+        for position, token in enumerate(text.lower().translate(self.translation_table).split()):
+            if token not in stop_words:
+                tokens.append(stem(token))
+                positions.append(position)
+        return tokens, positions
+
+_tokenizer = None
 
-    tokens = text.lower().translate(translation_table).split()
-    valid_tokens = []
-    for token in tokens:
-        if token in stop_words_list:
-            continue
-        stem_word = stemmer.stem(token)
-        valid_tokens.append(stem_word)
-    return valid_tokens
+# Shared tokenizer, created on first use
+def get_tokenizer() -> Tokenizer:
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = Tokenizer()
+    return _tokenizer
+
+def tokenize(text: str) -> List[str]:
+    return get_tokenizer().tokenize(text)
+
+# Query tokens plus each "quoted phrase" in it as (tokens, word offsets)
+def parse_query(query: str) -> Tuple[List[str], List[Tuple[List[str], List[int]]]]:
+    tokenizer = get_tokenizer()
+    phrases = [tokenizer.tokenize_with_positions(phrase) for phrase in re.findall(r'"([^"]+)"', query)]
+    return tokenizer.tokenize(query), [phrase for phrase in phrases if phrase[0]]
+
+# Scale scores to [0, 1], all-equal scores map to 1.0
+def min_max_normalize(scores) -> np.ndarray:
+    scores = np.asarray(scores, dtype=np.float64)
+    if len(scores) == 0:
+        return scores
+    low, high = scores.min(), scores.max()
+    if low == high:
+        return np.ones_like(scores)
+    return (scores - low) / (high - low)
+
+# Indices of the k highest scores, best first, without sorting the whole array.
+# Ties go to the lower index, so results do not depend on partition order
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    if k <= 0 or len(scores) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < len(scores):
+        threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+        above = np.flatnonzero(scores > threshold)
+        ties = np.flatnonzero(scores == threshold)[:k - len(above)]
+        candidates = np.sort(np.concatenate([above, ties]))
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
 
 def semantic_chunk(text: str, max_chunk_size: int, overlap: int = 0) -> List[str]:
+    return semantic_chunk_spans(text, max_chunk_size, overlap)[0]
+
+# Chunks of semantic_chunk with the [first, end) sentences of each, indexes
+# into split_text_to_sentences(text)
+def semantic_chunk_spans(text: str, max_chunk_size: int, overlap: int = 0) -> Tuple[List[str], List[Tuple[int, int]]]:
     separator = " "
     sentences = split_text_to_sentences(text)
     
     chunks: List[str] = []
+    spans: List[Tuple[int, int]] = []
     index = 0
     
     while index <= len(sentences):
         chunks.append(separator.join(s.strip() for s in sentences[index:index + max_chunk_size] if s.strip()))
+        spans.append((index, min(index + max_chunk_size, len(sentences))))
         index += max_chunk_size
         if (index >= len(sentences)):
             break
 
         index -= overlap
 
-    return chunks
+    return chunks, spans
+
+# Number of chunks semantic_chunk makes of a text, without building them
+def semantic_chunk_count(text: str, max_chunk_size: int, overlap: int = 0) -> int:
+    sentences = len(split_text_to_sentences(text))
+    if sentences <= max_chunk_size:
+        return 1
+    step = max_chunk_size - overlap
+    return 1 + (sentences - max_chunk_size + step - 1) // step
 
 def split_text_to_sentences(text: str) -> List[str]:
     text = text.strip()
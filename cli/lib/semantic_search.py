@@ -1,7 +1,21 @@
 import os
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from lib.search_utils import open_json_file
+from lib.ann_index import load_or_create_ivf_index
+from lib.embedding_cache import (
+    cached_embeddings_current,
+    documents_digest,
+    load_cached_embeddings,
+    update_cached_embeddings,
+)
+from lib.encoder import Encoder
+from lib.micro_batch import MicroBatcher
+from lib.profiling import count, stage
+from lib.query_cache import get_query_cache
+from lib.quantization import QuantizedEmbeddings
+from lib.search_utils import ANN_NPROBE, MICRO_BATCH_SIZE, MICRO_BATCH_WAIT_MS, open_json_file, top_k
+
+# embedding cache parameters of the movie embeddings, see embedding_key
+MOVIE_EMBEDDING_PARAMS = "movie:title: description"
 
 
 def cosine_similarity(vec1, vec2):
@@ -14,6 +28,13 @@ def cosine_similarity(vec1, vec2):
 
     return dot_product / (norm1 * norm2)
 
+# Scale rows to unit length so a dot product is the cosine similarity, zero rows stay zero
+def normalize_embeddings(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embeddings / norms
+
 def embed_text(text):
     sm = SemanticSearch()
     embedding = sm.generate_embedding(text)
@@ -38,12 +59,23 @@ def verify_embeddings():
     print(f"Embeddings shape: {sm.embeddings.shape[0]} vectors in {sm.embeddings.shape[1]} dimensions")
 
 class SemanticSearch:
-    def __init__(self, model_name='all-MiniLM-L6-v2') -> None:
+    def __init__(self, model_name='all-MiniLM-L6-v2', device='auto', backend='torch', workers=1) -> None:
         # Load the model (downloads automatically the first time)
-        self.model = SentenceTransformer(model_name)
+        self.encoder = Encoder(model_name, device, backend, workers)
+        self.model = self.encoder.model
+        self.model_name = model_name
         self.embeddings = None
         self.documents = None
         self.document_map = {}
+        # optional IVF index, searches use it instead of the exact scan once loaded
+        self.ann_index = None
+        # optional compressed embeddings, searches score them instead of the
+        # float32 matrix, which then stays on disk (memory-mapped for rerank)
+        self.quantized = None
+        self.rerank_embeddings = None
+        # optional coalescers for concurrent callers, see enable_micro_batching
+        self.encode_batcher = None
+        self.search_batcher = None
 
     def build_embeddings(self, documents):
         self.documents = documents
@@ -52,48 +84,157 @@ class SemanticSearch:
             self.document_map[doc['id']] = doc
             movies.append(f"{doc['title']}: {doc['description']}")
 
-        self.embeddings = self.model.encode(movies, show_progress_bar=True)
-        with open('cache/movie_embeddings.npy', 'wb') as file:
-            np.save(file, self.embeddings)
-        
+        # only new or edited movies are encoded, the rest come from the cache.
+        # Stored L2-normalized, so searching is a single matrix product
+        self.embeddings, encoded = update_cached_embeddings(
+            'cache/movie_embeddings.npy',
+            self.model_name,
+            MOVIE_EMBEDDING_PARAMS,
+            movies,
+            lambda texts: normalize_embeddings(self.encoder.encode(texts, show_progress_bar=True)),
+            documents_digest(self.model_name, MOVIE_EMBEDDING_PARAMS, movies),
+        )
+        print(f"Encoded {encoded} of {len(movies)} movies, reused {len(movies) - encoded} cached embeddings")
+        if encoded:
+            print(f"Encoder {self.encoder}: {self.encoder.throughput:.1f} chunks/sec")
         return self.embeddings
 
+    def __movies_digest(self, documents):
+        texts = (f"{doc['title']}: {doc['description']}" for doc in documents)
+        return documents_digest(self.model_name, MOVIE_EMBEDDING_PARAMS, texts)
+
     def generate_embedding(self, text):
         if text is None or text.strip() == "":
             raise ValueError("Input text must be a non-empty string.")
         
-        sentences = [text]
-        embedding = self.model.encode(sentences)
-        return embedding[0]
+        # repeated queries skip the model
+        with stage("semantic.query_embedding"):
+            return self.__cached_query_embeddings([text], self.__encode_queries)[0]
+
+    def __cached_query_embeddings(self, texts, encode):
+        return get_query_cache().get_many(f"{self.model_name}/{self.encoder.backend}", texts, encode)
+
+    def __encode_queries(self, texts):
+        count("semantic.queries_encoded", len(texts))
+        # a single query joins the current micro-batch, several are a batch already
+        with stage("semantic.encode"):
+            if self.encode_batcher is not None and len(texts) == 1:
+                return [self.encode_batcher.submit(texts[0])]
+            return self.model.encode(texts)
+
+    # Coalesce concurrent calls from many threads (e.g. the search server's
+    # workers): query encodes in generate_embedding, and whole searches in
+    # search, which then run as one search_many, one encode and one
+    # matrix-matrix product per batch. Each call waits at most max_wait_ms for
+    # others to join, so this only pays off under concurrent load
+    def enable_micro_batching(self, max_batch=MICRO_BATCH_SIZE, max_wait_ms=MICRO_BATCH_WAIT_MS):
+        self.encode_batcher = MicroBatcher(lambda texts: list(self.model.encode(texts)), max_batch, max_wait_ms)
+        self.search_batcher = MicroBatcher(self.__search_batch, max_batch, max_wait_ms)
+
+    def __search_batch(self, items):
+        results = self.search_many([query for query, _ in items], max(limit for _, limit in items))
+        return [documents[:limit] for documents, (_, limit) in zip(results, items)]
     
     def load_or_create_embeddings(self, documents):
         self.documents = documents
         for doc in documents:
             self.document_map[doc['id']] = doc
 
-        if os.path.isfile('cache/movie_embeddings.npy'):
-            with open('cache/movie_embeddings.npy', 'rb') as file:
-                self.embeddings = np.load(file)
-
-        if (self.embeddings is None or len(self.embeddings) != len(documents)):
-            self.build_embeddings(documents)
+        # the cache is used as is only when it was built from exactly these movies
+        with stage("embeddings.load"):
+            self.embeddings = load_cached_embeddings('cache/movie_embeddings.npy', self.__movies_digest(documents))
+        if self.embeddings is None:
+            return self.build_embeddings(documents)
         else:
+            self.embeddings = normalize_embeddings(self.embeddings)
             return self.embeddings
         
     def search(self, query, limit):
-        if self.embeddings is None or self.documents is None:
+        if (self.embeddings is None and self.quantized is None) or self.documents is None:
             raise ValueError("Embeddings and documents must be loaded before searching.")
+        if self.search_batcher is not None:
+            # checked here, one bad query must not fail the whole batch
+            if query is None or query.strip() == "":
+                raise ValueError("Input text must be a non-empty string.")
+            return self.search_batcher.submit((query, limit))
         
-        query_embedding = self.generate_embedding(query)
-        similarities = []
+        query_embedding = normalize_embeddings(self.generate_embedding(query))
+        if self.quantized is not None:
+            return self.__quantized_documents(query_embedding, limit)
+        if self.ann_index is not None:
+            return self.__ann_documents(query_embedding, limit)
+        count("semantic.vectors_scored", len(self.embeddings))
+        with stage("semantic.score"):
+            scores = self.embeddings @ query_embedding
+        return self.__top_documents(scores, limit)
+
+    # Search several queries at once: one encode call and one matrix-matrix product
+    def search_many(self, queries, limit):
+        if (self.embeddings is None and self.quantized is None) or self.documents is None:
+            raise ValueError("Embeddings and documents must be loaded before searching.")
+        if any(query is None or query.strip() == "" for query in queries):
+            raise ValueError("Input text must be a non-empty string.")
+        if len(queries) == 0:
+            return []
+
+        query_embeddings = normalize_embeddings(np.array(self.__cached_query_embeddings(list(queries), self.model.encode)))
+        if self.quantized is not None:
+            return [self.__quantized_documents(query_embedding, limit) for query_embedding in query_embeddings]
+        if self.ann_index is not None:
+            return [self.__ann_documents(query_embedding, limit) for query_embedding in query_embeddings]
+        count("semantic.vectors_scored", len(self.embeddings) * len(query_embeddings))
+        with stage("semantic.score"):
+            scores = query_embeddings @ self.embeddings.T
+        return [self.__top_documents(row, limit) for row in scores]
+
+    # (similarity, document) pairs for the best scores, best first
+    def __top_documents(self, scores, limit):
+        with stage("semantic.top_k"):
+            best = top_k(scores, limit)
+        return [(float(scores[idx]), self.documents[idx]) for idx in best]
+
+    def __ann_documents(self, query_embedding, limit):
+        with stage("semantic.ann"):
+            rows, scores = self.ann_index.search(query_embedding, limit)
+        return [(float(score), self.documents[row]) for row, score in zip(rows.tolist(), scores.tolist())]
+
+    def __quantized_documents(self, query_embedding, limit):
+        with stage("semantic.quantized"):
+            rows, scores = self.quantized.search(query_embedding, limit, self.rerank_embeddings)
+        return [(float(score), self.documents[row]) for row, score in zip(rows.tolist(), scores.tolist())]
+
+    # Search compressed embeddings (see QuantizedEmbeddings) instead of the float32
+    # matrix. The codes are cached per mode next to the embeddings cache; with
+    # rerank the float32 cache is memory-mapped to rescore the best candidates
+    def load_or_create_quantized_embeddings(self, documents, mode, rerank=True, rebuild=False):
+        self.documents = documents
+        for doc in documents:
+            self.document_map[doc['id']] = doc
 
-        for idx, doc_embedding in enumerate(self.embeddings):
-            similarity = cosine_similarity(query_embedding, doc_embedding)
-            similarities.append((similarity, self.documents[idx]))
+        path = f'cache/movie_embeddings.{mode}.npz'
+        self.quantized = None
+        if not cached_embeddings_current('cache/movie_embeddings.npy', self.__movies_digest(documents)):
+            # refreshing the cache also drops the codes built from the old matrix
+            self.load_or_create_embeddings(documents)
+        if os.path.isfile(path) and not rebuild:
+            self.quantized = QuantizedEmbeddings.load(path)
+        if self.quantized is None or self.quantized.mode != mode or len(self.quantized) != len(documents):
+            self.quantized = QuantizedEmbeddings.encode(self.load_or_create_embeddings(documents), mode)
+            self.quantized.save(path)
+        # the float32 matrix is only read through the memory map from here on
+        self.embeddings = None
+        self.rerank_embeddings = np.load('cache/movie_embeddings.npy', mmap_mode='r') if rerank else None
+        return self.quantized
 
-        similarities.sort(key=lambda x: x[0], reverse=True)
-        return similarities[:limit] 
+    # Load the IVF index next to the embeddings cache, building it when missing,
+    # stale, when nlist is given or when rebuild is set
+    def load_or_create_ann_index(self, nlist=None, nprobe=ANN_NPROBE, rebuild=False):
+        if self.embeddings is None:
+            raise ValueError("Embeddings must be loaded before building the ANN index.")
+        self.ann_index = load_or_create_ivf_index('cache/movie_embeddings.ivf.npz', self.embeddings, nlist, nprobe, rebuild)
+        return self.ann_index
 
     def verify_model(self) -> None:
         print(f"Model loaded: {self.model}")
+        print(f"Encoder: {self.encoder}")
         print(f"Max sequence length: {self.model.max_seq_length}")
@@ -0,0 +1,281 @@
+import json
+import os
+import shutil
+import time
+import uuid
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from lib.index_segment import merge_document_frequencies
+from lib.inverted_index import CACHE_DIR, CorpusStats, InvertedIndex
+from lib.profiling import count, stage
+from lib.semantic_search import normalize_embeddings
+from lib.search_utils import (
+    BM25_K1,
+    BUILD_BATCH_SIZE,
+    MOVIES_PATH,
+    SHARD_COUNT,
+    bm25_idf,
+    open_json_file,
+    parse_query,
+    shard_of,
+    tokenize,
+    top_k,
+)
+from typing import Dict, List, Optional, Tuple
+
+SHARDS_DIR = 'shards'
+
+
+def shard_dir(root: str, shard: int) -> str:
+    return os.path.join(root, f"shard_{shard:03d}")
+
+
+class Shard:
+    # One partition of the corpus: a keyword index over its docs and, once the
+    # vectors are sharded, its rows of the chunk embeddings grouped by doc id
+    def __init__(self, directory: str) -> None:
+        self.index = InvertedIndex(directory)
+        self.index.load()
+        self.chunk_embeddings: Optional[np.ndarray] = None
+        # per doc: its id and the first of its rows in chunk_embeddings
+        self.group_doc_ids = np.zeros(0, dtype=np.int64)
+        self.group_starts = np.zeros(0, dtype=np.int64)
+        embeddings_path = os.path.join(directory, "chunk_embeddings.npy")
+        if os.path.isfile(embeddings_path):
+            self.chunk_embeddings = np.load(embeddings_path, mmap_mode='r')
+            row_doc_ids = np.load(os.path.join(directory, "chunk_doc_ids.npy"))
+            if len(row_doc_ids) > 0:
+                self.group_starts = np.concatenate(([0], np.flatnonzero(np.diff(row_doc_ids)) + 1))
+                self.group_doc_ids = row_doc_ids[self.group_starts]
+
+    def bm25_top_k(self, tokens: List[str], limit: int, k1: float, phrases, stats: CorpusStats) -> Tuple[np.ndarray, np.ndarray]:
+        return self.index.bm25_top_k(tokens, limit, k1, phrases=phrases, stats=stats)
+
+    # Best docs by their best chunk, as (doc ids, scores), best first
+    def chunk_top_k(self, query_embedding: np.ndarray, limit: int) -> Tuple[np.ndarray, np.ndarray]:
+        if self.chunk_embeddings is None:
+            raise ValueError("Shard the chunk embeddings before searching them.")
+        if len(self.group_starts) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        doc_scores = np.maximum.reduceat(self.chunk_embeddings @ query_embedding, self.group_starts)
+        best = top_k(doc_scores, limit)
+        return self.group_doc_ids[best], doc_scores[best].astype(np.float64)
+
+
+# Shards opened by this process, by directory, with the build they belong to.
+# Pool workers keep their shards open between queries
+_open_shards: Dict[str, Tuple[str, Shard]] = {}
+
+
+def _shard(directory: str, build_id: str) -> Shard:
+    opened = _open_shards.get(directory)
+    if opened is None or opened[0] != build_id:
+        opened = (build_id, Shard(directory))
+        _open_shards[directory] = opened
+    return opened[1]
+
+
+def _bm25_shard(directory: str, build_id: str, tokens, limit, k1, phrases, stats) -> Tuple[np.ndarray, np.ndarray]:
+    return _shard(directory, build_id).bm25_top_k(tokens, limit, k1, phrases, stats)
+
+
+def _chunk_shard(directory: str, build_id: str, query_embedding, limit) -> Tuple[np.ndarray, np.ndarray]:
+    return _shard(directory, build_id).chunk_top_k(query_embedding, limit)
+
+
+# Build one shard's keyword index, runs inside build workers. Returns the
+# shard's doc count, total doc length and (lexicon, dfs)
+def _build_shard(directory: str, shard: int, shards: int, path: str, batch_size: int, positions: bool) -> Tuple[int, int, np.ndarray, np.ndarray]:
+    index = InvertedIndex(directory)
+    index.build(path, 1, batch_size, positions, (shard, shards))
+    lexicon, dfs = index.document_frequencies()
+    return index.doc_count, index.live_length_sum(), lexicon, dfs
+
+
+# Shard winners merged, ties go to the lower doc id as within one index
+def _merge(results: List[Tuple[np.ndarray, np.ndarray]], limit: int) -> Tuple[np.ndarray, np.ndarray]:
+    doc_ids = np.concatenate([np.zeros(0, dtype=np.int64)] + [doc_ids for doc_ids, _ in results])
+    scores = np.concatenate([np.zeros(0, dtype=np.float64)] + [scores for _, scores in results])
+    best = np.lexsort((doc_ids, -scores))[:limit]
+    return doc_ids[best], scores[best]
+
+
+class ShardedIndex:
+    # The corpus partitioned by doc id (see shard_of) into shards that each hold
+    # their own keyword index and chunk embeddings. A query fans out to every
+    # shard across a process pool and the shard winners are merged. BM25 uses the
+    # IDF and average doc length of the whole corpus, stored at build time, so
+    # scores match the unsharded index. Shards are rebuilt as a whole, upserts
+    # and deletes stay with the unsharded index
+    def __init__(self, root: str = os.path.join(CACHE_DIR, SHARDS_DIR), workers: Optional[int] = None) -> None:
+        self.root = root
+        # processes queries fan out to, one per shard up to the cpu count by
+        # default, 1 searches the shards one after another in this process
+        self.workers = workers
+        self.manifest_path = os.path.join(root, "manifest.json")
+        # utf-8 lexicon of the whole corpus and the df of each term
+        self.stats_path = os.path.join(root, "stats.npz")
+        self.manifest: Dict = {}
+        self.shards = 0
+        self.doc_count = 0
+        self.avg_doc_length = 0.0
+        self.lexicon = np.zeros(0, dtype="S1")
+        self.idf = np.zeros(0, dtype=np.float64)
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def has_vectors(self) -> bool:
+        return bool(self.manifest.get("vectors"))
+
+    @property
+    def has_positions(self) -> bool:
+        return bool(self.manifest.get("positions"))
+
+    def __shard_dirs(self) -> List[str]:
+        return [shard_dir(self.root, shard) for shard in range(self.shards)]
+
+    def __worker_count(self) -> int:
+        if self.workers is not None:
+            return self.workers
+        return min(self.shards, os.cpu_count() or 1)
+
+    # One call per shard, across the process pool unless a single worker is configured
+    def __map(self, function, *args) -> List:
+        count("shards.searched", self.shards)
+        build_id = self.manifest["build_id"]
+        if self.__worker_count() <= 1:
+            return [function(directory, build_id, *args) for directory in self.__shard_dirs()]
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.__worker_count())
+        futures = [self.executor.submit(function, directory, build_id, *args) for directory in self.__shard_dirs()]
+        return [future.result() for future in futures]
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def build(self, shards: int = SHARD_COUNT, path: str = MOVIES_PATH, batch_size: int = BUILD_BATCH_SIZE, positions: bool = False) -> None:
+        # Build the shards' keyword indexes in parallel, each worker streams the
+        # movies file and keeps the movies of its shard, then store the corpus
+        # statistics. Replaces any earlier shards, vectors included
+        if shards <= 0:
+            raise ValueError("The shard count must be positive.")
+        if os.path.isdir(self.root):
+            shutil.rmtree(self.root)
+        self.shards = shards
+        jobs = [(shard_dir(self.root, shard), shard, shards, path, batch_size, positions) for shard in range(shards)]
+        if self.__worker_count() <= 1:
+            results = [_build_shard(*job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=self.__worker_count()) as executor:
+                results = list(executor.map(_build_shard, *zip(*jobs)))
+
+        lexicon, dfs = merge_document_frequencies([result[2] for result in results], [result[3] for result in results])
+        with open(self.stats_path, 'wb') as file:
+            np.savez(file, lexicon=lexicon, dfs=dfs)
+        self.__save_manifest({
+            "shards": shards,
+            "doc_count": sum(result[0] for result in results),
+            "length_sum": sum(result[1] for result in results),
+            "positions": positions,
+            "vectors": False,
+        })
+        print(f"Saved {shards} shards with {self.doc_count} documents to {self.root}")
+
+    def build_vectors(self, semantic) -> None:
+        # Split the chunk embeddings of a loaded ChunkedSemanticSearch into the
+        # shards, each shard's rows grouped by doc id
+        if not self.manifest:
+            raise ValueError("Build or load the shards before sharding the chunk embeddings.")
+        if semantic.chunk_embeddings is None or semantic.chunk_metadata is None:
+            raise ValueError("Chunk embeddings must be loaded before sharding them.")
+        row_doc_ids = semantic.chunk_metadata.chunk_doc_ids(np.arange(len(semantic.chunk_metadata)))
+        for shard, directory in enumerate(self.__shard_dirs()):
+            rows = np.flatnonzero(shard_of(row_doc_ids, self.shards) == shard)
+            rows = rows[np.argsort(row_doc_ids[rows], kind="stable")]
+            np.save(os.path.join(directory, "chunk_embeddings.npy"), np.ascontiguousarray(semantic.chunk_embeddings[rows]))
+            np.save(os.path.join(directory, "chunk_doc_ids.npy"), row_doc_ids[rows])
+        self.__save_manifest({**self.manifest, "vectors": True})
+        print(f"Sharded {len(row_doc_ids)} chunk embeddings into {self.shards} shards")
+
+    def __save_manifest(self, manifest: Dict) -> None:
+        # a new build id makes pool workers reopen their shards
+        manifest = {**manifest, "build_id": uuid.uuid4().hex}
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(manifest, file)
+        os.replace(tmp_path, self.manifest_path)
+        self.load()
+
+    def load(self) -> None:
+        self.manifest = open_json_file(self.manifest_path)
+        self.shards = self.manifest["shards"]
+        self.doc_count = self.manifest["doc_count"]
+        self.avg_doc_length = float(self.manifest["length_sum"] / self.doc_count) if self.doc_count > 0 else 0.0
+        with np.load(self.stats_path) as data:
+            self.lexicon = data["lexicon"]
+            self.idf = bm25_idf(self.doc_count, data["dfs"])
+
+    # Corpus-wide average doc length and IDF of the query tokens
+    def corpus_stats(self, tokens: List[str]) -> CorpusStats:
+        idfs = {}
+        for token in tokens:
+            key = token.encode("utf-8")
+            pos = int(np.searchsorted(self.lexicon, key))
+            found = pos < len(self.lexicon) and self.lexicon[pos] == key
+            idfs[token] = float(self.idf[pos]) if found else float(bm25_idf(self.doc_count, 0))
+        return CorpusStats(self.avg_doc_length, idfs)
+
+    # Best `limit` docs over all shards as (doc_ids, scores), best first, see InvertedIndex.bm25_top_k
+    def bm25_top_k(self, tokens: List[str], limit: int, k1=BM25_K1, phrases=None) -> Tuple[np.ndarray, np.ndarray]:
+        stats = self.corpus_stats(tokens)
+        with stage("shards.bm25"):
+            results = self.__map(_bm25_shard, tokens, limit, k1, phrases, stats)
+        with stage("shards.merge"):
+            return _merge(results, limit)
+
+    def bm25_search(self, query: str, limit: int, k1=BM25_K1) -> List[Dict]:
+        with stage("bm25.tokenize"):
+            tokens, phrases = parse_query(query)
+        if not self.has_positions:
+            # as InvertedIndex.bm25_search: quoted phrases score as their words
+            phrases = None
+        doc_ids, scores = self.bm25_top_k(tokens, limit, k1, phrases)
+        return [{"id": doc_id, "score": score} for doc_id, score in zip(doc_ids.tolist(), scores.tolist())]
+
+    # Best docs by their best chunk over all shards, as (doc ids, scores), best first
+    def chunk_top_k(self, query_embedding: np.ndarray, limit: int) -> Tuple[np.ndarray, np.ndarray]:
+        if not self.has_vectors:
+            raise ValueError("Shard the chunk embeddings before searching them.")
+        query_embedding = normalize_embeddings(query_embedding)
+        with stage("shards.chunks"):
+            results = self.__map(_chunk_shard, query_embedding, limit)
+        with stage("shards.merge"):
+            return _merge(results, limit)
+
+
+def shard_report(sharded: ShardedIndex, index: InvertedIndex, queries: List[str], limit: int, semantic=None) -> List[Dict]:
+    # Latency of the unsharded and the sharded search per query, and whether
+    # both return the same docs with the same scores. With semantic the chunk
+    # search is compared as well, against ChunkedSemanticSearch.movie_scores
+    report = []
+    for query in queries:
+        tokens = tokenize(query)
+        row = {"query": query}
+        searches = [("bm25", lambda: index.bm25_top_k(tokens, limit), lambda: sharded.bm25_top_k(tokens, limit))]
+        if semantic is not None and sharded.has_vectors:
+            embedding = semantic.generate_embedding(query)
+            searches.append(("chunks", lambda: semantic.movie_scores(query, limit), lambda: sharded.chunk_top_k(embedding, limit)))
+        for name, unsharded_search, sharded_search in searches:
+            start = time.perf_counter()
+            expected_ids, expected_scores = unsharded_search()
+            row[f"{name}_ms"] = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            doc_ids, scores = sharded_search()
+            row[f"{name}_sharded_ms"] = (time.perf_counter() - start) * 1000
+            row[f"{name}_identical"] = doc_ids.tolist() == expected_ids.tolist()
+            row[f"{name}_max_score_diff"] = float(np.max(np.abs(scores - expected_scores))) if row[f"{name}_identical"] and len(scores) else 0.0
+        report.append(row)
+    return report
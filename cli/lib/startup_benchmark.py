@@ -0,0 +1,80 @@
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+CLI_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> CLI script and arguments, run from the project root like the CLIs themselves
+STARTUP_COMMANDS: Dict[str, List[str]] = {
+    "keyword --help": ["keyword_search_cli.py", "--help"],
+    "keyword search": ["keyword_search_cli.py", "search", "space adventure"],
+    "keyword bm25search": ["keyword_search_cli.py", "bm25search", "space adventure"],
+    "semantic --help": ["semantic_search_cli.py", "--help"],
+    "semantic chunk": ["semantic_search_cli.py", "chunk", "A short text. In two sentences."],
+    "semantic search": ["semantic_search_cli.py", "search", "space adventure"],
+    "semantic search_chunked": ["semantic_search_cli.py", "search_chunked", "space adventure"],
+    "hybrid rrf_search": ["hybrid_search_cli.py", "rrf_search", "space adventure"],
+}
+
+# "import time: self [us] | cumulative | name", top-level imports have no indent before the name
+_IMPORT_LINE = re.compile(r"^import time:\s+\d+ \|\s+(\d+) \| (\S.*)$")
+
+
+def _command(args: List[str]) -> List[str]:
+    return [sys.executable, os.path.join(CLI_DIR, args[0]), *args[1:]]
+
+
+# Milliseconds spent importing modules during one run, from python -X importtime
+def import_time_ms(args: List[str]) -> float:
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", *_command(args)[1:]],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    total = 0
+    for line in process.stderr.splitlines():
+        match = _IMPORT_LINE.match(line)
+        if match:
+            total += int(match.group(1))
+    return total / 1000
+
+
+# (milliseconds to the first line of output, milliseconds to exit) of one run
+def time_to_first_result(args: List[str]) -> Tuple[float, float]:
+    start = time.perf_counter()
+    # unbuffered, else a piped child holds its output back until it exits
+    env = {**os.environ, "PYTHONUNBUFFERED": "1"}
+    process = subprocess.Popen(_command(args), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, env=env)
+    first_line = None
+    for line in process.stdout:
+        if first_line is None and line.strip():
+            first_line = (time.perf_counter() - start) * 1000
+    process.wait()
+    total = (time.perf_counter() - start) * 1000
+    if process.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} exited with status {process.returncode}")
+    return first_line if first_line is not None else total, total
+
+
+def startup_benchmark(commands: Optional[Dict[str, List[str]]] = None, runs: int = 5) -> List[dict]:
+    # median startup cost of every command over a number of fresh processes
+    report = []
+    for name, args in (commands or STARTUP_COMMANDS).items():
+        try:
+            timings = [time_to_first_result(args) for _ in range(runs)]
+        except RuntimeError as e:
+            report.append({"command": name, "error": str(e)})
+            continue
+        report.append({
+            "command": name,
+            "runs": runs,
+            "import_ms": import_time_ms(args),
+            "first_result_ms": statistics.median(first for first, _ in timings),
+            "total_ms": statistics.median(total for _, total in timings),
+        })
+    return report
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+
+import argparse
+from lib.profiling import PROFILE_ENV
+from lib.search_server import run_server
+from lib.search_utils import SERVER_MAX_PENDING, SERVER_WORKERS
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Search Server: loads the model and indexes once and serves JSON search requests")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="Search worker threads")
+    parser.add_argument("--max-pending", type=int, default=SERVER_MAX_PENDING, help="Requests allowed to wait for a worker before answering 503")
+    parser.add_argument("--profile", action="store_true", help=f"Time each search stage and count events, served as Prometheus text on GET /metrics. {PROFILE_ENV}=1 also enables it")
+
+    args = parser.parse_args()
+    run_server(args.host, args.port, args.workers, args.max_pending, args.profile)
+
+
+if __name__ == "__main__":
+    main()
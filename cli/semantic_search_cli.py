@@ -1,8 +1,21 @@
 #!/usr/bin/env python3
 
 import argparse
+from lib.ann_index import recall_report
 from lib.chunked_semantic_search import ChunkedSemanticSearch
+from lib.encoder import ENCODER_BACKENDS, benchmark_encoder
+from lib.micro_batch import measure_qps
+from lib.profiling import add_profile_arguments, finish_profile, start_profile
+from lib.query_cache import get_query_cache
+from lib.search_client import remote_search
+from lib.quantization import QUANTIZATION_MODES, quantization_report
 from lib.search_utils import (
+    ANN_NPROBE,
+    MICRO_BATCH_SIZE,
+    MICRO_BATCH_WAIT_MS,
+    SERVER_URL,
+    DEFAULT_CHUNK_OVERLAP,
+    DEFAULT_SEMANTIC_CHUNK_SIZE,
     load_movies,
     semantic_chunk,
     split_text_to_sentences,
@@ -16,6 +29,10 @@ from lib.semantic_search import (
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Semantic Search CLI")
+    parser.add_argument("--device", type=str, default="auto", help="Encoder device: auto, cpu, cuda or mps")
+    parser.add_argument("--backend", choices=ENCODER_BACKENDS, default="torch", help="Encoder backend")
+    parser.add_argument("--workers", type=int, default=1, help="Encoder processes, 0 for one per core")
+    parser.add_argument("--query-cache", type=str, default=None, help="Load query embeddings from this path and save them back on exit")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
     subparsers.add_parser("verify", help="Verify the semantic search model")
@@ -31,6 +48,11 @@ def main() -> None:
     search = subparsers.add_parser("search", help="Search for similar documents")   
     search.add_argument("query", type=str, help="Query text")
     search.add_argument("--limit", type=int, default=5, help="Number of results to return")
+    search.add_argument("--ann", action="store_true", help="Search the IVF index instead of scanning every embedding")
+    search.add_argument("--nprobe", type=int, default=ANN_NPROBE, help="IVF lists to scan per query with --ann")
+    search.add_argument("--quant", choices=QUANTIZATION_MODES, default=None, help="Score compressed embeddings")
+    search.add_argument("--no-rerank", action="store_true", help="With --quant, skip the float32 rerank of the best candidates")
+    search.add_argument("--server", type=str, nargs="?", const=SERVER_URL, default=None, help="Send the query to a running search server (default %(const)s)")
 
     chunk = subparsers.add_parser("chunk", help="Chunk text for processing")
     chunk.add_argument("text", type=str, help="Text to chunk")
@@ -43,12 +65,50 @@ def main() -> None:
     semantic_chunk_option.add_argument("--overlap", type=int, default=0, help="Overlap between chunks")
     
     embed_chunks = subparsers.add_parser("embed_chunks", help="Get Chunk embeddings from text")
+    embed_chunks.add_argument("--chunk-workers", type=int, default=0, help="Processes chunking descriptions while batches are encoded, default 0 chunks in-process")
 
     search_chunked = subparsers.add_parser("search_chunked", help="Search and score a query within the embedding chunks")
     search_chunked.add_argument("query", type=str, help="Query to search documents")
     search_chunked.add_argument("--limit", type=int, default=5, help="Maximum number of results to return")
+    search_chunked.add_argument("--ann", action="store_true", help="Search the IVF index instead of scanning every chunk")
+    search_chunked.add_argument("--nprobe", type=int, default=ANN_NPROBE, help="IVF lists to scan per query with --ann")
+    search_chunked.add_argument("--quant", choices=QUANTIZATION_MODES, default=None, help="Score compressed embeddings")
+    search_chunked.add_argument("--no-rerank", action="store_true", help="With --quant, skip the float32 rerank of the best candidates")
+    search_chunked.add_argument("--server", type=str, nargs="?", const=SERVER_URL, default=None, help="Send the query to a running search server (default %(const)s)")
 
+    build_ann = subparsers.add_parser("build_ann", help="Build the IVF approximate nearest-neighbour index")
+    build_ann.add_argument("--level", choices=["movie", "chunk"], default="chunk", help="Index movie or chunk embeddings")
+    build_ann.add_argument("--nlist", type=int, default=None, help="Number of IVF lists (default sqrt of the rows)")
+
+    ann_recall = subparsers.add_parser("ann_recall", help="Report IVF recall@k and latency against the exact scan")
+    ann_recall.add_argument("--level", choices=["movie", "chunk"], default="chunk", help="Index movie or chunk embeddings")
+    ann_recall.add_argument("--k", type=int, default=10, help="Neighbours compared per query")
+    ann_recall.add_argument("--samples", type=int, default=200, help="Embeddings sampled as queries")
+    ann_recall.add_argument("--nprobe", type=int, nargs="+", default=None, help="nprobe values to report")
+
+    quantize = subparsers.add_parser("quantize", help="Build compressed embeddings and report size and recall@k")
+    quantize.add_argument("--level", choices=["movie", "chunk"], default="chunk", help="Compress movie or chunk embeddings")
+    quantize.add_argument("--mode", choices=QUANTIZATION_MODES, default="int8", help="Quantization mode")
+    quantize.add_argument("--k", type=int, default=10, help="Neighbours compared per query")
+    quantize.add_argument("--samples", type=int, default=200, help="Embeddings sampled as queries")
+
+    encoder_benchmark = subparsers.add_parser("benchmark_encoder", help="Report encoder throughput in chunks/sec")
+    encoder_benchmark.add_argument("--backends", choices=ENCODER_BACKENDS, nargs="+", default=["torch"], help="Backends to compare")
+    encoder_benchmark.add_argument("--workers-list", type=int, nargs="+", default=[1], help="Worker counts to compare")
+    encoder_benchmark.add_argument("--limit", type=int, default=2000, help="Number of chunks to encode")
+
+    batching_benchmark = subparsers.add_parser("benchmark_batching", help="Compare concurrent search QPS with and without micro-batching")
+    batching_benchmark.add_argument("--threads", type=int, default=16, help="Concurrent callers")
+    batching_benchmark.add_argument("--queries", type=int, default=400, help="Distinct queries per run")
+    batching_benchmark.add_argument("--max-batch", type=int, default=MICRO_BATCH_SIZE, help="Largest batch")
+    batching_benchmark.add_argument("--max-wait-ms", type=float, default=MICRO_BATCH_WAIT_MS, help="Longest wait for a batch to fill")
+
+    add_profile_arguments(subparsers)
     args = parser.parse_args()
+    start_profile(args)
+    encoder_options = {"device": args.device, "backend": args.backend, "workers": args.workers}
+    if args.query_cache:
+        get_query_cache().load(args.query_cache)
 
     match args.command:
         case "chunk":
@@ -72,36 +132,120 @@ def main() -> None:
         case "embed_chunks":
             movies_data = load_movies()
 
-            css = ChunkedSemanticSearch()
-            embeddings = css.load_or_create_chunk_embeddings(movies_data)
+            css = ChunkedSemanticSearch(**encoder_options)
+            embeddings = css.load_or_create_chunk_embeddings(movies_data, args.chunk_workers)
             print(f"Generated {len(embeddings)} chunked embeddings")
 
         case "embed_text":
             embed_text(args.text)
         case "verify":
-            sm = SemanticSearch()
+            sm = SemanticSearch(**encoder_options)
             sm.verify_model()
         case "verify_embeddings":
             verify_embeddings()
         case "embedquery":
             embed_query_text(args.query)
+        case "search" if args.server:
+            results = remote_search("semantic", {"query": args.query, "limit": args.limit}, args.server)["results"]
+            for result in results:
+                print(f"{result['title']} (score: {result['score']:.4f})\n  {result['document']}\n")
         case "search":
-            sm = SemanticSearch()
+            sm = SemanticSearch(**encoder_options)
             movies_data = load_movies()
-            sm.load_or_create_embeddings(movies_data)
+            if args.quant:
+                sm.load_or_create_quantized_embeddings(movies_data, args.quant, rerank=not args.no_rerank)
+            else:
+                sm.load_or_create_embeddings(movies_data)
+            if args.ann:
+                sm.load_or_create_ann_index(nprobe=args.nprobe)
             results = sm.search(args.query, args.limit)
             for score, doc in results:
                 print(f"{doc['title']} (score: {score:.4f})\n  {doc['description']}\n")
+        case "search_chunked" if args.server:
+            results = remote_search("chunked", {"query": args.query, "limit": args.limit}, args.server)["results"]
+            for i, result in enumerate(results):
+                print(f"\n{i+1}. {result['title']} (score: {result['score']:.4f})")
+                print(f"   {result['document']}...")
         case "search_chunked":
-            css = ChunkedSemanticSearch()
+            css = ChunkedSemanticSearch(**encoder_options)
             movies_data = load_movies()
-            css.load_or_create_chunk_embeddings(movies_data)
+            if args.quant:
+                css.load_or_create_quantized_chunk_embeddings(movies_data, args.quant, rerank=not args.no_rerank)
+            else:
+                css.load_or_create_chunk_embeddings(movies_data)
+            if args.ann:
+                css.load_or_create_ann_index(nprobe=args.nprobe)
             results = css.search_chunks(args.query, args.limit)
 
             for i, result in enumerate(results):
                 score = result['score']
                 print(f"\n{i+1}. {result['title']} (score: {score:.4f})")
                 print(f"   {result['document']}...")
+        case "build_ann" | "ann_recall":
+            movies_data = load_movies()
+            if args.level == "movie":
+                searcher = SemanticSearch(**encoder_options)
+                searcher.load_or_create_embeddings(movies_data)
+            else:
+                searcher = ChunkedSemanticSearch(**encoder_options)
+                searcher.load_or_create_chunk_embeddings(movies_data)
+
+            if args.command == "build_ann":
+                index = searcher.load_or_create_ann_index(nlist=args.nlist, rebuild=True)
+                print(f"Built IVF index with {index.nlist} lists over {len(index.list_rows)} {args.level} embeddings")
+            else:
+                index = searcher.load_or_create_ann_index()
+                print(f"IVF index: {index.nlist} lists over {len(index.list_rows)} {args.level} embeddings")
+                for row in recall_report(index, args.k, args.samples, args.nprobe):
+                    print(
+                        f"nprobe {row['nprobe']:>4}: recall@{args.k} {row['recall']:.4f}"
+                        f"  ann {row['ann_ms']:.3f} ms  exact {row['exact_ms']:.3f} ms"
+                    )
+        case "quantize":
+            movies_data = load_movies()
+            if args.level == "movie":
+                searcher = SemanticSearch(**encoder_options)
+                vectors = searcher.load_or_create_embeddings(movies_data)
+                quantized = searcher.load_or_create_quantized_embeddings(movies_data, args.mode, rebuild=True)
+            else:
+                searcher = ChunkedSemanticSearch(**encoder_options)
+                searcher.load_or_create_chunk_embeddings(movies_data)
+                # exact neighbours in chunk_idx order, the order of the codes
+                vectors = searcher.chunk_embeddings
+                quantized = searcher.load_or_create_quantized_chunk_embeddings(movies_data, args.mode, rebuild=True)
+
+            print(
+                f"{args.mode}: {quantized.nbytes / 2**20:.2f} MiB for {len(quantized)} {args.level} embeddings"
+                f" (float32 {vectors.nbytes / 2**20:.2f} MiB, {vectors.nbytes / max(quantized.nbytes, 1):.1f}x smaller)"
+            )
+            for row in quantization_report(quantized, vectors, args.k, args.samples, searcher.rerank_embeddings):
+                print(
+                    f"{row['scoring']:>6}: recall@{args.k} {row['recall']:.4f}"
+                    f"  search {row['search_ms']:.3f} ms  exact {row['exact_ms']:.3f} ms"
+                )
+        case "benchmark_encoder":
+            chunks = []
+            for movie in load_movies():
+                chunks.extend(semantic_chunk(movie['description'], DEFAULT_SEMANTIC_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP))
+                if len(chunks) >= args.limit:
+                    break
+            chunks = chunks[:args.limit]
+            for row in benchmark_encoder(chunks, "all-MiniLM-L6-v2", args.device, args.backends, args.workers_list):
+                print(f"{row['encoder']}: {row['texts']} chunks in {row['seconds']:.2f}s, {row['chunks_per_sec']:.1f} chunks/sec")
+        case "benchmark_batching":
+            movies_data = load_movies()
+            sm = SemanticSearch(**encoder_options)
+            sm.load_or_create_embeddings(movies_data)
+            queries = [movie['title'] for movie in movies_data[:args.queries]]
+            # the query cache would hide the encoder, every run starts cold
+            get_query_cache().clear()
+            unbatched = measure_qps(lambda query: sm.search(query, 5), queries, args.threads)
+            get_query_cache().clear()
+            sm.enable_micro_batching(args.max_batch, args.max_wait_ms)
+            batched_qps = measure_qps(lambda query: sm.search(query, 5), queries, args.threads)
+            print(f"{len(queries)} queries from {args.threads} threads")
+            print(f"  unbatched:      {unbatched:.1f} queries/sec")
+            print(f"  micro-batched:  {batched_qps:.1f} queries/sec (mean batch {sm.search_batcher.mean_batch_size:.1f})")
         case "semantic_chunk":
             chunk_list = semantic_chunk(args.text, args.max_chunk_size, args.overlap)
             sentences = split_text_to_sentences(args.text)
@@ -114,5 +258,12 @@ def main() -> None:
         case _:
             parser.print_help()
 
+    if args.query_cache:
+        query_cache = get_query_cache()
+        query_cache.save(args.query_cache)
+        stats = query_cache.stats()
+        print(f"Query cache: {stats['hits']} hits, {stats['misses']} misses, {stats['size']} entries")
+    finish_profile(args)
+
 if __name__ == "__main__":
     main()
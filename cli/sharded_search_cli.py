@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import argparse
+from lib.inverted_index import InvertedIndex
+from lib.profiling import add_profile_arguments, finish_profile, start_profile
+from lib.search_utils import BUILD_BATCH_SIZE, SHARD_COUNT, SCORE_PRECISION, load_movies
+from lib.sharded_index import ShardedIndex, shard_report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Sharded Search CLI: the corpus split by doc id into shards searched in parallel")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    build_parser = subparsers.add_parser("build", help="Build the keyword index of every shard and the corpus-wide BM25 statistics")
+    build_parser.add_argument("--shards", type=int, default=SHARD_COUNT, help="Number of shards")
+    build_parser.add_argument("--batch-size", type=int, default=BUILD_BATCH_SIZE, help="Documents per indexing batch")
+    build_parser.add_argument("--positions", action="store_true", help="Also store token positions, for phrase queries")
+    build_parser.add_argument("--vectors", action="store_true", help="Also split the chunk embeddings into the shards (loads the model)")
+
+    vectors_parser = subparsers.add_parser("build_vectors", help="Split the chunk embeddings into the existing shards")
+
+    bm25_parser = subparsers.add_parser("bm25search", help="BM25 search over all shards")
+    bm25_parser.add_argument("query", type=str, help="Search query")
+    bm25_parser.add_argument("--limit", type=int, default=5, help="Limit")
+
+    chunked_parser = subparsers.add_parser("search_chunked", help="Chunked semantic search over all shards")
+    chunked_parser.add_argument("query", type=str, help="Search query")
+    chunked_parser.add_argument("--limit", type=int, default=5, help="Limit")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare results and latency of the sharded and the unsharded indexes")
+    compare_parser.add_argument("queries", type=str, nargs='+', help="Search queries")
+    compare_parser.add_argument("--limit", type=int, default=10, help="Limit")
+    compare_parser.add_argument("--semantic", action="store_true", help="Compare the chunked semantic search too (loads the model)")
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument("--workers", type=int, default=None, help="Worker processes, default one per shard up to the CPU count, 1 runs in-process")
+        subparser.add_argument("--device", type=str, default="auto", help="Encoder device")
+    add_profile_arguments(subparsers)
+    args = parser.parse_args()
+    start_profile(args)
+
+    match args.command:
+        case "build":
+            sharded = ShardedIndex(workers=args.workers)
+            sharded.build(args.shards, batch_size=args.batch_size, positions=args.positions)
+            if args.vectors:
+                sharded.build_vectors(load_chunked_search(args.device))
+
+        case "build_vectors":
+            sharded = load_sharded(args.workers)
+            sharded.build_vectors(load_chunked_search(args.device))
+
+        case "bm25search":
+            sharded = load_sharded(args.workers)
+            documents = {doc['id']: doc for doc in load_movies()}
+            try:
+                for result in sharded.bm25_search(args.query, args.limit):
+                    print(f"({result['id']}) {documents[result['id']]['title']} - Score: {result['score']:.2f}")
+            except ValueError as e:
+                print(e)
+            sharded.close()
+
+        case "search_chunked":
+            sharded = load_sharded(args.workers)
+            # only the query is encoded here, the shards hold the chunk embeddings
+            semantic = load_chunked_search(args.device, embeddings=False)
+            documents = {doc['id']: doc for doc in load_movies()}
+            doc_ids, scores = sharded.chunk_top_k(semantic.generate_embedding(args.query), args.limit)
+            for i, (doc_id, score) in enumerate(zip(doc_ids.tolist(), scores.tolist())):
+                print(f"\n{i+1}. {documents[doc_id]['title']} (score: {round(score, SCORE_PRECISION)})")
+                print(f"   {documents[doc_id]['description'][:100]}...")
+            sharded.close()
+
+        case "compare":
+            sharded = load_sharded(args.workers)
+            index = InvertedIndex()
+            index.load()
+            semantic = load_chunked_search(args.device) if args.semantic else None
+            # the first fan-out starts the worker processes, keep it out of the timings
+            sharded.bm25_top_k(["warmup"], 1)
+            for row in shard_report(sharded, index, args.queries, args.limit, semantic):
+                print(f"\n{row['query']}")
+                for name in ("bm25", "chunks"):
+                    if f"{name}_ms" in row:
+                        print(f"  {name}: {row[f'{name}_ms']:.2f} ms unsharded, {row[f'{name}_sharded_ms']:.2f} ms sharded, "
+                              f"identical: {row[f'{name}_identical']}, max score diff {row[f'{name}_max_score_diff']:.2e}")
+            sharded.close()
+
+        case _:
+            parser.print_help()
+
+    finish_profile(args)
+
+
+def load_sharded(workers) -> ShardedIndex:
+    sharded = ShardedIndex(workers=workers)
+    sharded.load()
+    return sharded
+
+
+def load_chunked_search(device, embeddings=True):
+    # imported here: only the vector commands need the model
+    from lib.chunked_semantic_search import ChunkedSemanticSearch
+    semantic = ChunkedSemanticSearch(device=device)
+    if embeddings:
+        semantic.load_or_create_chunk_embeddings(load_movies())
+    return semantic
+
+
+if __name__ == "__main__":
+    main()
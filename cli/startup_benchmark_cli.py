@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+from lib.startup_benchmark import STARTUP_COMMANDS, startup_benchmark
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Startup Benchmark: import time and time to first result of each CLI command in a fresh process")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh processes per command, the median is reported")
+    parser.add_argument("--command", type=str, action="append", choices=list(STARTUP_COMMANDS), default=None, help="Command to time, repeatable (default all)")
+    parser.add_argument("--json", type=str, default=None, help="Also write the report to this JSON file")
+
+    args = parser.parse_args()
+    commands = {name: STARTUP_COMMANDS[name] for name in args.command} if args.command else None
+    report = startup_benchmark(commands, args.runs)
+
+    print(f"{'command':<26} {'imports':>10} {'first result':>14} {'total':>10}")
+    for row in report:
+        if "error" in row:
+            print(f"{row['command']:<26} failed: {row['error']}")
+            continue
+        print(f"{row['command']:<26} {row['import_ms']:>8.1f}ms {row['first_result_ms']:>12.1f}ms {row['total_ms']:>8.1f}ms")
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()